@@ -4,16 +4,45 @@ Unified Python IDLE Backend Server (Fixed)
 Combines all features with proper input handling
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import sys
 import os
+import io
+import signal
+import socket
 import subprocess
-import tempfile
 import time
 import json
 import uuid
 import threading
+import hashlib
+import queue
+import codecs
+import select
+import selectors
+import asyncio
+import argparse
+import ast
+import base64
+import gzip
+import marshal
+import mmap
+import traceback
+import bisect
+import heapq
+import itertools
+import contextvars
+import re
+import sqlite3
+import tempfile
+import weakref
+import urllib.parse
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque, OrderedDict
 from datetime import datetime
 
 # Try to import optional features
@@ -24,10 +53,39 @@ try:
 except ImportError:
     HAS_LIMITER = False
 
+try:
+    import uvicorn
+    HAS_UVICORN = True
+except ImportError:
+    HAS_UVICORN = False
+
+try:
+    from flask_sock import Sock
+    HAS_SOCK = True
+except ImportError:
+    HAS_SOCK = False
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes responses with orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Initialize Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = "unified-python-idle-secret"
 CORS(app, origins="*", supports_credentials=True)
+if HAS_ORJSON:
+    app.json = OrjsonProvider(app)
 
 # Optional rate limiting
 if HAS_LIMITER:
@@ -39,874 +97,5523 @@ if HAS_LIMITER:
 else:
     limiter = None
 
-# Global state
-sessions = {}
-active_processes = {}
+# Optional WebSocket endpoint (/ws)
+sock = Sock(app) if HAS_SOCK else None
 
-class UnifiedCodeExecutor:
-    def __init__(self):
-        self.execution_timeout = 30
+@app.after_request
+def compress_response(response):
+    """gzip large JSON responses for clients that accept it"""
+    if (GZIP_MIN_BYTES <= 0 or response.direct_passthrough or response.is_streamed
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers.add('Vary', 'Accept-Encoding')
+    return response
 
-    def execute_code(self, code: str, session_id: str):
-        """Execute Python code with intelligent input detection and handling"""
-        try:
-            start_time = time.time()
-            
-            # Check if code needs input with smart detection
-            if 'input(' in code:
-                # Count and analyze input statements
-                input_info = self.analyze_input_statements(code)
-                return self.execute_interactive_code(code, session_id, start_time, input_info)
+# Execution configuration (override through environment variables)
+EXECUTION_ENGINE = os.environ.get('PYIDLE_ENGINE', 'subprocess')  # 'subprocess' or 'forkserver'
+FORKSERVER_PRELOAD = [name.strip() for name in os.environ.get(
+    'PYIDLE_PRELOAD', 'math,collections,re,json,random,itertools,functools,numpy').split(',') if name.strip()]
+POOL_SIZE = int(os.environ.get('PYIDLE_POOL_SIZE', '4'))
+POOL_MIN_IDLE = int(os.environ.get('PYIDLE_POOL_MIN_IDLE', str(max(1, POOL_SIZE // 2))))
+POOL_MAX_IDLE = int(os.environ.get('PYIDLE_POOL_MAX_IDLE', str(POOL_SIZE * 2)))
+RESULT_CACHE_ENTRIES = int(os.environ.get('PYIDLE_CACHE_ENTRIES', '0'))  # 0 disables the result cache
+RESULT_CACHE_BYTES = int(os.environ.get('PYIDLE_CACHE_BYTES', str(64 * 1024 * 1024)))
+MAX_RUNNING = int(os.environ.get('PYIDLE_MAX_RUNNING', str(max(8, 4 * (os.cpu_count() or 1)))))
+MAX_QUEUED = int(os.environ.get('PYIDLE_MAX_QUEUED', '100'))
+MAX_RUNNING_PER_CLIENT = int(os.environ.get('PYIDLE_MAX_PER_CLIENT', str(max(1, MAX_RUNNING * 3 // 4))))
+MAX_QUEUED_PER_CLIENT = int(os.environ.get('PYIDLE_MAX_QUEUED_PER_CLIENT', str(max(1, MAX_QUEUED * 3 // 4))))
+MAX_RUNNING_PER_SESSION = int(os.environ.get('PYIDLE_MAX_PER_SESSION', '1'))
+QUEUE_TIMEOUT = float(os.environ.get('PYIDLE_QUEUE_TIMEOUT', '10'))
+# Per-run resource limits applied inside every child (0 disables a limit).
+# RLIMIT_NPROC counts every process and thread of the server's user, not of
+# one run, so it is only a fallback for when no cgroup is available (see
+# RunCgroups); -1 sizes it from the user's current process count.
+RESOURCE_LIMITS = {
+    'cpu': int(os.environ.get('PYIDLE_LIMIT_CPU_SECONDS', '30')),
+    'as': int(os.environ.get('PYIDLE_LIMIT_MEMORY_MB', '1024')) * 1024 * 1024,
+    'nofile': int(os.environ.get('PYIDLE_LIMIT_OPEN_FILES', '256')),
+    'nproc': int(os.environ.get('PYIDLE_LIMIT_PROCESSES', '-1'))
+}
+# Every run gets its own cgroup v2 with pids.max = PYIDLE_PIDS_PER_RUN under
+# PYIDLE_CGROUP_ROOT, a cgroup delegated to the server ('off', the default,
+# disables; 'auto' uses the parent of the server's cgroup if it is writable and
+# already has the pids controller enabled). The server never moves itself.
+CGROUP_ROOT = os.environ.get('PYIDLE_CGROUP_ROOT', 'off')
+PIDS_PER_RUN = int(os.environ.get('PYIDLE_PIDS_PER_RUN', '64'))
+MAX_SESSIONS = int(os.environ.get('PYIDLE_MAX_SESSIONS', '10000'))
+SESSION_TTL = float(os.environ.get('PYIDLE_SESSION_TTL', '3600'))  # seconds without activity
+INPUT_IDLE_TIMEOUT = float(os.environ.get('PYIDLE_INPUT_IDLE_TIMEOUT', '300'))  # abandoned input prompts
+# Per-run budgets enforced by the deadline scheduler (0 disables one). Wall time
+# only counts while the program runs, not while it waits at an input() prompt;
+# that wait has its own input-idle budget. Requests may lower any of them with
+# `timeout`, `cpu_timeout` and `input_timeout`.
+RUN_TIME_LIMITS = {
+    'wall_time': float(os.environ.get('PYIDLE_WALL_TIME_SECONDS', '30')),
+    'cpu_time': float(os.environ.get('PYIDLE_CPU_TIME_SECONDS', str(RESOURCE_LIMITS['cpu']))),
+    'input_idle': INPUT_IDLE_TIMEOUT
+}
+TIME_LIMIT_FIELDS = {'timeout': 'wall_time', 'cpu_timeout': 'cpu_time', 'input_timeout': 'input_idle'}
+# Longest /execute, /input or /poll holds an interactive request open; a run still
+# busy after that is answered with `running: true` and a resume token for /poll
+LONG_POLL_SECONDS = float(os.environ.get('PYIDLE_LONG_POLL_SECONDS', '10'))
+# How long pipes may stay open after a run's leader is reaped (or a budget killed
+# it) before they are closed on whatever escaped its process group
+ORPHAN_PIPE_GRACE = float(os.environ.get('PYIDLE_ORPHAN_PIPE_GRACE', '2'))
+SESSION_REAP_INTERVAL = float(os.environ.get('PYIDLE_REAP_INTERVAL', '15'))
+BATCH_WORKERS = int(os.environ.get('PYIDLE_BATCH_WORKERS', str(os.cpu_count() or 1)))
+BATCH_MAX_JOBS = int(os.environ.get('PYIDLE_BATCH_MAX_JOBS', '10000'))
+ANALYSIS_CACHE_ENTRIES = int(os.environ.get('PYIDLE_ANALYSIS_CACHE_ENTRIES', '1024'))  # 0 disables it
+CODE_CACHE_ENTRIES = int(os.environ.get('PYIDLE_CODE_CACHE_ENTRIES', '512'))  # 0 disables bytecode shipping
+CODE_CACHE_BYTES = int(os.environ.get('PYIDLE_CODE_CACHE_BYTES', str(32 * 1024 * 1024)))
+GZIP_MIN_BYTES = int(os.environ.get('PYIDLE_GZIP_MIN_BYTES', '1024'))  # 0 disables response compression
+# Output kept in memory per stream of a run (characters). Past it only the first
+# half and the most recent text are kept; the full output is spooled to a file
+# and paged through GET /output/<run_id> until PYIDLE_OUTPUT_SPOOL_TTL expires.
+OUTPUT_MEMORY_CHARS = int(os.environ.get('PYIDLE_OUTPUT_MEMORY_CHARS', str(1024 * 1024)))  # 0 keeps everything
+OUTPUT_SPOOL_BYTES = int(os.environ.get('PYIDLE_OUTPUT_SPOOL_BYTES', str(64 * 1024 * 1024)))  # per stream, 0 disables spooling
+OUTPUT_SPOOL_FILES = int(os.environ.get('PYIDLE_OUTPUT_SPOOL_FILES', '64'))
+OUTPUT_SPOOL_TTL = float(os.environ.get('PYIDLE_OUTPUT_SPOOL_TTL', '600'))
+OUTPUT_SPOOL_DIR = os.environ.get('PYIDLE_OUTPUT_SPOOL_DIR') or None  # system temp directory by default
+OUTPUT_PAGE_BYTES = 64 * 1024
+OUTPUT_MAX_PAGE_BYTES = 1024 * 1024
+# Kernel mode: persistent per-session interpreters (0 kernels disables it)
+MAX_KERNELS = int(os.environ.get('PYIDLE_MAX_KERNELS', '32'))
+KERNEL_IDLE_TIMEOUT = float(os.environ.get('PYIDLE_KERNEL_IDLE_TIMEOUT', '600'))
+KERNEL_MAX_RSS_MB = int(os.environ.get('PYIDLE_KERNEL_MAX_RSS_MB', '512'))  # restart above this peak RSS
+
+# Imports and builtins that make a program's output depend on more than its
+# code and stdin; such programs are never served from the result cache
+NONDETERMINISTIC_MODULES = {
+    'random', 'secrets', 'uuid', 'time', 'datetime', 'calendar', 'os', 'io', 'pathlib',
+    'shutil', 'glob', 'tempfile', 'socket', 'urllib', 'http', 'requests', 'subprocess',
+    'threading', 'multiprocessing', 'asyncio', 'sqlite3', 'csv', 'pickle', 'shelve'
+}
+NONDETERMINISTIC_CALLS = {'open', '__import__', 'exec', 'eval', 'compile', 'id'}
+
+class SessionRecord:
+    """State of one session; __slots__ keeps the many idle records small"""
+
+    __slots__ = ('session_id', 'created_at', 'last_activity', 'reset_count', 'input_info', 'run')
+
+    def __init__(self, session_id: str, reset_count: int = 0):
+        self.session_id = session_id
+        self.created_at = datetime.now()
+        self.last_activity = time.time()
+        self.reset_count = reset_count
+        self.input_info = None
+        self.run = None  # {'process', 'channel', 'start_time', ...} while a program runs
+
+class SessionRegistry:
+    """Thread-safe, bounded map of session id -> SessionRecord.
+
+    Records are spread over lock-protected shards, each kept in
+    least-recently-used order. Past `max_sessions` the least recently used
+    session of the shard is evicted, preferring ones with nothing running.
+    The reaper (see UnifiedCodeExecutor) drops sessions idle for longer
+    than the TTL and kills programs left waiting for input.
+    """
+
+    def __init__(self, max_sessions: int, shard_count: int = 16):
+        self.shards = [(threading.Lock(), OrderedDict()) for _ in range(shard_count)]
+        self.shard_capacity = max(1, -(-max_sessions // shard_count))
+        self.max_sessions = self.shard_capacity * shard_count
+        self.evictions = 0
+
+    def _shard(self, session_id: str):
+        return self.shards[hash(session_id) % len(self.shards)]
+
+    def __len__(self):
+        return sum(len(records) for _, records in self.shards)
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def get(self, session_id: str):
+        lock, records = self._shard(session_id)
+        with lock:
+            return records.get(session_id)
+
+    def touch(self, session_id: str):
+        """Return the session's record, creating it if needed, and mark it active"""
+        lock, records = self._shard(session_id)
+        with lock:
+            record = records.get(session_id)
+            if record is None:
+                record = records[session_id] = SessionRecord(session_id)
+                evicted = self._evict(records, keep=session_id)
             else:
-                return self.execute_simple_code(code, start_time, session_id)
-                
-        except Exception as e:
-            return {
-                'success': False,
-                'error': f'Execution error: {str(e)}',
-                'session_id': session_id
-            }
+                evicted = None
+            record.last_activity = time.time()
+            records.move_to_end(session_id)
+        if evicted is not None:
+            stop_evicted_run(evicted)
+        return record
 
-    def analyze_input_statements(self, code: str):
-        """Analyze code to detect and count input() statements with context - ENHANCED"""
-        import re
-        import ast
-        
-        input_info = {
-            'count': 0,
-            'statements': [],
-            'variables': [],
-            'prompts': []
+    def reset(self, session_id: str):
+        """Start a fresh run state for the session (the running program must already be stopped)"""
+        record = self.touch(session_id)
+        lock, _ = self._shard(session_id)
+        with lock:
+            record.reset_count += 1
+            record.input_info = None
+            record.run = None
+        return record
+
+    def _evict(self, records: OrderedDict, keep: str = None):
+        """Drop the least recently used record if the shard is over capacity (lock held).
+
+        `keep` (the record being created) is never the victim; with nothing
+        else to drop the shard stays over capacity for now.
+        """
+        if len(records) <= self.shard_capacity:
+            return None
+        victim = next((session_id for session_id, record in records.items()
+                       if record.run is None and session_id != keep), None)
+        if victim is None:
+            victim = next((session_id for session_id in records if session_id != keep), None)
+            if victim is None:
+                return None
+        self.evictions += 1
+        return records.pop(victim)
+
+    def remove(self, session_id: str):
+        lock, records = self._shard(session_id)
+        with lock:
+            return records.pop(session_id, None)
+
+    def set_run(self, session_id: str, run: dict):
+        record = self.touch(session_id)
+        lock, _ = self._shard(session_id)
+        with lock:
+            record.run = run
+
+    def get_run(self, session_id: str):
+        record = self.get(session_id)
+        return record.run if record else None
+
+    def pop_run(self, session_id: str, process=None):
+        """Detach the session's run (only if it belongs to `process`, when given)"""
+        lock, records = self._shard(session_id)
+        with lock:
+            record = records.get(session_id)
+            if record is None or record.run is None:
+                return None
+            if process is not None and record.run.get('process') is not process:
+                return None
+            run, record.run = record.run, None
+            return run
+
+    def runs(self):
+        """Snapshot of (session_id, run) for every running program"""
+        found = []
+        for lock, records in self.shards:
+            with lock:
+                found.extend((session_id, record.run) for session_id, record in records.items() if record.run)
+        return found
+
+    def run_count(self):
+        return len(self.runs())
+
+    def expired(self, ttl: float, collect_timeout: float):
+        """Ids of idle sessions past the TTL, and (id, process) of runs that finished (or were
+        stopped by a budget) but were not collected within `collect_timeout`"""
+        now = time.time()
+        stale_sessions, idle_runs = [], []
+        for lock, records in self.shards:
+            with lock:
+                for session_id, record in records.items():
+                    idle = now - record.last_activity
+                    run = record.run
+                    if run is None:
+                        if idle > ttl:
+                            stale_sessions.append(session_id)
+                    elif run.get('streaming') or run.get('oneshot'):
+                        continue  # a request thread is watching these
+                    elif (run['channel'].exited or run['channel'].cell_result is not None) and idle > collect_timeout:
+                        idle_runs.append((session_id, run['process']))
+        return stale_sessions, idle_runs
+
+    def remove_if_idle(self, session_id: str, ttl: float):
+        """Remove the session unless it was used again since expired() saw it"""
+        lock, records = self._shard(session_id)
+        with lock:
+            record = records.get(session_id)
+            if record is None or record.run or time.time() - record.last_activity <= ttl:
+                return None
+            return records.pop(session_id)
+
+    def stats(self):
+        return {
+            'sessions': len(self),
+            'max_sessions': self.max_sessions,
+            'running': self.run_count(),
+            'evictions': self.evictions
         }
-        
-        try:
-            # Parse the code to get AST
-            tree = ast.parse(code)
-            
-            for node in ast.walk(tree):
-                if isinstance(node, ast.Call):
-                    # Check if this is an input() call
-                    if (isinstance(node.func, ast.Name) and node.func.id == 'input'):
-                        input_info['count'] += 1
-                        
-                        # Extract prompt if available
-                        prompt = "Enter input: "
-                        if node.args:
-                            if isinstance(node.args[0], ast.Constant):
-                                prompt = node.args[0].value
-                            elif isinstance(node.args[0], ast.Str):  # For older Python versions
-                                prompt = node.args[0].s
-                        
-                        input_info['prompts'].append(prompt)
-                        
-                        # Enhanced variable detection for complex expressions like int(input())
-                        variable = f"input_{input_info['count']}"
-                        if hasattr(node, 'lineno'):
-                            lines = code.split('\n')
-                            if node.lineno <= len(lines):
-                                line = lines[node.lineno - 1].strip()
-                                
-                                # Handle various assignment patterns
-                                # Pattern 1: simple assignment  var = input(...)
-                                simple_match = re.match(r'^(\w+)\s*=\s*input\s*\(', line)
-                                if simple_match:
-                                    variable = simple_match.group(1)
-                                else:
-                                    # Pattern 2: function wrapped input  var = int(input(...))
-                                    func_match = re.match(r'^(\w+)\s*=\s*\w+\s*\(\s*input\s*\(', line)
-                                    if func_match:
-                                        variable = func_match.group(1)
-                                    else:
-                                        # Pattern 3: complex expressions
-                                        complex_match = re.match(r'^(\w+)\s*=.*input\s*\(', line)
-                                        if complex_match:
-                                            variable = complex_match.group(1)
-                        
-                        input_info['variables'].append(variable)
-                        input_info['statements'].append({
-                            'variable': variable,
-                            'prompt': prompt,
-                            'line': getattr(node, 'lineno', 0)
-                        })
-        
-        except Exception as e:
-            # Enhanced fallback regex parsing
-            import re
-            
-            # Multiple patterns to catch different input formats
-            patterns = [
-                r'(\w+)\s*=\s*input\s*\(\s*(["\'].*?["\'])?\s*\)',  # var = input("prompt")
-                r'(\w+)\s*=\s*int\s*\(\s*input\s*\(\s*(["\'].*?["\'])?\s*\)\s*\)',  # var = int(input("prompt"))
-                r'(\w+)\s*=\s*float\s*\(\s*input\s*\(\s*(["\'].*?["\'])?\s*\)\s*\)',  # var = float(input("prompt"))
-                r'(\w+)\s*=\s*str\s*\(\s*input\s*\(\s*(["\'].*?["\'])?\s*\)\s*\)',  # var = str(input("prompt"))
-                r'(\w+)\s*=\s*\w+\s*\(\s*input\s*\(\s*(["\'].*?["\'])?\s*\)\s*\)'  # var = func(input("prompt"))
-            ]
-            
-            for pattern in patterns:
-                matches = re.findall(pattern, code)
-                for var, prompt_match in matches:
-                    prompt = prompt_match.strip('\'"') if prompt_match else "Enter input: "
-                    input_info['count'] += 1
-                    input_info['variables'].append(var)
-                    input_info['prompts'].append(prompt)
-                    input_info['statements'].append({
-                        'variable': var,
-                        'prompt': prompt,
-                        'line': input_info['count']
-                    })
-                    break  # Only use the first matching pattern
-        
-        return input_info
-
-    def execute_simple_code(self, code: str, start_time: float, session_id: str):
-        """Execute non-interactive code"""
-        try:
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as temp_file:
-                temp_file.write(code)
-                temp_file_path = temp_file.name
-            
-            try:
-                # Execute code with timeout
-                process = subprocess.run(
-                    [sys.executable, temp_file_path],
-                    capture_output=True,
-                    text=True,
-                    timeout=self.execution_timeout
-                )
-                
-                execution_time = round(time.time() - start_time, 3)
-                
-                return {
-                    'success': process.returncode == 0,
-                    'output': process.stdout,
-                    'error': process.stderr if process.stderr else None,
-                    'execution_time': execution_time,
-                    'session_id': session_id
-                }
-                
-            finally:
-                # Clean up
-                try:
-                    os.unlink(temp_file_path)
-                except:
-                    pass
-                    
-        except subprocess.TimeoutExpired:
-            return {
-                'success': False,
-                'output': '',
-                'error': f'Code execution timed out ({self.execution_timeout}s limit)',
-                'timeout': True,
-                'session_id': session_id
-            }
-        except Exception as e:
-            return {
-                'success': False,
-                'output': '',
-                'error': f'Execution error: {str(e)}',
-                'session_id': session_id
-            }
 
-    def execute_interactive_code(self, code: str, session_id: str, start_time: float, input_info: dict):
-        """Execute interactive code with SIMPLE but RELIABLE input handling"""
-        try:
-            # Ensure clean state - if there's already an active process, clean it up
-            if session_id in active_processes:
-                print(f"[DEBUG] Found existing process for session {session_id}, cleaning up...")
-                existing_info = active_processes[session_id]
-                if 'process' in existing_info:
-                    try:
-                        existing_info['process'].terminate()
-                    except:
-                        pass
-                if 'temp_file' in existing_info:
-                    try:
-                        os.unlink(existing_info['temp_file'])
-                    except:
-                        pass
-                del active_processes[session_id]
-            
-            # Store input information in session
-            if session_id not in sessions:
-                sessions[session_id] = {}
-            
-            sessions[session_id]['input_info'] = input_info
-            sessions[session_id]['current_input_index'] = 0
-            sessions[session_id]['inputs_collected'] = []
-            
-            # Create SIMPLE wrapper without complex JSON - just basic input/output
-            # Properly indent the user code
-            indented_code = '\n'.join('    ' + line for line in code.split('\n'))
-            
-            wrapper_code = f'''
+def stop_evicted_run(record: SessionRecord):
+    """Kill the program of a session pushed out of the registry.
+
+    Called by touch() after the shard lock is released. It still only sends
+    the kill without waiting, because it runs on the request that created
+    the new session.
+    """
+    executor.metrics.inc('pyidle_session_evictions_total')
+    if record.run:
+        kill_run(record.run['process'])
+
+# Global state
+sessions = SessionRegistry(MAX_SESSIONS)
+
+# Filename user code is compiled under; shows up in tracebacks
+USER_CODE_FILENAME = 'main.py'
+
+# Code shared by every worker interpreter's bootstrap. Runtime events
+# (prompts, completion) go to the parent as JSON lines on an inherited control
+# pipe, so stdout stays pure user output. The pipe is only reachable through
+# closures: `_send_control` is popped from the globals by the bootstrap that
+# runs the code, and builtins.input is replaced once, before any code arrives,
+# by a version that announces the prompt on that pipe; user code runs
+# unchanged. None of this stops a determined program from writing to its own
+# fds, so the server also checks every event against the run's state (see
+# ProcessChannel.accepts). `_apply_limits` installs the per-run resource
+# limits, `_print_user_exception` prints a traceback without the
+# bootstrap's frames and `_reset_peak_rss`/`_peak_rss_kb` measure the peak
+# RSS of the code alone (a child's ru_maxrss starts at its parent's).
+BOOTSTRAP_PRELUDE = r'''
 import sys
 import os
-
-# Simple input function that works
-def custom_input(prompt=""):
-    """Simple custom input function"""
-    if prompt:
-        print(prompt, end="", flush=True)
-    
-    # Clear signal for input request
-    print("\\n__NEED_INPUT__", flush=True)
-    
-    # Read input
+import json
+import types
+import builtins
+import linecache
+import traceback
+def _control_sender():
+    if 'PYIDLE_CONTROL_HANDLE' in os.environ:
+        import msvcrt
+        fd = msvcrt.open_osfhandle(int(os.environ.pop('PYIDLE_CONTROL_HANDLE')), os.O_WRONLY)
+    elif 'PYIDLE_CONTROL_FD' in os.environ:
+        fd = int(os.environ.pop('PYIDLE_CONTROL_FD'))
+    else:
+        return lambda event, **fields: None
+    os.set_inheritable(fd, False)
+    control = os.fdopen(fd, 'w', encoding='utf-8', buffering=1)
+    def send_control(event, **fields):
+        fields['event'] = event
+        try:
+            control.write(json.dumps(fields) + '\n')
+            control.flush()
+        except (OSError, ValueError):
+            pass
+    return send_control
+def _install_input(send_control):
+    def input(prompt=''):
+        prompt = str(prompt)
+        if prompt:
+            sys.stdout.write(prompt)
+            sys.stdout.flush()
+        send_control('input_request', prompt=prompt)
+        line = sys.stdin.readline()
+        if not line:
+            raise EOFError('EOF when reading a line')
+        return line[:-1] if line.endswith('\n') else line
+    builtins.input = input
+_send_control = _control_sender()
+_install_input(_send_control)
+del _control_sender, _install_input
+def _user_traceback(tb):
+    frames = []
+    while tb is not None:
+        if tb.tb_frame.f_globals is not globals():
+            frames.append(tb)
+        tb = tb.tb_next
+    tb = None
+    for frame in reversed(frames):
+        tb = types.TracebackType(tb, frame.tb_frame, frame.tb_lasti, frame.tb_lineno)
+    return tb
+def _print_user_exception(exc):
+    seen = set()
+    chained = exc
+    while chained is not None and id(chained) not in seen:
+        seen.add(id(chained))
+        chained.__traceback__ = _user_traceback(chained.__traceback__)
+        chained = chained.__cause__ or chained.__context__
+    traceback.print_exception(type(exc), exc, exc.__traceback__)
+def _apply_limits(skip=()):
+    limits = os.environ.pop('PYIDLE_RLIMITS', None)
     try:
-        user_input = sys.stdin.readline().strip()
-        return user_input
-    except:
-        return ""
+        import resource
+    except ImportError:
+        return
+    for name, value in json.loads(limits or '{}').items():
+        which = getattr(resource, 'RLIMIT_' + name.upper(), None)
+        if which is None or not value or name in skip:
+            continue
+        # A hard CPU limit one second above the soft one: SIGXCPU first, then SIGKILL
+        try:
+            resource.setrlimit(which, (value, value + 1 if name == 'cpu' else value))
+        except (ValueError, OSError):
+            pass
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')  # VmHWM restarts from the current RSS
+    except OSError:
+        pass
+def _peak_rss_kb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+'''
 
-# Replace built-in input
-original_input = input
-input = custom_input
+# Bootstrap run by every worker interpreter. The worker starts idle and blocks
+# until a "<byte length>[ <code length>]\n<source>[<code>]" frame arrives on
+# stdin; everything after the frame is left on stdin for the user's program.
+# The optional code part is the base64 of the marshalled code object the
+# server already compiled (see CodeCache), so the worker skips parsing and
+# compiling. Nothing touches disk: the source is registered with linecache so
+# tracebacks still show the lines.
+WORKER_BOOTSTRAP = BOOTSTRAP_PRELUDE + r'''
+def _run_worker(send_control):
+    global _apply_limits
+    header = sys.stdin.buffer.readline().split()
+    if not header:
+        sys.exit(0)
+    source = sys.stdin.buffer.read(int(header[0])).decode('utf-8')
+    code = None
+    if len(header) > 1:
+        import marshal
+        import binascii
+        code = marshal.loads(binascii.a2b_base64(sys.stdin.buffer.read(int(header[1]))))
+    _apply_limits()
+    del _apply_limits
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'main.py'
+    linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+    sys.argv = [filename]
+    user_globals = {'__name__': '__main__', '__builtins__': __builtins__, '__file__': filename}
+    _reset_peak_rss()
+    try:
+        exec(code if code is not None else compile(source, filename, 'exec'), user_globals)
+    except SystemExit:
+        raise
+    except BaseException as exc:
+        _print_user_exception(exc)
+        send_control('error', message=str(exc), max_rss=_peak_rss_kb())
+        sys.exit(1)
+    send_control('complete', max_rss=_peak_rss_kb())
+_run_worker(globals().pop('_send_control'))
+'''
 
-# Execute user code
-try:
-{indented_code}
-    print("\\n__COMPLETE__", flush=True)
-except Exception as e:
-    print(f"Error: {{e}}", file=sys.stderr)
-    print("\\n__ERROR__", flush=True)
+# Bootstrap of a kernel (see KernelManager): one interpreter that keeps its
+# globals and runs every frame it receives as a new cell; the end of each cell
+# is reported on the control pipe. The CPU limit is left out because it would
+# add up over the kernel's whole life; cells are bounded by the wall-clock
+# timeout instead.
+KERNEL_BOOTSTRAP = BOOTSTRAP_PRELUDE + r'''
+import signal
+_apply_limits(skip=('cpu',))
+del _apply_limits
+# Interrupts must raise KeyboardInterrupt even if the server ignores SIGINT
+signal.signal(signal.SIGINT, signal.default_int_handler)
+_reset_peak_rss()
+def _kernel_loop(send_control):
+    namespace = {'__name__': '__main__', '__builtins__': builtins}
+    cell = 0
+    while True:
+        try:
+            size = sys.stdin.buffer.readline()
+        except KeyboardInterrupt:
+            continue  # an interrupt that arrived after the cell had finished
+        if not size:
+            return
+        try:
+            length = int(size)
+        except ValueError:
+            # Not a frame header (e.g. a stray line a cell left unread): drop it
+            if size.strip():
+                sys.stderr.write(f'[kernel] ignoring unexpected line on stdin: {size[:80]!r}\n')
+                sys.stderr.flush()
+            continue
+        source = sys.stdin.buffer.read(length).decode('utf-8')
+        cell += 1
+        filename = f'<cell {cell}>'
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+        ok = True
+        try:
+            exec(compile(source, filename, 'exec'), namespace)
+        except SystemExit as exc:
+            ok = exc.code in (None, 0)
+        except BaseException as exc:
+            ok = False
+            _print_user_exception(exc)
+        send_control('cell_done', cell=cell, ok=ok, max_rss=_peak_rss_kb())
+_kernel_loop(globals().pop('_send_control'))
 '''
-            
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as temp_file:
-                temp_file.write(wrapper_code)
-                temp_file_path = temp_file.name
-            
-            # Start simple process
-            process = subprocess.Popen(
-                [sys.executable, '-u', temp_file_path],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=0
-            )
-            
-            # Store process info
-            active_processes[session_id] = {
-                'process': process,
-                'temp_file': temp_file_path,
-                'start_time': start_time,
-                'output_buffer': ''
-            }
-            
-            # Monitor with simple approach
-            return self.simple_monitor_process(session_id, process, temp_file_path, start_time)
-                
-        except Exception as e:
-            return {
-                'success': False,
-                'output': '',
-                'error': f'Execution error: {str(e)}',
-                'session_id': session_id
-            }
-                
-        except subprocess.TimeoutExpired:
-            return {
-                'success': False,
-                'output': '',
-                'error': f'Code execution timed out ({self.execution_timeout}s limit)',
-                'timeout': True,
-                'session_id': session_id
-            }
-        except Exception as e:
+
+def frame_source(source: str, code: str = None):
+    """Build the stdin frame that hands source code (and optionally its compiled code) to a worker"""
+    if code is None:
+        return f"{len(source.encode('utf-8'))}\n{source}"
+    return f"{len(source.encode('utf-8'))} {len(code)}\n{source}{code}"
+
+def control_pipe_options(control_w: int, env: dict):
+    """Popen arguments that let a worker inherit only the control pipe's write end"""
+    if sys.platform == 'win32':
+        import msvcrt
+        handle = msvcrt.get_osfhandle(control_w)
+        os.set_handle_inheritable(handle, True)
+        env['PYIDLE_CONTROL_HANDLE'] = str(handle)
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.lpAttributeList = {'handle_list': [handle]}
+        return {'startupinfo': startupinfo}
+    env['PYIDLE_CONTROL_FD'] = str(control_w)
+    return {'pass_fds': (control_w,)}
+
+# Set to a fresh token in every worker's environment; whatever the run starts
+# inherits it, so processes that left its group and tree can still be found
+RUN_TOKEN_ENV = 'PYIDLE_RUN_TOKEN'
+
+def worker_env():
+    """Environment for worker interpreters, carrying the per-run resource limits and a run token"""
+    return dict(os.environ, PYTHONIOENCODING='utf-8', PYIDLE_RLIMITS=json.dumps(RESOURCE_LIMITS),
+                **{RUN_TOKEN_ENV: uuid.uuid4().hex})
+
+class RunCgroups:
+    """One cgroup v2 leaf per run, capping its processes with pids.max.
+
+    Unlike RLIMIT_NPROC this counts only the run's own processes, so a fork
+    bomb hits its own ceiling without touching other runs or the server.
+    A worker is moved into a fresh cgroup right before its code arrives;
+    when the run exits the cgroup is emptied with cgroup.kill (which also
+    catches processes that left the process group) and removed.
+    """
+
+    def __init__(self, root: str = None, pids_max: int = 0):
+        self.root = root
+        self.pids_max = pids_max
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.leftover = []  # cgroups that were still busy when their run ended
+        self.created = 0
+        self.failed = 0
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+    @classmethod
+    def detect(cls, setting: str, pids_max: int):
+        """RunCgroups under `setting` (a path, 'auto' or 'off'); disabled when unusable"""
+        if setting in ('', 'off') or pids_max <= 0 or not sys.platform.startswith('linux'):
+            return cls()
+        try:
+            if setting == 'auto':
+                with open('/proc/self/cgroup') as own:
+                    path = next((line[3:].strip() for line in own if line.startswith('0::')), None)
+                if path is None or not os.path.exists('/sys/fs/cgroup/cgroup.controllers'):
+                    return cls()  # no unified (v2) hierarchy
+                # Only a subtree someone already delegated: never rearrange
+                # cgroups that systemd or a container runtime manages
+                root = os.path.dirname(os.path.join('/sys/fs/cgroup', path.strip('/')))
+                with open(os.path.join(root, 'cgroup.subtree_control')) as control:
+                    if 'pids' not in control.read().split() or not os.access(root, os.W_OK):
+                        return cls()
+            else:
+                root = setting
+                cls._delegate(root)
+        except (OSError, ValueError) as e:
+            if setting != 'auto':
+                print(f"[DEBUG] cgroup root {setting} is not usable ({e}); falling back to RLIMIT_NPROC")
+            return cls()
+        print(f"[DEBUG] Capping each run at {pids_max} processes with cgroups under {root}")
+        return cls(root, pids_max)
+
+    @staticmethod
+    def _delegate(root: str):
+        """Enable the pids controller for children of `root`.
+
+        cgroup v2 only allows that on a cgroup without processes of its own;
+        the server does not move anything out of the way. Raises OSError when
+        the cgroup is not writable or holds processes.
+        """
+        with open(os.path.join(root, 'cgroup.subtree_control')) as control:
+            if 'pids' in control.read().split():
+                return
+        with open(os.path.join(root, 'cgroup.controllers')) as controllers:
+            if 'pids' not in controllers.read().split():
+                raise OSError('pids controller not available')
+        with open(os.path.join(root, 'cgroup.procs')) as procs:
+            if procs.read().split():
+                raise OSError('the cgroup holds processes')
+        with open(os.path.join(root, 'cgroup.subtree_control'), 'w') as control:
+            control.write('+pids')
+
+    def attach(self, pid: int):
+        """Move `pid` into a new capped cgroup; returns its path, or None if that failed"""
+        if not self.enabled or not pid:
+            return None
+        path = os.path.join(self.root, f'run-{os.getpid()}-{next(self.ids)}')
+        try:
+            os.mkdir(path)
+            with open(os.path.join(path, 'pids.max'), 'w') as limit:
+                limit.write(str(self.pids_max))
+            with open(os.path.join(path, 'cgroup.procs'), 'w') as procs:
+                procs.write(str(pid))
+        except OSError as e:
+            print(f"[DEBUG] Could not put pid {pid} in a cgroup: {e}")
+            self.failed += 1
+            self._remove(path)
+            return None
+        self.created += 1
+        return path
+
+    def release(self, path: str):
+        """Kill whatever is left in a finished run's cgroup and remove it"""
+        if path is None:
+            return
+        try:
+            with open(os.path.join(path, 'cgroup.kill'), 'w') as kill:
+                kill.write('1')
+        except OSError:
+            pass  # before Linux 5.14; the process group kill has run already
+        with self.lock:
+            pending, self.leftover = self.leftover + [path], []
+        for leftover in pending:
+            if not self._remove(leftover):
+                with self.lock:
+                    self.leftover.append(leftover)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return False  # killed processes not reaped yet; retried with the next release
+        return True
+
+    def stats(self):
+        with self.lock:
             return {
-                'success': False,
-                'output': '',
-                'error': f'Execution error: {str(e)}',
-                'session_id': session_id
+                'enabled': self.enabled,
+                'root': self.root,
+                'pids_max': self.pids_max,
+                'created': self.created,
+                'failed': self.failed,
+                'leftover': len(self.leftover)
             }
 
-    def simple_monitor_process(self, session_id: str, process, temp_file_path: str, start_time: float):
-        """Simple, reliable process monitoring that actually works"""
-        output_buffer = ""
-        
-        # Read output line by line until we find input request or completion
-        while True:
-            if process.poll() is not None:
-                # Process finished
-                remaining_output, stderr = process.communicate()
-                if remaining_output:
-                    output_buffer += remaining_output
-                
-                execution_time = round(time.time() - start_time, 3)
-                self.cleanup_process(session_id, temp_file_path)
-                
-                # Clean output
-                clean_output = output_buffer.replace('__COMPLETE__', '').replace('__ERROR__', '').strip()
-                
-                return {
-                    'success': process.returncode == 0,
-                    'output': clean_output,
-                    'error': stderr if stderr else None,
-                    'execution_time': execution_time,
-                    'session_id': session_id
-                }
-            
+def user_process_count():
+    """Processes (threads included) of the server's user, as RLIMIT_NPROC counts them"""
+    uid = os.getuid()
+    count = 0
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
             try:
-                # Read a line with timeout
-                import select
-                import sys
-                
-                if sys.platform != 'win32':
-                    # Unix
-                    ready, _, _ = select.select([process.stdout], [], [], 0.1)
-                    if ready:
-                        line = process.stdout.readline()
-                        if line:
-                            output_buffer += line
-                else:
-                    # Windows - use simple approach
-                    time.sleep(0.1)
-                    try:
-                        # Try to read available data
-                        while True:
-                            line = process.stdout.readline()
-                            if not line:
-                                break
-                            output_buffer += line
-                            
-                            # Check for input request immediately
-                            if '__NEED_INPUT__' in line:
-                                active_processes[session_id]['output_buffer'] = output_buffer
-                                
-                                # Extract prompt from output
-                                lines = output_buffer.strip().split('\n')
-                                prompt = "Enter input: "
-                                for i, l in enumerate(lines):
-                                    if '__NEED_INPUT__' in l and i > 0:
-                                        prompt = lines[i-1].strip()
-                                        break
-                                
-                                return {
-                                    'success': True,
-                                    'output': output_buffer.replace('__NEED_INPUT__', '').strip(),
-                                    'waiting_for_input': True,
-                                    'input_prompt': prompt,
-                                    'session_id': session_id
-                                }
-                    except:
-                        # If reading fails, wait a bit and try again
-                        time.sleep(0.1)
-                
-                # Check for input request
-                if '__NEED_INPUT__' in output_buffer:
-                    active_processes[session_id]['output_buffer'] = output_buffer
-                    
-                    # Extract prompt from output
-                    lines = output_buffer.strip().split('\n')
-                    prompt = "Enter input: "
-                    for i, l in enumerate(lines):
-                        if '__NEED_INPUT__' in l and i > 0:
-                            prompt = lines[i-1].strip()
-                            break
-                    
-                    return {
-                        'success': True,
-                        'output': output_buffer.replace('__NEED_INPUT__', '').strip(),
-                        'waiting_for_input': True,
-                        'input_prompt': prompt,
-                        'session_id': session_id
-                    }
-                
-                # Timeout protection
-                if time.time() - start_time > 30:
-                    process.terminate()
-                    self.cleanup_process(session_id, temp_file_path)
-                    return {
-                        'success': False,
-                        'error': 'Process execution timeout',
-                        'session_id': session_id
-                    }
-                    
-            except Exception as e:
-                time.sleep(0.1)
+                with open(f'/proc/{entry}/status') as status:
+                    fields = dict(line.split(':', 1) for line in status if ':' in line)
+                if int(fields['Uid'].split()[0]) == uid:
+                    count += int(fields['Threads'])
+            except (OSError, KeyError, ValueError, IndexError):
                 continue
+    except OSError:
+        return None
+    return count
 
-    def detect_input_request(self, output: str):
-        """Detect input request in the output stream - CLEAN VERSION"""
-        import re
-        import json
-        
-        # Look for input request pattern
-        pattern = r'__INPUT_REQUEST__(\{.*?\})__'
-        match = re.search(pattern, output)
-        
-        if match:
-            try:
-                request_data = json.loads(match.group(1))
-                return request_data
-            except json.JSONDecodeError as e:
-                # Fallback to simple request
-                return {
-                    'index': 0,
-                    'prompt': 'Enter input: ',
-                    'variable': 'input_1'
-                }
-        
+run_cgroups = RunCgroups.detect(CGROUP_ROOT, PIDS_PER_RUN)
+if RESOURCE_LIMITS['nproc'] < 0:
+    # With per-run cgroups the rlimit is not needed. Without them the limit
+    # is per user, so it is sized for everything the server may run at once
+    # plus what the user already has; one run can still take the headroom of
+    # the others, and root ignores the limit altogether.
+    current = None if run_cgroups.enabled or not hasattr(os, 'getuid') else user_process_count()
+    if current is None:
+        RESOURCE_LIMITS['nproc'] = 0
+    else:
+        RESOURCE_LIMITS['nproc'] = current + (MAX_RUNNING + POOL_MAX_IDLE + MAX_KERNELS + 1) * PIDS_PER_RUN
+
+def wait_status(pid: int, flags: int):
+    """os.waitpid() that also returns the child's resource usage where wait4 exists"""
+    if hasattr(os, 'wait4'):
+        pid, status, usage = os.wait4(pid, flags)
+        return pid, status, {'ru_utime': usage.ru_utime, 'ru_stime': usage.ru_stime, 'ru_maxrss': usage.ru_maxrss}
+    pid, status = os.waitpid(pid, flags)
+    return pid, status, None
+
+class AccountedPopen(subprocess.Popen):
+    """Popen that reaps its child with wait4 and keeps the rusage in `rusage`.
+
+    Children started in their own process group (`own_group`) have that group
+    killed just before they are reaped, so background processes a program
+    leaves behind cannot outlive it or hold its pipes open.
+    """
+
+    rusage = None
+    own_group = False
+
+    def _waitpid(self, pid, flags):
+        if self.own_group and hasattr(os, 'waitid'):
+            # Until the child is reaped its pid (the group id) cannot be reused
+            if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT | (flags & os.WNOHANG)) is not None:
+                kill_process_group(pid)
+        pid, status, usage = wait_status(pid, flags)
+        if pid == self.pid and usage is not None:
+            self.rusage = usage
+        return pid, status
+
+    def _try_wait(self, wait_flags):
+        try:
+            return self._waitpid(self.pid, wait_flags)
+        except ChildProcessError:
+            # Same fallback as Popen: the child is gone and its status lost
+            return self.pid, 0
+
+    def _internal_poll(self, _deadstate=None, **kwargs):
+        if sys.platform == 'win32':
+            return super()._internal_poll(_deadstate, **kwargs)
+        return super()._internal_poll(_deadstate, _waitpid=self._waitpid)
+
+def resource_usage(process, channel=None):
+    """Measured CPU time, peak RSS and exit signal of a finished child (None while running).
+
+    The peak RSS is the one the child reported on its control pipe (None if
+    it died first or has no /proc): ru_maxrss cannot be used because a child
+    starts with its parent's high-water mark.
+    """
+    returncode = process.returncode
+    usage = getattr(process, 'rusage', None)
+    if returncode is None or usage is None:
         return None
+    peak_rss_kb = channel.peak_rss_kb if channel is not None else None
+    exit_signal = None
+    if returncode < 0:
+        try:
+            exit_signal = signal.Signals(-returncode).name
+        except ValueError:
+            exit_signal = str(-returncode)
+    return {
+        'user_cpu_time': round(usage['ru_utime'], 4),
+        'system_cpu_time': round(usage['ru_stime'], 4),
+        'peak_rss_kb': peak_rss_kb,
+        'exit_signal': exit_signal,
+        'cpu_limit_exceeded': exit_signal == 'SIGXCPU'
+    }
 
-    def clean_partial_output(self, output: str):
-        """Clean partial output for display (remove internal markers)"""
-        import re
-        
-        # Remove input request markers
-        cleaned = re.sub(r'__INPUT_REQUEST__\{.*?\}__', '', output)
-        cleaned = cleaned.replace('__WAITING_FOR_INPUT__', '')
-        cleaned = cleaned.replace('__EXECUTION_COMPLETE__', '')
-        cleaned = cleaned.replace('__EXECUTION_ERROR__', '')
-        
-        return cleaned.strip()
+def signal_error(resources):
+    """Error text for a child that died from a signal without printing anything"""
+    if not resources or not resources['exit_signal']:
+        return None
+    if resources['cpu_limit_exceeded']:
+        return f"CPU time limit exceeded ({RESOURCE_LIMITS['cpu']}s limit)"
+    return f"Process killed by {resources['exit_signal']}"
 
-    def clean_final_output(self, output: str):
-        """Clean final output for display"""
-        import re
-        
-        # Remove all internal markers
-        cleaned = re.sub(r'__INPUT_REQUEST__\{.*?\}__', '', output)
-        cleaned = cleaned.replace('__WAITING_FOR_INPUT__', '')
-        cleaned = cleaned.replace('__EXECUTION_COMPLETE__', '')
-        cleaned = cleaned.replace('__EXECUTION_ERROR__', '')
-        
-        return cleaned.strip()
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+def process_cpu_seconds(pid: int):
+    """User plus system CPU time a live child has used so far (None without /proc)"""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as stat:
+            # Fields after the parenthesised command name start at field 3 (state)
+            fields = stat.read().rsplit(b')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
 
-    def cleanup_process(self, session_id: str, temp_file_path: str):
-        """Clean up process resources thoroughly"""
+def process_tree(pid: int):
+    """Pids of the live descendants of `pid` (empty without /proc)"""
+    found, parents = [], [pid]
+    while parents:
+        parent = parents.pop()
         try:
-            # Clean up temp file
-            if temp_file_path and os.path.exists(temp_file_path):
-                os.unlink(temp_file_path)
-                print(f"[DEBUG] Cleaned up temp file: {temp_file_path}")
-            
-            # Remove from active processes
-            if session_id in active_processes:
-                process_info = active_processes[session_id]
-                process = process_info.get('process')
-                
-                # Ensure process is properly terminated
-                if process and process.poll() is None:
-                    try:
-                        process.terminate()
-                        process.wait(timeout=2)
-                    except subprocess.TimeoutExpired:
-                        process.kill()
-                    except:
-                        pass
-                
-                del active_processes[session_id]
-                print(f"[DEBUG] Cleaned up active process for session: {session_id}")
-            
-            # Reset session input state
-            if session_id in sessions:
-                # Keep session but reset input-related state
-                sessions[session_id]['input_info'] = None
-                sessions[session_id]['current_input_index'] = 0
-                sessions[session_id]['inputs_collected'] = []
-                sessions[session_id]['last_activity'] = datetime.now()
-                
-        except Exception as e:
-            print(f"[DEBUG] Error during cleanup: {e}")
-            # Even if cleanup fails, make sure we remove from active processes
-            if session_id in active_processes:
-                try:
-                    del active_processes[session_id]
-                except:
-                    pass
+            tasks = os.listdir(f'/proc/{parent}/task')
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                with open(f'/proc/{parent}/task/{task}/children') as children:
+                    pids = [int(child) for child in children.read().split()]
+            except (OSError, ValueError):
+                continue
+            found.extend(pids)
+            parents.extend(pids)
+    return found
+
+def processes_with_token(token: str):
+    """Pids whose environment carries the run token `token` (empty without /proc)"""
+    needle = f'\0{RUN_TOKEN_ENV}={token}\0'.encode()
+    found = []
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return found
+    for entry in entries:
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            with open(f'/proc/{entry}/environ', 'rb') as environ:
+                if needle in b'\0' + environ.read():
+                    found.append(int(entry))
+        except OSError:
+            pass  # gone, or not ours to read
+    return found
+
+TIMEOUT_ERRORS = {
+    'wall_time': 'Code execution timed out ({limit:g}s limit, not counting time waiting for input)',
+    'cpu_time': 'CPU time limit exceeded ({limit:g}s limit)',
+    'input_idle': 'Stopped after waiting {limit:g}s for input'
+}
+
+def timeout_fields(reason: str, limits: dict):
+    """Response fields for a run stopped by one of its budgets"""
+    return {
+        'error': TIMEOUT_ERRORS[reason].format(limit=limits[reason]),
+        'timeout': True,
+        'timeout_reason': reason
+    }
+
+# Every run gets its own session, and so its own process group, where the platform has them
+PROCESS_GROUP_OPTIONS = {'start_new_session': True} if hasattr(os, 'setsid') else {}
+
+def kill_process_group(pgid: int, sig: int = None):
+    """Signal every process in a run's group (SIGKILL by default); False if the group is gone"""
+    try:
+        os.killpg(pgid, sig or signal.SIGKILL)
+        return True
+    except (ProcessLookupError, PermissionError):
+        return False
+
+def kill_strays(process):
+    """SIGKILL what a run started outside its process group; returns how many were found.
+
+    The child's process tree is walked while it is alive, and every process
+    still carrying its run token is found even after it was re-parented.
+    Only a process that both left the tree and cleared its environment
+    escapes; a run cgroup catches that one too.
+    """
+    pids = set(process_tree(process.pid)) if process.pid and process.returncode is None else set()
+    token = getattr(process, 'run_token', None)
+    if token:
+        pids.update(processes_with_token(token))
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    return len(pids)
+
+def run_reclaimed(process, channel=None, timeout: float = 1.0):
+    """True once a stopped run's processes are all gone, as far as the server can tell"""
+    if channel is not None and channel.cgroup:
+        return True  # cgroup.kill empties the cgroup whatever its processes did
+    token = getattr(process, 'run_token', None)
+    deadline = time.monotonic() + timeout
+    # SIGKILLed processes take a moment to exit
+    while token and processes_with_token(token):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+def kill_run(process):
+    """SIGKILL a child that has not been reaped yet, together with everything it started"""
+    if process.returncode is not None:
+        return False
+    kill_strays(process)
+    if getattr(process, 'own_group', False) and process.pid:
+        return kill_process_group(process.pid)
+    try:
+        process.kill()
+        return True
+    except OSError:
+        return False
+
+def terminate_run(process, reason: str, channel=None, timeout: float = 2.0):
+    """Stop a run and everything it started, and wait until its resources are back.
+
+    Every route, timeout and reaper stops programs through here. The time
+    from the signal until the child is reaped and its pipes are closed (which
+    is also when its execution slot is released) is recorded as
+    pyidle_reclaim_seconds{reason} and returned; None if the run had
+    already ended. Descendants that left the process group are killed
+    through kill_strays(); one that also cleared its environment survives
+    unless the run has a cgroup (see run_reclaimed()).
+    """
+    started = time.perf_counter()
+    if process is None:
+        return None
+    if not kill_run(process):
+        if channel is None or channel.exited:
+            return None
+        # The leader is already reaped; only something outside its group holds the pipes
+        channel.force_close()
+    try:
+        if channel is not None:
+            reclaimed = channel.wait_for_exit(timeout)
+            if not reclaimed:
+                print(f"[DEBUG] Pipes of run {channel.run_id} still held open; closing them")
+                channel.force_close()
+                reclaimed = channel.wait_for_exit(timeout)
+        else:
+            process.wait(timeout=timeout)
+            reclaimed = True
+    except subprocess.TimeoutExpired:
+        reclaimed = False
+    if not reclaimed:
+        print(f"[DEBUG] Run not reclaimed within {timeout}s of SIGKILL ({reason})")
+        return None
+    elapsed = time.perf_counter() - started
+    executor.metrics.observe('pyidle_reclaim_seconds', elapsed, reason=reason)
+    return elapsed
+
+def start_worker(bootstrap: str = WORKER_BOOTSTRAP):
+    """Start a worker interpreter that waits for its code frame on stdin"""
+    env = worker_env()
+    control_r, control_w = os.pipe()
+    try:
+        worker = AccountedPopen(
+            [sys.executable, '-u', '-c', bootstrap, USER_CODE_FILENAME],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            errors='replace',
+            bufsize=0,
+            env=env,
+            **PROCESS_GROUP_OPTIONS,
+            **control_pipe_options(control_w, env)
+        )
+    except:
+        os.close(control_r)
+        raise
+    finally:
+        os.close(control_w)
+    worker.run_token = env[RUN_TOKEN_ENV]
+    worker.control = io.FileIO(control_r, 'rb')
+    worker.own_group = bool(PROCESS_GROUP_OPTIONS)
+    return worker
+
+class WarmInterpreterPool:
+    """Pool of idle, pre-started worker interpreters.
+
+    Every worker runs exactly one program and then exits, so isolation is the
+    same as a fresh spawn; only the interpreter startup is paid ahead of time.
+    The refill thread tops the pool back up to `size` once the idle count drops
+    below `min_idle`. Misses grow `size` (up to `max_idle`) so bursts get more
+    warm workers next time.
+    """
+
+    def __init__(self, size: int, min_idle: int, max_idle: int):
+        self.size = max(0, min(size, max_idle))
+        self.min_idle = max(1, min(min_idle, self.size)) if self.size else 0
+        self.max_idle = max_idle
+        self.idle = deque()
+        self.condition = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.spawned = 0
+        self.running = self.size > 0
+
+        if self.running:
+            threading.Thread(target=self._refill_loop, daemon=True).start()
+
+    @property
+    def enabled(self):
+        return self.running
+
+    def spawn_worker(self):
+        """Start a new worker for the pool"""
+        worker = start_worker()
+        with self.condition:
+            self.spawned += 1
+        return worker
+
+    def acquire(self):
+        """Take a ready worker, spawning one on the spot if the pool is empty"""
+        with self.condition:
+            while self.idle:
+                worker = self.idle.popleft()
+                if worker.poll() is None:
+                    self.hits += 1
+                    self.condition.notify()
+                    return worker
+            self.misses += 1
+            if self.size < self.max_idle:
+                self.size += 1
+            self.condition.notify()
+        return self.spawn_worker()
+
+    def _refill_loop(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.idle) >= self.min_idle:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                missing = self.size - len(self.idle)
+
+            for _ in range(missing):
+                try:
+                    worker = self.spawn_worker()
+                except Exception as e:
+                    print(f"[DEBUG] Failed to spawn pool worker: {e}")
+                    time.sleep(1)
+                    break
+                with self.condition:
+                    self.idle.append(worker)
+
+    def shutdown(self):
+        """Stop refilling and kill every idle worker"""
+        with self.condition:
+            self.running = False
+            workers = list(self.idle)
+            self.idle.clear()
+            self.condition.notify_all()
+        for worker in workers:
+            try:
+                worker.kill()
+                worker.wait(timeout=2)
+            except:
+                pass
+
+    def stats(self):
+        with self.condition:
+            return {
+                'enabled': self.running,
+                'size': self.size,
+                'min_idle': self.min_idle,
+                'max_idle': self.max_idle,
+                'idle': len(self.idle),
+                'hits': self.hits,
+                'misses': self.misses,
+                'spawned': self.spawned
+            }
+
+# Fork server ("zygote") source. It imports the preload modules once, then
+# waits on a unix socket for (stdin, stdout, stderr, control) descriptors and forks one
+# child per request. Children share the preloaded pages copy-on-write and go
+# on to run WORKER_BOOTSTRAP (argv[2]) exactly like a pool worker. The parent
+# reaps children and reports their exit codes back over the socket.
+FORKSERVER_SOURCE = r"""
+import os, sys, json, signal, socket, select, importlib
+
+def _serve():
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    preloaded = []
+    for name in sys.argv[4:]:
+        try:
+            importlib.import_module(name)
+            preloaded.append(name)
+        except Exception:
+            pass
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(wake_w)
+    sock.send(json.dumps({'ready': True, 'preloaded': preloaded}).encode())
+
+    while True:
+        ready, _, _ = select.select([0, sock, wake_r], [], [])
+        if 0 in ready and not os.read(0, 1024):
+            os._exit(0)
+        if wake_r in ready:
+            try:
+                while os.read(wake_r, 1024):
+                    pass
+            except BlockingIOError:
+                pass
+        while True:
+            try:
+                if hasattr(os, 'waitid'):
+                    # Peek first: while the exited child is unreaped its pid, which
+                    # is also its process group id, cannot be reused, so anything
+                    # the program left running in its group can be killed safely
+                    info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+                    if info is None:
+                        break
+                    try:
+                        os.killpg(info.si_pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                    pid, status, usage = os.wait4(info.si_pid, 0)
+                else:
+                    pid, status, usage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            sock.send(json.dumps({
+                'exit': pid,
+                'returncode': os.waitstatus_to_exitcode(status),
+                'rusage': {'ru_utime': usage.ru_utime, 'ru_stime': usage.ru_stime, 'ru_maxrss': usage.ru_maxrss}
+            }).encode())
+        if sock in ready:
+            message, fds, _, _ = socket.recv_fds(sock, 4096, 4)
+            request = json.loads(message)
+            pid = os.fork()
+            if pid == 0:
+                os.setsid()  # own process group, so a cancel reaches everything the run starts
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.close(wake_r)
+                os.close(wake_w)
+                sock.close()
+                for target, fd in enumerate(fds[:3]):
+                    os.dup2(fd, target)
+                    os.close(fd)
+                os.environ['PYIDLE_CONTROL_FD'] = str(fds[3])
+                os.environ['PYIDLE_RUN_TOKEN'] = request['token']
+                if 'numpy' in sys.modules:
+                    sys.modules['numpy'].random.seed()
+                return
+            for fd in fds:
+                os.close(fd)
+            sock.send(json.dumps({'id': request['id'], 'pid': pid}).encode())
+
+_serve()
+del _serve
+_bootstrap = sys.argv[2]
+sys.argv = [sys.argv[0], sys.argv[3]]
+exec(compile(_bootstrap, '<bootstrap>', 'exec'), {'__name__': '__bootstrap__', '__builtins__': __builtins__})
+"""
+
+class ForkedProcess:
+    """Popen-compatible handle for a child forked by the fork server"""
+
+    own_group = True  # the fork server puts every child in its own session
+
+    def __init__(self, stdin_fd: int, stdout_fd: int, stderr_fd: int, control_fd: int):
+        self.args = ['<forkserver>']
+        self.pid = None
+        self.returncode = None
+        self.fork_latency = None
+        self.rusage = None
+        self.run_token = uuid.uuid4().hex  # inherited by what it starts (see RUN_TOKEN_ENV)
+        self.stdin = io.TextIOWrapper(io.FileIO(stdin_fd, 'wb'), encoding='utf-8', errors='replace', write_through=True)
+        self.stdout = io.TextIOWrapper(io.FileIO(stdout_fd, 'rb'), encoding='utf-8', errors='replace')
+        self.stderr = io.TextIOWrapper(io.FileIO(stderr_fd, 'rb'), encoding='utf-8', errors='replace')
+        self.control = io.FileIO(control_fd, 'rb')
+        self.started = threading.Event()
+        self.exited = threading.Event()
+        self.on_reaped = None  # set by the multiplexer watching its pipes
+        self._output = None
+        self._threads = []
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self.exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.pid and self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def communicate(self, input=None, timeout=None):
+        """Same contract as Popen.communicate, including retry after a timeout"""
+        if self._output is None:
+            self._output = ([], [])
+
+            def write_input():
+                try:
+                    if input:
+                        self.stdin.write(input)
+                    self.stdin.close()
+                except (OSError, ValueError):
+                    pass
+
+            def read_stream(stream, chunks):
+                try:
+                    chunks.append(stream.read())
+                    stream.close()
+                except (OSError, ValueError):
+                    pass
+
+            self._threads = [
+                threading.Thread(target=write_input, daemon=True),
+                threading.Thread(target=read_stream, args=(self.stdout, self._output[0]), daemon=True),
+                threading.Thread(target=read_stream, args=(self.stderr, self._output[1]), daemon=True)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                raise subprocess.TimeoutExpired(self.args, timeout)
+        self.wait(None if deadline is None else max(0, deadline - time.monotonic()))
+        return ''.join(self._output[0]), ''.join(self._output[1])
+
+    def close(self):
+        for stream in (self.stdin, self.stdout, self.stderr, self.control):
+            try:
+                stream.close()
+            except:
+                pass
+
+class ForkServer:
+    """Long-lived zygote interpreter that forks one child per run"""
+
+    def __init__(self, preload: list):
+        self.preload = preload
+        self.lock = threading.Lock()
+        self.process = None
+        self.sock = None
+        self.preloaded = []
+        self.pending = {}
+        self.children = {}
+        self.next_id = 0
+        self.forks = 0
+        self.total_fork_latency = 0.0
+        self.last_fork_latency = None
+        self.start()
+
+    def start(self):
+        """Start (or restart) the zygote and wait until its preloads are done"""
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        env = worker_env()
+        del env[RUN_TOKEN_ENV]  # each child gets its own with the fork request
+        self.process = subprocess.Popen(
+            [sys.executable, '-u', '-c', FORKSERVER_SOURCE, str(child_sock.fileno()), WORKER_BOOTSTRAP, USER_CODE_FILENAME] + self.preload,
+            stdin=subprocess.PIPE,
+            pass_fds=(child_sock.fileno(),),
+            start_new_session=True,
+            env=env
+        )
+        child_sock.close()
+
+        parent_sock.settimeout(120)
+        hello = json.loads(parent_sock.recv(65536))
+        parent_sock.settimeout(None)
+
+        self.sock = parent_sock
+        self.preloaded = hello.get('preloaded', [])
+        threading.Thread(target=self._reader_loop, args=(parent_sock,), daemon=True).start()
+        print(f"[DEBUG] Fork server {self.process.pid} ready, preloaded: {', '.join(self.preloaded) or 'nothing'}")
+
+    def spawn(self):
+        """Fork a fresh child; returns a Popen-like handle waiting for its code frame"""
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        control_r, control_w = os.pipe()
+        handle = ForkedProcess(stdin_w, stdout_r, stderr_r, control_r)
+
+        with self.lock:
+            if self.process.poll() is not None:
+                print("[DEBUG] Fork server exited, restarting")
+                self.start()
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = handle
+            sock = self.sock
+
+        started = time.perf_counter()
+        try:
+            socket.send_fds(sock, [json.dumps({'id': request_id, 'token': handle.run_token}).encode()], [stdin_r, stdout_w, stderr_w, control_w])
+        finally:
+            for fd in (stdin_r, stdout_w, stderr_w, control_w):
+                os.close(fd)
+
+        if not handle.started.wait(10):
+            with self.lock:
+                self.pending.pop(request_id, None)
+            handle.close()
+            raise RuntimeError('Fork server did not respond')
+
+        handle.fork_latency = time.perf_counter() - started
+        with self.lock:
+            self.forks += 1
+            self.total_fork_latency += handle.fork_latency
+            self.last_fork_latency = handle.fork_latency
+        return handle
+
+    def _reader_loop(self, sock):
+        while True:
+            try:
+                message = sock.recv(65536)
+            except OSError:
+                break
+            if not message:
+                break
+
+            event = json.loads(message)
+            with self.lock:
+                if 'pid' in event:
+                    handle = self.pending.pop(event['id'], None)
+                    if handle:
+                        handle.pid = event['pid']
+                        self.children[handle.pid] = handle
+                        handle.started.set()
+                elif 'exit' in event:
+                    handle = self.children.pop(event['exit'], None)
+                    if handle:
+                        handle.rusage = event.get('rusage')
+                        handle.returncode = event['returncode']
+                        handle.exited.set()
+                        if handle.on_reaped:
+                            handle.on_reaped()
+
+        # The zygote is gone; nobody will report these children any more
+        with self.lock:
+            orphans = list(self.children.values())
+            self.children.clear()
+        for handle in orphans:
+            handle.returncode = -1
+            handle.exited.set()
+            if handle.on_reaped:
+                handle.on_reaped()
+
+    def shutdown(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=2)
+        except:
+            pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pid': self.process.pid,
+                'alive': self.process.poll() is None,
+                'preloaded': self.preloaded,
+                'forks': self.forks,
+                'avg_fork_latency_ms': round(self.total_fork_latency / self.forks * 1000, 3) if self.forks else None,
+                'last_fork_latency_ms': round(self.last_fork_latency * 1000, 3) if self.last_fork_latency is not None else None
+            }
+
+class OutputSpool:
+    """Complete text of one output stream on disk, for output past the memory cap.
+
+    The file is grown in steps and written through an mmap, so appending is a
+    memory copy and reading any page touches only that page.
+    """
+
+    def __init__(self, max_bytes: int, directory: str = None):
+        self.max_bytes = max_bytes
+        self.file = tempfile.TemporaryFile(prefix='pyidle-output-', dir=directory)
+        self.map = None
+        self.capacity = 0
+        self.size = 0
+        self.dropped = 0  # bytes past max_bytes that were not kept
+        self.closed = False
+        self.lock = threading.Lock()
+        self.last_access = time.time()
+
+    def write(self, data: bytes):
+        with self.lock:
+            if self.closed:
+                return
+            kept = data[:max(0, self.max_bytes - self.size)]
+            self.dropped += len(data) - len(kept)
+            if not kept:
+                return
+            end = self.size + len(kept)
+            if end > self.capacity:
+                self._grow(end)
+            self.map[self.size:end] = kept
+            self.size = end
+
+    def _grow(self, needed: int):
+        capacity = min(self.max_bytes, max(needed, self.capacity * 2, 64 * 1024))
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(capacity)
+        self.map = mmap.mmap(self.file.fileno(), capacity)
+        self.capacity = capacity
+
+    def read(self, offset: int, limit: int):
+        """Up to `limit` bytes from `offset` as text; returns (text, next_offset)"""
+        with self.lock:
+            self.last_access = time.time()
+            if self.closed or offset >= self.size:
+                return '', min(offset, self.size)
+            end = min(self.size, offset + limit)
+            # Do not cut a UTF-8 sequence in half; the next page starts with it
+            while offset < end < self.size and (self.map[end] & 0xC0) == 0x80:
+                end -= 1
+            if end == offset:
+                end = min(self.size, offset + limit)
+            return self.map[offset:end].decode('utf-8', errors='replace'), end
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            try:
+                if self.map is not None:
+                    self.map.close()
+                self.file.close()
+            except:
+                pass
+
+class OutputSpoolRegistry:
+    """Spools by (run_id, stream), closed after `ttl` seconds unread or when over `max_files`"""
+
+    def __init__(self, max_bytes: int, max_files: int, ttl: float, directory: str = None):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.ttl = ttl
+        self.directory = directory
+        self.spools = OrderedDict()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 and self.max_files > 0
+
+    def create(self, run_id: str, stream: str):
+        if not self.enabled:
+            return None
+        try:
+            spool = OutputSpool(self.max_bytes, self.directory)
+        except OSError as e:
+            print(f"[DEBUG] Could not create output spool: {e}")
+            return None
+        with self.lock:
+            self.spools[(run_id, stream)] = spool
+            self.created += 1
+            while len(self.spools) > self.max_files:
+                _, evicted = self.spools.popitem(last=False)
+                evicted.close()
+                self.evicted += 1
+        return spool
+
+    def get(self, run_id: str, stream: str = 'stdout'):
+        with self.lock:
+            spool = self.spools.get((run_id, stream))
+            if spool is not None:
+                self.spools.move_to_end((run_id, stream))
+            return spool
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            expired = [key for key, spool in self.spools.items() if spool.last_access < cutoff]
+            spools = [self.spools.pop(key) for key in expired]
+        for spool in spools:
+            spool.close()
+        return len(spools)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'memory_chars': OUTPUT_MEMORY_CHARS,
+                'spools': len(self.spools),
+                'spooled_bytes': sum(spool.size for spool in self.spools.values()),
+                'created': self.created,
+                'evicted': self.evicted
+            }
+
+output_spools = OutputSpoolRegistry(OUTPUT_SPOOL_BYTES, OUTPUT_SPOOL_FILES, OUTPUT_SPOOL_TTL, OUTPUT_SPOOL_DIR)
+
+def new_run_id():
+    """Run ids carry the worker id in multi-worker mode so /output can be routed"""
+    run_id = uuid.uuid4().hex
+    return f'{cluster.worker_id}-{run_id}' if cluster else run_id
+
+class OutputCapture:
+    """One output stream of a run, bounded in memory.
+
+    Text is kept as chunks with the character offset each starts at. Once
+    more than `memory_limit` characters have been produced, only the first
+    half of that (the head) and the most recent text (the tail) stay in
+    memory; the complete stream is written to a spool from then on. Reads
+    across the dropped middle get a marker line in its place.
+    """
+
+    def __init__(self, run_id: str, stream: str, memory_limit: int = OUTPUT_MEMORY_CHARS):
+        self.run_id = run_id
+        self.stream = stream
+        self.memory_limit = memory_limit
+        self.chunks = []
+        self.offsets = []
+        self.length = 0  # characters produced, including any no longer in memory
+        self.retained = 0
+        self.head_chunks = 0
+        self.head_length = 0
+        self.truncated = False
+        self.spool = None
+
+    def append(self, text: str):
+        self.offsets.append(self.length)
+        self.chunks.append(text)
+        self.length += len(text)
+        self.retained += len(text)
+        if self.spool is not None:
+            self.spool.write(text.encode('utf-8', errors='replace'))
+        if 0 < self.memory_limit < self.retained:
+            self._trim()
+
+    def _trim(self):
+        if not self.truncated:
+            self.truncated = True
+            self.spool = output_spools.create(self.run_id, self.stream)
+            if self.spool is not None:
+                self.spool.write(''.join(self.chunks).encode('utf-8', errors='replace'))
+            self._split_head(self.memory_limit // 2)
+
+        excess = self.retained - self.memory_limit
+        end = self.head_chunks
+        while excess > 0 and end < len(self.chunks) and len(self.chunks[end]) <= excess:
+            excess -= len(self.chunks[end])
+            self.retained -= len(self.chunks[end])
+            end += 1
+        del self.chunks[self.head_chunks:end]
+        del self.offsets[self.head_chunks:end]
+        if excess > 0 and self.head_chunks < len(self.chunks):
+            index = self.head_chunks
+            self.chunks[index] = self.chunks[index][excess:]
+            self.offsets[index] += excess
+            self.retained -= excess
+
+    def _split_head(self, head_length: int):
+        index = bisect.bisect_right(self.offsets, head_length) - 1
+        split = head_length - self.offsets[index]
+        if 0 < split < len(self.chunks[index]):
+            chunk = self.chunks[index]
+            self.chunks[index:index + 1] = [chunk[:split], chunk[split:]]
+            self.offsets.insert(index + 1, head_length)
+            index += 1
+        elif split >= len(self.chunks[index]):
+            index += 1
+        self.head_chunks = index
+        self.head_length = head_length
+
+    def omitted_marker(self, count: int):
+        where = f'; GET /output/{self.run_id}' + ('?stream=stderr' if self.stream == 'stderr' else '') + ' for all of it'
+        return f'\n[... {count} characters of output omitted{where if self.spool is not None else ""} ...]\n'
+
+    def since(self, cursor: int):
+        """Text after character offset `cursor` and the offset it ends at"""
+        if not self.truncated and len(self.chunks) > 1 and cursor <= 0:
+            # Keep the joined text so the next full read does not join again
+            self.chunks = [''.join(self.chunks)]
+            self.offsets = [0]
+        position = min(max(cursor, 0), self.length)
+        parts = []
+        for index in range(max(0, bisect.bisect_right(self.offsets, position) - 1), len(self.chunks)):
+            start, chunk = self.offsets[index], self.chunks[index]
+            if start + len(chunk) <= position:
+                continue
+            if start > position:
+                parts.append(self.omitted_marker(start - position))
+            parts.append(chunk[max(0, position - start):])
+            position = start + len(chunk)
+        if position < self.length:
+            parts.append(self.omitted_marker(self.length - position))
+        return ''.join(parts), self.length
+
+    def text(self):
+        return self.since(0)[0]
+
+def output_truncation(channel):
+    """Explicit truncation flag for a run's response, with where to page through the rest"""
+    fields = {'output_truncated': channel.output.truncated}
+    if channel.output.truncated or channel.errors.truncated:
+        fields['run_id'] = channel.run_id
+        fields['output_length'] = channel.output.length
+        if channel.errors.truncated:
+            fields['error_truncated'] = True
+        spools = [capture.spool for capture in (channel.output, channel.errors) if capture.spool is not None]
+        fields['output_spooled'] = bool(spools)
+        if any(spool.dropped for spool in spools):
+            fields['output_spool_full'] = True
+    return fields
+
+class ProcessChannel:
+    """Output and state of one child process, filled in by the multiplexer.
+
+    The child's stdout and stderr carry only user output. Prompts and
+    completion travel as newline-delimited JSON events on a separate control
+    pipe. Request threads block on `condition` instead of polling the pipes
+    and are woken the moment a prompt or the exit is seen. Subscribers
+    (streaming responses) get every event pushed to their own queue.
+    """
+
+    def __init__(self, process, interactive: bool = False, streams: dict = None):
+        self.process = process
+        self.interactive = interactive
+        self.streams = streams if streams is not None else {
+            name: stream for name, stream in (
+                ('stdout', process.stdout),
+                ('stderr', process.stderr),
+                ('control', getattr(process, 'control', None))
+            ) if stream is not None
+        }
+        self.decoders = {
+            name: codecs.getincrementaldecoder('utf-8')(errors='replace')
+            for name in ('stdout', 'stderr')
+        }
+        self.condition = threading.Condition()
+        self.run_id = new_run_id()
+        self.output = OutputCapture(self.run_id, 'stdout')
+        self.errors = OutputCapture(self.run_id, 'stderr')
+        self.prompt = 'Enter input: '
+        self.completion = None
+        self.cell_result = None  # last 'cell_done' event of a kernel
+        self.peak_rss_kb = None  # VmHWM the child reported, see resource_usage()
+        self.cell = None  # number of the kernel cell being run; None for workers
+        self.waiting_for_input = False
+        self.inputs_sent = 0
+        self.timed_out = False  # killed (or its kernel cell interrupted) by one of its budgets
+        self.timeout_reason = None  # which one: a RUN_TIME_LIMITS key
+        self.limits = RUN_TIME_LIMITS
+        self.budget = None  # RunBudget tracking the run (or the current kernel cell)
+        self.cancelled = False  # stopped through /execute/cancel
+        self.cgroup = None  # the run's cgroup (see RunCgroups)
+        self.multiplexer = None  # the ProcessMultiplexer reading its pipes
+        self.exited = False
+        self.returncode = None
+        self.subscribers = []
+        self.exit_callbacks = []
+        self.output_bytes = 0
+        self._control_buffer = b''
+        self._last_line = ''
+        self._open_outputs = {'stdout', 'stderr'} & set(self.streams)
+
+    def subscribe(self):
+        events = queue.Queue()
+        with self.condition:
+            self.subscribers.append(events)
+        return events
+
+    def _publish(self, event, payload):
+        for events in self.subscribers:
+            events.put((event, payload))
+
+    def read(self, name: str):
+        """Read whatever is ready on one pipe; returns False at EOF"""
+        try:
+            data = os.read(self.streams[name].fileno(), 65536)
+        except (OSError, ValueError):
+            data = b''
+
+        if name == 'control':
+            if data:
+                # Output written before the event must be delivered first
+                self._drain_outputs()
+                self._feed_control(data)
+            return bool(data)
+
+        self.output_bytes += len(data)
+        self.feed(name, self.decoders[name].decode(data, final=not data))
+        return bool(data)
+
+    def _drain_outputs(self):
+        if sys.platform == 'win32':
+            return  # no select() on pipes; ordering is best effort there
+        for name in ('stdout', 'stderr'):
+            if name not in self._open_outputs:
+                continue
+            fd = self.streams[name].fileno()
+            while select.select([fd], [], [], 0)[0]:
+                data = os.read(fd, 65536)
+                if not data:
+                    break  # EOF is picked up by the normal read path
+                self.output_bytes += len(data)
+                self.feed(name, self.decoders[name].decode(data))
+
+    def _feed_control(self, data: bytes):
+        self._control_buffer += data
+        *lines, self._control_buffer = self._control_buffer.split(b'\n')
+        for line in lines:
+            try:
+                self.handle_control(json.loads(line))
+            except ValueError:
+                print(f"[DEBUG] Ignoring malformed control frame: {line[:80]!r}")
+
+    def accepts(self, kind: str, event: dict):
+        """Whether a control event fits the state the run is in (caller holds the condition).
+
+        User code runs in the same interpreter as the bootstrap and can
+        always write to the control pipe, so events are checked against what
+        the server expects instead of being trusted: workers report
+        'complete' or 'error' once, kernels report 'cell_done' once for the
+        cell they were given, and prompts only count while code is running.
+        """
+        if self.exited:
+            return False
+        if kind == 'input_request':
+            if self.waiting_for_input:
+                return False
+            return self.cell is None or (self.cell > 0 and self.cell_result is None)
+        if kind in ('complete', 'error'):
+            return (self.cell is None and self.completion is None
+                    and (event.get('max_rss') is None or type(event.get('max_rss')) is int))
+        if kind == 'cell_done':
+            return (self.cell is not None and self.cell_result is None
+                    and event.get('cell') == self.cell and isinstance(event.get('ok'), bool)
+                    and (event.get('max_rss') is None or type(event.get('max_rss')) is int))
+        return False
+
+    def handle_control(self, event: dict):
+        with self.condition:
+            kind = event.get('event') if isinstance(event, dict) else None
+            if not self.accepts(kind, event):
+                print(f"[DEBUG] Ignoring unexpected control event {str(kind)[:40]!r} from run {self.run_id}")
+                return
+            if kind == 'input_request':
+                prompt = str(event.get('prompt') or '')[:1024]
+                self.prompt = prompt.strip() or self._last_line.strip() or 'Enter input: '
+                self.waiting_for_input = True
+                if self.budget:
+                    self.budget.prompt()
+                self._publish('input_request', self.prompt)
+                self.condition.notify_all()
+            elif kind in ('complete', 'error'):
+                self.completion = kind
+                self.peak_rss_kb = event.get('max_rss')
+            elif kind == 'cell_done':
+                self.cell_result = event
+                self.peak_rss_kb = event.get('max_rss')
+                self.waiting_for_input = False
+                if self.budget:
+                    self.budget.finish()
+                self._publish('cell_done', event)
+                self.condition.notify_all()
+
+    def _emit_output(self, text):
+        if text:
+            self.output.append(text)
+            self._last_line = (self._last_line + text).rsplit('\n', 1)[-1][-1024:]
+            self._publish('stdout', text)
+
+    def feed(self, name: str, text: str):
+        """Record newly read, decoded output"""
+        if not text:
+            return
+        with self.condition:
+            if name == 'stderr':
+                self.errors.append(text)
+                self._publish('stderr', text)
+            else:
+                self._emit_output(text)
+
+    def close_stream(self, name: str):
+        """Called once per pipe at EOF; the run is over when stdout and stderr are closed"""
+        try:
+            self.streams[name].close()
+        except:
+            pass
+        if name == 'control':
+            return
+        with self.condition:
+            self._open_outputs.discard(name)
+            if self._open_outputs:
+                return
+        self._outputs_closed()
+
+    def force_close(self):
+        """End the run even though processes that left its group still hold its pipes"""
+        if not self.exited and self.multiplexer is not None:
+            kill_strays(self.process)
+            self.multiplexer.detach(self)
+
+    def _outputs_closed(self):
+        if self.exited:
+            return  # force-closed earlier; the reader threads only caught up now
+        if self.process.poll() is not None:
+            self.mark_exited(self.process.returncode)
+        else:
+            # Pipes close a moment before the process can be reaped
+            threading.Thread(target=lambda: self.mark_exited(self.process.wait()), daemon=True).start()
+
+    def mark_exited(self, returncode):
+        with self.condition:
+            if self.budget:
+                self.budget.finish()
+            self.exited = True
+            self.returncode = returncode
+            self.waiting_for_input = False
+            self._publish('exit', returncode)
+            self.condition.notify_all()
+            callbacks, self.exit_callbacks = self.exit_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_exit(self, callback):
+        """Call `callback` once the child has exited (right away if it already has)"""
+        with self.condition:
+            if not self.exited:
+                self.exit_callbacks.append(callback)
+                return
+        callback()
+
+    def send_input(self, text: str):
+        with self.condition:
+            self.waiting_for_input = False
+            self.inputs_sent += 1
+            if self.budget:
+                self.budget.resume()
+        self.process.stdin.write(text + '\n')
+
+    def resume_token(self):
+        """Names this run and how many inputs it has had, so a stale /poll is refused"""
+        return f'{self.run_id}.{self.inputs_sent}'
+
+    def begin_cell(self, cell: int):
+        """Forget the previous kernel cell's output before cell number `cell` starts"""
+        with self.condition:
+            self.cell = cell
+            self.run_id = new_run_id()
+            self.output = OutputCapture(self.run_id, 'stdout')
+            self.errors = OutputCapture(self.run_id, 'stderr')
+            self.output_bytes = 0
+            self.cell_result = None
+            self.waiting_for_input = False
+            self.inputs_sent = 0
+            if self.budget:
+                self.budget.finish()
+            self.budget = None
+            self.timed_out = False
+            self.timeout_reason = None
+            self.cancelled = False
+            self._last_line = ''
+
+    def wait_for_prompt_or_exit(self, timeout=None):
+        """Returns 'input', 'exit', 'timeout' or, for kernels, 'done' at the end of a cell"""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.waiting_for_input or self.exited or self.cell_result is not None,
+                None if timeout is None else max(0, timeout)
+            )
+            if self.exited:
+                return 'exit'
+            if self.cell_result is not None:
+                return 'done'
+            return 'input' if self.waiting_for_input else 'timeout'
+
+    def wait_for_cell_end(self, timeout):
+        """Wait until the running kernel cell finishes or the kernel exits; returns 'done', 'exit' or 'timeout'"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.exited or self.cell_result is not None, max(0, timeout))
+            if self.exited:
+                return 'exit'
+            return 'done' if self.cell_result is not None else 'timeout'
+
+    def wait_for_exit(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.exited, timeout)
+
+    def output_text(self):
+        return self.output_since(0)[0]
+
+    def output_since(self, cursor: int):
+        """Stdout produced after character offset `cursor`, and the offset it ends at"""
+        with self.condition:
+            return self.output.since(cursor)
+
+    def stderr_text(self):
+        with self.condition:
+            return self.errors.text()
+
+def output_fields(channel, cursor: int = None):
+    """Response fields for an interactive run's stdout.
+
+    Without a cursor the whole output is returned (stripped, as before).
+    With one, only the text after that character offset comes back,
+    unstripped so the client can append it; `output_cursor` is the offset
+    to send next time either way.
+    """
+    if cursor is None:
+        text, end = channel.output_since(0)
+        return {'output': text.strip(), 'output_cursor': end, **output_truncation(channel)}
+    text, end = channel.output_since(cursor)
+    return {'output': text, 'output_offset': min(cursor, end), 'output_cursor': end, **output_truncation(channel)}
+
+def channel_response(channel, state: str, session_id: str, start_time: float, cursor: int = None):
+    """Build the /execute, /input or /poll response for an interactive run's state"""
+    if state == 'running':
+        # The long-poll wait ran out first; the client collects the rest with /poll
+        return {
+            'success': True,
+            **output_fields(channel, cursor),
+            'running': True,
+            'waiting_for_input': False,
+            'resume_token': channel.resume_token(),
+            'execution_time': round(time.time() - start_time, 3),
+            'session_id': session_id
+        }
+
+    if state == 'exit' and channel.timed_out:
+        state = 'timeout'
+
+    if state == 'input':
+        return {
+            'success': True,
+            **output_fields(channel, cursor),
+            'waiting_for_input': True,
+            'input_prompt': channel.prompt,
+            'session_id': session_id
+        }
+    
+    if state == 'exit' and channel.cancelled:
+        return {
+            'success': False,
+            **output_fields(channel, cursor),
+            'error': 'Run cancelled',
+            'cancelled': True,
+            'execution_time': round(time.time() - start_time, 3),
+            'session_id': session_id
+        }
+
+    if state == 'exit':
+        stderr = channel.stderr_text()
+        resources = resource_usage(channel.process, channel)
+        response = {
+            'success': channel.returncode == 0,
+            **output_fields(channel, cursor),
+            'error': stderr or signal_error(resources),
+            'execution_time': round(time.time() - start_time, 3),
+            'resources': resources,
+            'session_id': session_id
+        }
+        if resources and resources['cpu_limit_exceeded']:
+            # RLIMIT_CPU got there before the scheduler's CPU check did
+            response.update(timeout=True, timeout_reason='cpu_time')
+        return response
+    
+    return {
+        'success': False,
+        **output_fields(channel, cursor),
+        **timeout_fields(channel.timeout_reason or 'wall_time', channel.limits),
+        'execution_time': round(time.time() - start_time, 3),
+        'session_id': session_id
+    }
+
+class ProcessMultiplexer:
+    """Single I/O loop that owns the stdout, stderr and control pipes of every child.
+
+    One selector thread reads whatever is ready and hands it to the owning
+    ProcessChannel. Platforms without pipe support in select() (Windows)
+    fall back to a blocking reader thread per pipe feeding the same channel.
+    Where pidfds exist, each child's pidfd is watched too, so a child is
+    reaped (and its leftover process group killed) as soon as it exits,
+    not only once every holder of its pipes has let go. Processes that
+    left the group (setsid) can still hold the pipes; ORPHAN_PIPE_GRACE after
+    the leader is reaped the pipes are closed on them with detach().
+    """
+
+    def __init__(self, deadlines=None):
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.watched = 0
+        self.selector = None
+        self.deadlines = deadlines
+
+        if sys.platform != 'win32':
+            self.selector = selectors.DefaultSelector()
+            self._wake_r, self._wake_w = os.pipe()
+            os.set_blocking(self._wake_r, False)
+            os.set_blocking(self._wake_w, False)
+            self.selector.register(self._wake_r, selectors.EVENT_READ)
+            threading.Thread(target=self._loop, daemon=True).start()
+
+    def watch(self, process, interactive: bool = False):
+        """Start reading a child's pipes; returns its ProcessChannel"""
+        channel = ProcessChannel(process, interactive=interactive)
+        self.register(channel)
+        return channel
+
+    def register(self, channel):
+        channel.multiplexer = self
+        with self.lock:
+            self.watched += 1
+
+        if self.selector is None:
+            for name in channel.streams:
+                threading.Thread(target=self._read_blocking, args=(channel, name), daemon=True).start()
+            return
+
+        pidfd = None
+        if hasattr(os, 'pidfd_open') and isinstance(channel.process, AccountedPopen):
+            try:
+                pidfd = os.pidfd_open(channel.process.pid)
+            except OSError:
+                pass  # already reaped
+        elif isinstance(channel.process, ForkedProcess):
+            channel.process.on_reaped = lambda: self.leader_exited(channel)
+            if channel.process.exited.is_set():
+                self.leader_exited(channel)
+        with self.lock:
+            for name, stream in channel.streams.items():
+                self.pending.append((stream, channel, name))
+            if pidfd is not None:
+                self.pending.append((pidfd, channel, 'pidfd'))
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            pass  # a wakeup is already queued
+
+    def leader_exited(self, channel):
+        """The run's leader is reaped; whatever still holds its pipes gets ORPHAN_PIPE_GRACE to let go"""
+        if self.deadlines is not None and not channel.exited:
+            self.deadlines.schedule(ORPHAN_PIPE_GRACE, channel.force_close)
+
+    def detach(self, channel):
+        """Stop reading a channel and close its pipes, ending the run (any thread)"""
+        if self.selector is None:
+            # Reader threads cannot be interrupted; the run ends now and they finish on their own
+            channel.mark_exited(channel.process.poll())
+            return
+        with self.lock:
+            self.pending.append((None, channel, 'detach'))
+        self._wake()
+
+    def _detach(self, channel):
+        for name in list(channel._open_outputs) + ['control']:
+            stream = channel.streams.get(name)
+            try:
+                self.selector.unregister(stream)
+            except (KeyError, ValueError):
+                continue  # already at EOF
+            self._close(channel, name)
+
+    def _loop(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj == self._wake_r:
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    with self.lock:
+                        pending, self.pending = self.pending, deque()
+                    for stream, channel, name in pending:
+                        if name == 'detach':
+                            self._detach(channel)
+                        else:
+                            self.selector.register(stream, selectors.EVENT_READ, (channel, name))
+                    continue
+
+                channel, name = key.data
+                if name == 'pidfd':
+                    self.selector.unregister(key.fileobj)
+                    os.close(key.fileobj)
+                    channel.process.poll()  # reaps it; AccountedPopen kills what it left behind
+                    self.leader_exited(channel)
+                    continue
+                if not channel.read(name):
+                    self.selector.unregister(key.fileobj)
+                    self._close(channel, name)
+
+    def _read_blocking(self, channel, name):
+        while channel.read(name):
+            pass
+        self._close(channel, name)
+
+    def _close(self, channel, name):
+        if name == 'stderr':
+            with self.lock:
+                self.watched -= 1
+        channel.close_stream(name)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'mode': 'selector' if self.selector else 'threads',
+                'watched_processes': self.watched
+            }
+
+DEFAULT_INPUT_PROMPT = "Enter input: "
+
+# Fallback for code that does not parse: `var = input(...)` or `var = func(input(...))`
+INPUT_ASSIGNMENT_PATTERN = re.compile(r'(\w+)\s*=\s*(?:\w+\s*\(\s*)?input\s*\(\s*(["\'].*?["\'])?\s*\)')
+
+class InputAnalyzer(ast.NodeVisitor):
+    """One pass over the tree collecting input() calls and nondeterminism.
+
+    Each input() call is attributed to the name it is assigned to, taken
+    from the enclosing assignment node, so `n = int(input())` and
+    `a, b = input().split()` need no second look at the source text.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+        self.deterministic = True
+        self.targets = []
+
+    def visit_Import(self, node):
+        if any(alias.name.split('.')[0] in NONDETERMINISTIC_MODULES for alias in node.names):
+            self.deterministic = False
+
+    def visit_ImportFrom(self, node):
+        if (node.module or '').split('.')[0] in NONDETERMINISTIC_MODULES:
+            self.deterministic = False
+
+    def _visit_assignment(self, targets, value):
+        self.targets.append(targets)
+        if value is not None:
+            self.visit(value)
+        self.targets.pop()
+        for target in targets:
+            self.visit(target)
+
+    def visit_Assign(self, node):
+        self._visit_assignment(node.targets, node.value)
+
+    def visit_AnnAssign(self, node):
+        self._visit_assignment([node.target], node.value)
+
+    def visit_AugAssign(self, node):
+        self._visit_assignment([node.target], node.value)
+
+    def visit_NamedExpr(self, node):
+        self._visit_assignment([node.target], node.value)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name):
+            if node.func.id in NONDETERMINISTIC_CALLS:
+                self.deterministic = False
+            elif node.func.id == 'input':
+                self.count += 1
+                prompt = DEFAULT_INPUT_PROMPT
+                if node.args and isinstance(node.args[0], ast.Constant):
+                    prompt = node.args[0].value
+                self.statements.append({
+                    'variable': self._target_name() or f'input_{self.count}',
+                    'prompt': prompt,
+                    'line': node.lineno
+                })
+        self.generic_visit(node)
+
+    def _target_name(self):
+        """Name(s) the innermost enclosing assignment binds, if plain names"""
+        if not self.targets:
+            return None
+        target = self.targets[-1][0]
+        if isinstance(target, ast.Name):
+            return target.id
+        if isinstance(target, (ast.Tuple, ast.List)) and all(isinstance(elt, ast.Name) for elt in target.elts):
+            return ', '.join(elt.id for elt in target.elts)
+        return None
+
+def analyze_source(code: str):
+    """Input statements and determinism of a program (see InputAnalyzer)"""
+    try:
+        analyzer = InputAnalyzer()
+        analyzer.visit(ast.parse(code))
+        statements, deterministic = analyzer.statements, analyzer.deterministic
+    except (SyntaxError, ValueError, RecursionError):
+        # Unparseable code fails at run time anyway; this only feeds the session state
+        deterministic = False
+        statements = []
+        for variable, prompt in INPUT_ASSIGNMENT_PATTERN.findall(code):
+            statements.append({
+                'variable': variable,
+                'prompt': prompt.strip('\'"') if prompt else DEFAULT_INPUT_PROMPT,
+                'line': len(statements) + 1
+            })
+    return {
+        'count': len(statements),
+        'statements': statements,
+        'variables': [statement['variable'] for statement in statements],
+        'prompts': [statement['prompt'] for statement in statements],
+        'deterministic': deterministic
+    }
+
+class AnalysisCache:
+    """Bounded LRU of analyze_source() results keyed by a hash of the source.
+
+    Resubmitting the same program (the common case while a student fixes
+    input, or many students running the same exercise) skips the parse.
+    Cached results are shared, so callers must not modify them.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def analyze(self, code: str):
+        if self.max_entries <= 0:
+            return analyze_source(code)
+        key = hashlib.sha256(code.encode('utf-8', errors='surrogatepass')).digest()
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+        result = analyze_source(code)
+        with self.lock:
+            self.entries[key] = result
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+def format_syntax_error(error: SyntaxError):
+    """The error text the interpreter itself would print for a syntax error"""
+    return ''.join(traceback.format_exception_only(type(error), error))
+
+class CodeCache:
+    """LRU of compiled programs, keyed by hash(source, filename, interpreter).
+
+    Every submission is compiled here before anything is spawned: a syntax
+    error is answered straight away, and valid code is kept as a base64
+    marshalled code object that goes to the worker with the source, so the
+    child skips parsing and compiling. A hit saves the whole compile; the
+    time it originally took is what gets reported as saved.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.syntax_errors = 0
+        self.saved_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def key(self, source: str, filename: str):
+        digest = hashlib.sha256()
+        for part in (sys.version, filename, source):
+            digest.update(part.encode('utf-8', errors='surrogatepass'))
+            digest.update(b'\0')
+        return digest.digest()
+
+    def compile(self, source: str, filename: str = USER_CODE_FILENAME, record: bool = True):
+        """Return (marshalled code or None, info); raises SyntaxError for invalid code.
+
+        `record` counts the call in the hit/miss statistics; frame() passes
+        False so a run that was already pre-flighted is not counted twice.
+        """
+        key = self.key(source, filename)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                if record:
+                    self.hits += 1
+                    self.saved_seconds += entry[1]
+                return entry[0], {'cache': 'hit', 'compile_ms': 0.0, 'saved_ms': round(entry[1] * 1000, 3)}
+
+        started = time.perf_counter()
+        try:
+            code = compile(source, filename, 'exec', dont_inherit=True)
+        except (SyntaxError, ValueError) as e:
+            if record:
+                with self.lock:
+                    self.syntax_errors += 1
+            if isinstance(e, SyntaxError):
+                raise
+            raise SyntaxError(str(e)) from None  # e.g. null bytes in the source
+        payload = base64.b64encode(marshal.dumps(code)).decode('ascii') if self.enabled else None
+        elapsed = time.perf_counter() - started
+
+        with self.lock:
+            if record:
+                self.misses += 1
+            if payload is not None and len(payload) <= self.max_bytes and key not in self.entries:
+                self.entries[key] = (payload, elapsed)
+                self.size_bytes += len(payload)
+                while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                    _, (old_payload, _) = self.entries.popitem(last=False)
+                    self.size_bytes -= len(old_payload)
+        # On a miss the compile only moved from the child to the server
+        return payload, {'cache': 'miss', 'compile_ms': round(elapsed * 1000, 3), 'saved_ms': 0.0}
+
+    def frame(self, source: str, filename: str = USER_CODE_FILENAME):
+        """Worker frame for `source`, carrying its code object unless shipping is off or it does not compile"""
+        if not self.enabled:
+            return frame_source(source)
+        try:
+            payload, _ = self.compile(source, filename, record=False)
+        except SyntaxError:
+            return frame_source(source)  # the worker reports it like any other error
+        return frame_source(source, payload)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'bytes': self.size_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'syntax_errors': self.syntax_errors,
+                'saved_ms': round(self.saved_seconds * 1000, 3)
+            }
+
+class ResultCache:
+    """LRU cache of finished runs keyed by hash(code, stdin, interpreter).
+
+    Bounded by both entry count and stored bytes. Identical requests that
+    arrive while the first one is still running wait for it instead of
+    spawning their own process ("singleflight").
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def key(self, code: str, stdin: str = ''):
+        digest = hashlib.sha256()
+        for part in (sys.version, code, stdin):
+            digest.update(part.encode('utf-8', errors='surrogatepass'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def run(self, key: str, compute):
+        """Return (result, 'hit'|'miss'|'coalesced'), running compute() at most once per key"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dict(self.entries[key][0]), 'hit'
+
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = {'done': threading.Event(), 'result': None, 'waiters': []}
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight['done'].wait()
+            if flight['result'] is not None:
+                return dict(flight['result']), 'coalesced'
+            # The leader failed; run on our own rather than sharing the failure
+            return compute(), 'miss'
+
+        result = None
+        try:
+            result = compute()
+            return result, 'miss'
+        finally:
+            self._land(key, flight, result)
+
+    async def run_async(self, key: str, compute):
+        """run() for the event loop: `compute` is a coroutine function and followers await the leader"""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dict(self.entries[key][0]), 'hit'
+
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = {'done': threading.Event(), 'result': None, 'waiters': []}
+                self.misses += 1
+            else:
+                self.coalesced += 1
+                landed = loop.create_future()
+                flight['waiters'].append(lambda: loop.call_soon_threadsafe(lambda: landed.done() or landed.set_result(None)))
+
+        if not leader:
+            await landed
+            if flight['result'] is not None:
+                return dict(flight['result']), 'coalesced'
+            return await compute(), 'miss'
+
+        result = None
+        try:
+            result = await compute()
+            return result, 'miss'
+        finally:
+            self._land(key, flight, result)
+
+    def _land(self, key: str, flight: dict, result):
+        """Publish the leader's result to the cache and to everyone waiting on it"""
+        with self.lock:
+            self.inflight.pop(key, None)
+            if result is not None and self.is_cacheable(result):
+                self._store(key, result)
+            flight['result'] = result
+            waiters, flight['waiters'] = flight['waiters'], []
+        flight['done'].set()
+        for wake in waiters:
+            wake()
+
+    def is_cacheable(self, result: dict):
+        """Only keep results that depend on nothing but the program itself"""
+        if result.get('timeout') or result.get('waiting_for_input') or result.get('cancelled') or result.get('run_id'):
+            return False  # a run_id points at a spool that expires
+        if (result.get('resources') or {}).get('exit_signal'):
+            return False
+        error = result.get('error') or ''
+        return not error.startswith(('Execution error:', 'Server error:'))
+
+    def _store(self, key: str, result: dict):
+        size = len(result.get('output') or '') + len(result.get('error') or '')
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (dict(result), size)
+        self.size_bytes += size
+        while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size_bytes -= evicted_size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self.entries),
+                'bytes': self.size_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'inflight': len(self.inflight)
+            }
+
+class AdmissionRejected(Exception):
+    """Raised when the job queue cannot take another run; carries a Retry-After hint"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionTicket:
+    """One admitted (or waiting) run; release() frees its slot exactly once"""
+
+    def __init__(self, admission, client: str, session_id: str):
+        self.admission = admission
+        self.client = client
+        self.session_id = session_id
+        self.enqueued_at = time.time()
+        self.granted_at = None
+        self.released = False
+        self.on_grant = None  # called under the queue lock when a slot is granted
+
+    @property
+    def queue_wait(self):
+        return (self.granted_at or time.time()) - self.enqueued_at
+
+    def release(self):
+        self.admission.release(self)
+
+class AdmissionQueue:
+    """Bounded job queue in front of the executor.
+
+    At most `max_running` children are alive at once; everything else waits
+    in a queue of at most `max_queued` entries and is shed with
+    AdmissionRejected (429) beyond that or after `queue_timeout` seconds.
+    Waiting runs are granted round-robin across clients, and a client or
+    session may not hold more than its share of running slots, so one busy
+    client cannot starve the rest. A slot is held until the child exits.
+    """
+
+    def __init__(self, max_running: int, max_queued: int, max_per_client: int,
+                 max_queued_per_client: int, max_per_session: int, queue_timeout: float):
+        self.max_running = max(1, max_running)
+        self.max_queued = max(0, max_queued)
+        self.max_per_client = max(1, max_per_client)
+        self.max_queued_per_client = max(0, max_queued_per_client)
+        self.max_per_session = max(1, max_per_session)
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.waiting = OrderedDict()  # client -> deque of tickets, in round-robin order
+        self.queued = 0
+        self.running = 0
+        self.running_by_client = {}
+        self.running_by_session = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.total_queue_wait = 0.0
+        self.avg_hold = 1.0  # moving average of how long a slot is held
+
+    def acquire(self, client: str, session_id: str = None, timeout: float = None):
+        """Wait for a running slot; returns an AdmissionTicket or raises AdmissionRejected"""
+        ticket = AdmissionTicket(self, client or 'unknown', session_id)
+        timeout = self.queue_timeout if timeout is None else timeout
+
+        with self.condition:
+            self._enqueue(ticket)
+            if not self.condition.wait_for(lambda: ticket.granted_at is not None, timeout):
+                self._remove_waiting(ticket)
+                self.rejected += 1
+                raise AdmissionRejected(f'Server is busy, no execution slot within {timeout:g}s', self.retry_after())
+
+            self.admitted += 1
+            self.total_queue_wait += ticket.queue_wait
+            return ticket
+
+    async def acquire_async(self, client: str, session_id: str = None, timeout: float = None):
+        """acquire() for the event loop: a queued run waits on a future, not a blocked thread"""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        ticket = AdmissionTicket(self, client or 'unknown', session_id)
+        ticket.on_grant = lambda: loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+        timeout = self.queue_timeout if timeout is None else timeout
+
+        with self.condition:
+            self._enqueue(ticket)
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), timeout)
+        except BaseException as e:
+            with self.condition:
+                if ticket.granted_at is None:
+                    self._remove_waiting(ticket)
+                    if isinstance(e, asyncio.TimeoutError):
+                        self.rejected += 1
+                        raise AdmissionRejected(f'Server is busy, no execution slot within {timeout:g}s', self.retry_after())
+                    raise
+            if not isinstance(e, asyncio.TimeoutError):
+                ticket.release()  # granted just as the request went away
+                raise
+
+        with self.condition:
+            self.admitted += 1
+            self.total_queue_wait += ticket.queue_wait
+        return ticket
+
+    def _enqueue(self, ticket: AdmissionTicket):
+        """Queue a ticket or shed it when the queue is full (caller holds the lock)"""
+        client_queue = self.waiting.get(ticket.client)
+        if self.queued >= self.max_queued or (client_queue and len(client_queue) >= self.max_queued_per_client):
+            self.rejected += 1
+            raise AdmissionRejected('Server is busy, execution queue is full', self.retry_after())
+
+        self.waiting.setdefault(ticket.client, deque()).append(ticket)
+        self.queued += 1
+        self._dispatch()
+
+    def release(self, ticket: AdmissionTicket):
+        with self.condition:
+            if ticket.released or ticket.granted_at is None:
+                return
+            ticket.released = True
+            self.running -= 1
+            self._count(self.running_by_client, ticket.client, -1)
+            self._count(self.running_by_session, ticket.session_id, -1)
+            self.avg_hold = 0.9 * self.avg_hold + 0.1 * (time.time() - ticket.granted_at)
+            self._dispatch()
+
+    def _count(self, counts: dict, key, delta: int):
+        if key is None:
+            return
+        counts[key] = counts.get(key, 0) + delta
+        if counts[key] <= 0:
+            del counts[key]
+
+    def _remove_waiting(self, ticket: AdmissionTicket):
+        client_queue = self.waiting.get(ticket.client)
+        if client_queue and ticket in client_queue:
+            client_queue.remove(ticket)
+            self.queued -= 1
+            if not client_queue:
+                del self.waiting[ticket.client]
+
+    def _dispatch(self):
+        """Grant free slots round-robin across clients (caller holds the lock)"""
+        granted = False
+        progress = True
+        while progress and self.running < self.max_running:
+            progress = False
+            for client in list(self.waiting):
+                if self.running >= self.max_running:
+                    break
+                if self.running_by_client.get(client, 0) >= self.max_per_client:
+                    continue
+                ticket = next((waiting for waiting in self.waiting[client]
+                               if waiting.session_id is None
+                               or self.running_by_session.get(waiting.session_id, 0) < self.max_per_session), None)
+                if ticket is None:
+                    continue
+
+                self._remove_waiting(ticket)
+                ticket.granted_at = time.time()
+                self.running += 1
+                self._count(self.running_by_client, client, 1)
+                self._count(self.running_by_session, ticket.session_id, 1)
+                if ticket.on_grant:
+                    ticket.on_grant()
+                if client in self.waiting:
+                    self.waiting.move_to_end(client)
+                granted = progress = True
+        if granted:
+            self.condition.notify_all()
+
+    def retry_after(self):
+        """Seconds until a slot is likely free, from the queue depth and average hold time"""
+        waves = (self.queued + 1) / self.max_running
+        return max(1, int(waves * self.avg_hold + 0.999))
+
+    def stats(self):
+        with self.condition:
+            return {
+                'running': self.running,
+                'queued': self.queued,
+                'max_running': self.max_running,
+                'max_queued': self.max_queued,
+                'max_per_client': self.max_per_client,
+                'max_per_session': self.max_per_session,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'avg_queue_wait_ms': round(self.total_queue_wait / self.admitted * 1000, 3) if self.admitted else None,
+                'avg_slot_hold_ms': round(self.avg_hold * 1000, 3)
+            }
+
+# Histogram buckets (upper bounds) used by the /metrics endpoint
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (0, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name -> (type, help text, histogram buckets)
+METRIC_DEFINITIONS = {
+    'pyidle_spawn_seconds': ('histogram', 'Time to get a ready worker interpreter', LATENCY_BUCKETS),
+    'pyidle_queue_wait_seconds': ('histogram', 'Time a run waited for an execution slot', LATENCY_BUCKETS),
+    'pyidle_execution_seconds': ('histogram', 'Wall time from run start to child exit', LATENCY_BUCKETS),
+    'pyidle_input_roundtrip_seconds': ('histogram', 'Time from sending input to the next prompt or exit', LATENCY_BUCKETS),
+    'pyidle_polls_total': ('counter', 'Requests to /poll for runs answered with a resume token', None),
+    'pyidle_output_bytes': ('histogram', 'Stdout plus stderr bytes produced per run', BYTES_BUCKETS),
+    'pyidle_runs_total': ('counter', 'Finished runs by outcome', None),
+    'pyidle_output_truncated_total': ('counter', 'Runs whose output passed the in-memory cap', None),
+    'pyidle_timeouts_total': ('counter', 'Runs stopped by their wall-time, CPU-time or input-idle budget', None),
+    'pyidle_reclaim_seconds': ('histogram', "Time from killing a run's process group until it was reaped and its pipes closed", LATENCY_BUCKETS),
+    'pyidle_cleanup_failures_total': ('counter', 'Errors while tearing down a run', None),
+    'pyidle_session_evictions_total': ('counter', 'Sessions dropped because the registry was full', None),
+    'pyidle_reaped_sessions_total': ('counter', 'Sessions dropped by the reaper after the TTL', None),
+    'pyidle_reaped_processes_total': ('counter', 'Programs killed by the reaper while idle at an input prompt', None),
+    'pyidle_reaper_seconds': ('histogram', 'Duration of one reaper pass', LATENCY_BUCKETS),
+    'pyidle_compile_seconds': ('histogram', 'In-server compile time of submissions not in the code cache', LATENCY_BUCKETS),
+    'pyidle_compile_saved_seconds_total': ('counter', 'Compile time skipped thanks to code cache hits', None),
+    'pyidle_syntax_errors_total': ('counter', 'Submissions rejected by the pre-flight compile without spawning', None),
+    'pyidle_kernel_starts_total': ('counter', 'Kernel interpreters started', None),
+    'pyidle_kernel_shutdowns_total': ('counter', 'Kernel interpreters stopped, by reason', None)
+}
+
+class Metrics:
+    """Counters and histograms for /metrics, sharded per thread.
+
+    Each thread updates only its own shard under the shard's own lock,
+    which only a scrape ever contends for, so the hot path is a
+    thread-local lookup, an uncontended lock and a dict update. A scrape
+    copies each shard while holding its lock, so it never sees a histogram
+    half updated. The registry lock is taken once per thread to register
+    its shard and at scrape time. When a thread ends, its thread-local
+    handle is freed and a finalizer folds the shard into `retired`, so
+    short-lived threads do not pile up shards between scrapes.
+    """
+
+    class _Handle:
+        """Thread-local owner of one shard; its finalizer retires the shard"""
+        __slots__ = ('shard', 'lock', '__weakref__')
+
+    def __init__(self, definitions: dict):
+        self.definitions = definitions
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = {}  # id -> shard of a live thread
+        self.retired = {}
+        self._ids = itertools.count()
+
+    def _handle(self):
+        handle = getattr(self.local, 'handle', None)
+        if handle is None:
+            handle = self.local.handle = self._Handle()
+            handle.shard = {}
+            handle.lock = threading.Lock()
+            shard_id = next(self._ids)
+            with self.lock:
+                self.shards[shard_id] = (handle.lock, handle.shard)
+            weakref.finalize(handle, self._retire, shard_id)
+        return handle
+
+    def _retire(self, shard_id: int):
+        with self.lock:
+            entry = self.shards.pop(shard_id, None)
+            if entry:
+                self._merge(self.retired, entry[1])
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        handle = self._handle()
+        key = (name, tuple(sorted(labels.items())))
+        with handle.lock:
+            handle.shard[key] = handle.shard.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        handle = self._handle()
+        key = (name, tuple(sorted(labels.items())))
+        bounds = self.definitions[name][2]
+        with handle.lock:
+            histogram = handle.shard.get(key)
+            if histogram is None:
+                histogram = handle.shard[key] = [[0] * len(bounds), 0.0, 0]
+            buckets = histogram[0]
+            for index, bound in enumerate(bounds):
+                if value <= bound:
+                    buckets[index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _merge(target: dict, shard: dict):
+        for key, value in shard.items():
+            if isinstance(value, list):
+                merged = target.setdefault(key, [[0] * len(value[0]), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], value[0])]
+                merged[1] += value[1]
+                merged[2] += value[2]
+            else:
+                target[key] = target.get(key, 0) + value
+
+    def snapshot(self):
+        """Merge every shard into one {(name, labels): value} dict"""
+        merged = {}
+        with self.lock:
+            self._merge(merged, self.retired)
+            shards = list(self.shards.values())
+        # One lock at a time: a shard retired meanwhile is only in `retired` from now on
+        for lock, shard in shards:
+            with lock:
+                self._merge(merged, shard)
+        return merged
+
+    def render(self, gauges: dict):
+        """Prometheus text exposition of all metrics plus the given gauges"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, (kind, help_text, bounds) in self.definitions.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (metric, labels), value in sorted(snapshot.items()):
+                if metric != name:
+                    continue
+                if kind == 'counter':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(bounds, value[0]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", repr(float(bound))),))} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {value[2]}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value[1]}')
+                lines.append(f'{name}_count{format_labels(labels)} {value[2]}')
+        for name, (help_text, value) in gauges.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels: tuple):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+class Kernel:
+    """One session's long-lived interpreter; its cells run one at a time"""
+
+    def __init__(self, session_id: str, process, channel):
+        self.session_id = session_id
+        self.process = process
+        self.channel = channel
+        self.started = time.time()
+        self.last_used = self.started
+        self.cells = 0
+        self.busy = False
+        self.ticket = None
+
+    @property
+    def alive(self):
+        # The channel's wait thread reaps the child; polling here would race it
+        return not self.channel.exited
+
+    def peak_rss_kb(self):
+        """The kernel's own peak RSS since it started, as reported with the last finished cell"""
+        return self.channel.peak_rss_kb
+
+    def finish_cell(self):
+        """Mark the running cell over and give back its execution slot"""
+        self.busy = False
+        self.last_used = time.time()
+        ticket, self.ticket = self.ticket, None
+        if ticket:
+            ticket.release()
+
+class KernelManager:
+    """Persistent per-session interpreters for kernel mode.
+
+    A kernel runs KERNEL_BOOTSTRAP: it keeps one globals dict alive and runs
+    every code frame it receives as a new cell against it, so variables,
+    imports and functions survive between runs. Kernels are capped in
+    number (the least recently used idle one makes room), restarted when
+    their peak RSS passes the limit and shut down after sitting idle.
+    """
+
+    def __init__(self, multiplexer, metrics, max_kernels: int, idle_timeout: float, max_rss_mb: int):
+        self.multiplexer = multiplexer
+        self.metrics = metrics
+        self.max_kernels = max_kernels
+        self.idle_timeout = idle_timeout
+        self.max_rss_kb = max_rss_mb * 1024
+        self.lock = threading.Lock()
+        self.kernels = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.max_kernels > 0
+
+    def get(self, session_id: str):
+        """The session's kernel if it is still alive"""
+        with self.lock:
+            kernel = self.kernels.get(session_id)
+        if kernel is not None and not kernel.alive:
+            self.shutdown(session_id, 'exited')
+            return None
+        return kernel
+
+    def acquire(self, session_id: str):
+        """Return (kernel, started) for the session, starting a kernel if it has none"""
+        kernel = self.get(session_id)
+        if kernel is not None:
+            with self.lock:
+                self.kernels.move_to_end(session_id)
+            return kernel, False
+
+        with self.lock:
+            if len(self.kernels) >= self.max_kernels:
+                victim = next((k for k in self.kernels.values() if not k.busy), None)
+                if victim is None:
+                    raise RuntimeError(f'All {self.max_kernels} kernels are busy')
+            else:
+                victim = None
+        if victim is not None:
+            self.shutdown(victim.session_id, 'evicted')
+
+        process = start_worker(KERNEL_BOOTSTRAP)
+        channel = self.multiplexer.watch(process, interactive=True)
+        channel.cell = 0  # a kernel: only 'cell_done' events end its cells
+        kernel = Kernel(session_id, process, channel)
+        channel.on_exit(kernel.finish_cell)
+        with self.lock:
+            previous = self.kernels.pop(session_id, None)
+            self.kernels[session_id] = kernel
+        if previous is not None:
+            self._stop(previous)
+        self.metrics.inc('pyidle_kernel_starts_total')
+        print(f"[DEBUG] Started kernel for session {session_id} (pid {process.pid})")
+        return kernel, True
+
+    def shutdown(self, session_id: str, reason: str):
+        """Stop and forget the session's kernel; returns whether it had one"""
+        with self.lock:
+            kernel = self.kernels.pop(session_id, None)
+        if kernel is None:
+            return False
+        self._stop(kernel)
+        self.metrics.inc('pyidle_kernel_shutdowns_total', reason=reason)
+        print(f"[DEBUG] Stopped kernel for session {session_id} ({reason})")
+        return True
+
+    def _stop(self, kernel: Kernel):
+        try:
+            kernel.process.stdin.close()  # an idle kernel exits on EOF
+        except:
+            pass
+        if not kernel.channel.wait_for_exit(0 if kernel.busy else 1):
+            terminate_run(kernel.process, 'kernel', kernel.channel)
+        kernel.finish_cell()
+
+    def interrupt(self, kernel: Kernel):
+        """Raise KeyboardInterrupt in the running cell; returns False if nothing was running"""
+        if not kernel.busy or not kernel.alive:
+            return False
+        if sys.platform == 'win32':
+            # No SIGINT for a child without a console: restarting is the only way out
+            self.shutdown(kernel.session_id, 'interrupted')
+            return True
+        try:
+            kernel.process.send_signal(signal.SIGINT)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def cancel_cell(self, kernel: Kernel, grace: float = 2.0):
+        """Interrupt the running cell and wait for it to end, restarting the kernel if it will not"""
+        if not self.interrupt(kernel):
+            return
+        if kernel.channel.wait_for_cell_end(grace) == 'done':
+            kernel.finish_cell()
+        else:
+            self.shutdown(kernel.session_id, 'unresponsive')
+
+    def reap(self):
+        """Shut down kernels idle for longer than the idle timeout"""
+        cutoff = time.time() - self.idle_timeout
+        with self.lock:
+            idle = [k.session_id for k in self.kernels.values() if not k.busy and k.last_used < cutoff]
+        for session_id in idle:
+            self.shutdown(session_id, 'idle')
+        return len(idle)
+
+    def stats(self):
+        with self.lock:
+            kernels = list(self.kernels.values())
+        return {
+            'enabled': self.enabled,
+            'kernels': len(kernels),
+            'busy': sum(1 for k in kernels if k.busy),
+            'max_kernels': self.max_kernels,
+            'idle_timeout': self.idle_timeout,
+            'max_rss_mb': self.max_rss_kb // 1024
+        }
+
+class Deadline:
+    """One pending callback of the DeadlineScheduler"""
+
+    __slots__ = ('when', 'callback', 'cancelled')
+
+    def __init__(self, when: float, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+class DeadlineScheduler:
+    """Every run's deadlines in one heap, fired by a single thread.
+
+    The thread sleeps until the earliest deadline (or until an earlier one
+    is added), so thousands of pending deadlines cost nothing until they
+    are due. Cancelling only marks an entry; marked entries are dropped
+    when they reach the top, or all at once when they make up most of the
+    heap. Callbacks run on the scheduler thread and must not block.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count()  # tie-breaker, Deadline objects do not compare
+        self.condition = threading.Condition()
+        self.cancelled = 0
+        self.fired = 0
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def schedule(self, delay: float, callback):
+        """Call `callback` in `delay` seconds; returns the Deadline to cancel"""
+        deadline = Deadline(time.monotonic() + max(0, delay), callback)
+        with self.condition:
+            heapq.heappush(self.heap, (deadline.when, next(self.sequence), deadline))
+            if self.heap[0][2] is deadline:
+                self.condition.notify()
+        return deadline
+
+    def cancel(self, deadline: Deadline):
+        with self.condition:
+            if deadline.cancelled:
+                return
+            deadline.cancelled = True
+            self.cancelled += 1
+            if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def _next_due(self):
+        """Pop the next deadline once it is due (condition held)"""
+        while True:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+                self.cancelled -= 1
+            if not self.heap:
+                self.condition.wait()
+                continue
+            delay = self.heap[0][0] - time.monotonic()
+            if delay <= 0:
+                deadline = heapq.heappop(self.heap)[2]
+                deadline.cancelled = True  # fired: a late cancel() is a no-op
+                self.fired += 1
+                return deadline
+            self.condition.wait(delay)
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                deadline = self._next_due()
+            try:
+                deadline.callback()
+            except Exception as e:
+                print(f"[DEBUG] Deadline callback failed: {e}")
+
+    def stats(self):
+        with self.condition:
+            return {'pending': len(self.heap) - self.cancelled, 'fired': self.fired}
+
+class RunBudget:
+    """Wall-time, CPU-time and input-idle budgets of one run (or kernel cell).
+
+    Wall time runs only while the program does: it is paused at every
+    input() prompt, where the input-idle budget runs instead. CPU time can
+    never outrun wall time, so the CPU check is first scheduled for when
+    the budget could be spent at the earliest, then re-armed for whatever
+    is left; a program that sleeps or waits costs no extra checks. Where
+    /proc is missing only RLIMIT_CPU enforces CPU time. `on_expire(reason)`
+    is called once, from the scheduler thread, when a budget runs out.
+    """
+
+    def __init__(self, scheduler: DeadlineScheduler, limits: dict, process, on_expire, interactive: bool = True):
+        self.scheduler = scheduler
+        self.limits = limits
+        self.process = process
+        self.on_expire = on_expire
+        self.interactive = interactive
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.wall_used = 0.0
+        self.running_since = time.monotonic()
+        self.cpu_base = process_cpu_seconds(process.pid)
+        self.finished = False
+        with self.lock:
+            self._arm('wall_time', limits['wall_time'])
+            self._arm_cpu()
+
+    def _arm(self, reason: str, delay: float):
+        """Schedule the `reason` budget (lock held); a budget of 0 is never armed"""
+        if self.limits[reason]:
+            self.timers[reason] = self.scheduler.schedule(delay, lambda: self._fire(reason))
+
+    def _arm_cpu(self):
+        if self.cpu_base is None:
+            return
+        used = self.cpu_used()
+        if used is not None:
+            self._arm('cpu_time', self.limits['cpu_time'] - used)
+
+    def _disarm(self, *reasons):
+        for reason in reasons:
+            timer = self.timers.pop(reason, None)
+            if timer is not None:
+                self.scheduler.cancel(timer)
+
+    def cpu_used(self):
+        seconds = process_cpu_seconds(self.process.pid)
+        return None if seconds is None or self.cpu_base is None else seconds - self.cpu_base
+
+    def prompt(self):
+        """The program is waiting for a human: stop its clocks, start the idle one"""
+        if not self.interactive:
+            return  # prompts of a run fed from stdin are answered from the pipe
+        with self.lock:
+            if self.finished or self.running_since is None:
+                return
+            self.wall_used += time.monotonic() - self.running_since
+            self.running_since = None
+            self._disarm('wall_time', 'cpu_time')
+            self._arm('input_idle', self.limits['input_idle'])
+
+    def resume(self):
+        """Input was sent: the program runs on the rest of its budgets"""
+        with self.lock:
+            if self.finished or self.running_since is not None:
+                return
+            self.running_since = time.monotonic()
+            self._disarm('input_idle')
+            self._arm('wall_time', self.limits['wall_time'] - self.wall_used)
+            self._arm_cpu()
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+            self._disarm(*list(self.timers))
+
+    def _fire(self, reason: str):
+        with self.lock:
+            if self.finished:
+                return
+            self.timers.pop(reason, None)
+            if reason == 'cpu_time':
+                used = self.cpu_used()
+                if used is None:
+                    return  # the child is already gone
+                if used < self.limits['cpu_time']:
+                    self._arm('cpu_time', self.limits['cpu_time'] - used)
+                    return
+            self.finished = True
+            self._disarm(*list(self.timers))
+        self.on_expire(reason)
+
+class UnifiedCodeExecutor:
+    def __init__(self):
+        self.engine = EXECUTION_ENGINE
+        if self.engine == 'forkserver' and not hasattr(os, 'fork'):
+            print("[DEBUG] Fork server engine needs os.fork, falling back to subprocess")
+            self.engine = 'subprocess'
+
+        self.fork_server = ForkServer(FORKSERVER_PRELOAD) if self.engine == 'forkserver' else None
+        self.pool = WarmInterpreterPool(POOL_SIZE if self.engine == 'subprocess' else 0, POOL_MIN_IDLE, POOL_MAX_IDLE)
+        self.result_cache = ResultCache(RESULT_CACHE_ENTRIES, RESULT_CACHE_BYTES)
+        self.analysis_cache = AnalysisCache(ANALYSIS_CACHE_ENTRIES)
+        self.code_cache = CodeCache(CODE_CACHE_ENTRIES, CODE_CACHE_BYTES)
+        self.deadlines = DeadlineScheduler()
+        self.multiplexer = ProcessMultiplexer(self.deadlines)
+        self.metrics = Metrics(METRIC_DEFINITIONS)
+        self.kernels = KernelManager(self.multiplexer, self.metrics, MAX_KERNELS, KERNEL_IDLE_TIMEOUT, KERNEL_MAX_RSS_MB)
+        threading.Thread(target=self._reap_sessions_loop, daemon=True).start()
+        self.admission = AdmissionQueue(
+            MAX_RUNNING, MAX_QUEUED, MAX_RUNNING_PER_CLIENT,
+            MAX_QUEUED_PER_CLIENT, MAX_RUNNING_PER_SESSION, QUEUE_TIMEOUT
+        )
+        self.stream_lock = threading.Lock()
+        self.stream_stats = {'runs': 0, 'ttfb_total': 0.0, 'ttfb_count': 0, 'last_ttfb': None}
+        # Batch jobs are driven by threads, the work itself runs in the child
+        # processes; one shared pool caps batch parallelism at the core count
+        self.batch_workers = max(1, BATCH_WORKERS)
+        self.batch_pool = ThreadPoolExecutor(max_workers=self.batch_workers, thread_name_prefix='batch')
+
+    def acquire_worker(self, path: str = 'simple'):
+        """Get a ready worker interpreter from the configured engine"""
+        started = time.perf_counter()
+        if self.fork_server:
+            worker = self.fork_server.spawn()
+        elif self.pool.enabled:
+            worker = self.pool.acquire()
+        else:
+            worker = start_worker()
+        self.metrics.observe('pyidle_spawn_seconds', time.perf_counter() - started, path=path)
+        return worker
+
+    def track_run(self, channel, path: str, start_time: float):
+        """Record execution time, output size and outcome once the child exits"""
+        def finished():
+            self.metrics.observe('pyidle_execution_seconds', time.time() - start_time, path=path)
+            self.metrics.observe('pyidle_output_bytes', channel.output_bytes, path=path)
+            if channel.output.truncated or channel.errors.truncated:
+                self.metrics.inc('pyidle_output_truncated_total', path=path)
+            self.metrics.inc('pyidle_runs_total', path=path, outcome='success' if channel.returncode == 0 else 'error')
+        channel.on_exit(finished)
+
+    def start_budget(self, channel, path: str, limits: dict = None, kernel=None):
+        """Arm the run's wall-time, CPU-time and input-idle budgets on the deadline scheduler.
+
+        A run (or kernel) seen for the first time is also moved into its own
+        capped cgroup, before its code is sent.
+        """
+        if channel.cgroup is None and run_cgroups.enabled:
+            channel.cgroup = run_cgroups.attach(channel.process.pid)
+            if channel.cgroup:
+                channel.on_exit(lambda: run_cgroups.release(channel.cgroup))
+        channel.limits = limits or RUN_TIME_LIMITS
+        budget = RunBudget(
+            self.deadlines, channel.limits, channel.process,
+            lambda reason: self.expire_run(channel, reason, path, kernel),
+            interactive=channel.interactive or kernel is not None
+        )
+        with channel.condition:
+            channel.budget = budget
+            if channel.exited:
+                budget.finish()
+
+    def expire_run(self, channel, reason: str, path: str, kernel=None):
+        """A budget ran out (scheduler thread): stop the run without blocking.
+
+        Whoever is waiting on the channel sees the exit, or the end of the
+        kernel cell, and reports it with channel.timeout_reason.
+        """
+        print(f"[DEBUG] Run {channel.run_id} exceeded its {reason} budget")
+        channel.timeout_reason = reason
+        channel.timed_out = True
+        self.metrics.inc('pyidle_timeouts_total', path=path, reason=reason)
+        if kernel is not None:
+            # KeyboardInterrupt keeps the kernel's state; one that ignores it is killed
+            if self.kernels.interrupt(kernel):
+                cell = kernel.cells
+                self.deadlines.schedule(2.0, lambda: (
+                    kernel.cells == cell and kernel.channel.cell_result is None and kill_run(kernel.process)))
+            return
+        killed_at = time.perf_counter()
+        channel.on_exit(lambda: self.metrics.observe(
+            'pyidle_reclaim_seconds', time.perf_counter() - killed_at,
+            reason='idle' if reason == 'input_idle' else 'timeout'))
+        if not kill_run(channel.process):
+            # The leader is already reaped; only something outside its group holds the pipes
+            channel.force_close()
+            return
+        # Whatever left the group and keeps the pipes open is cut off after the grace period
+        self.deadlines.schedule(ORPHAN_PIPE_GRACE, channel.force_close)
+
+    def engine_details(self, process):
+        """Per-run engine measurements merged into execution results"""
+        details = {'engine': self.engine}
+        fork_latency = getattr(process, 'fork_latency', None)
+        if fork_latency is not None:
+            details['fork_latency_ms'] = round(fork_latency * 1000, 3)
+        resources = getattr(process, 'resources', None)
+        if resources is not None:
+            details['resources'] = resources
+        return details
+
+    def preflight(self, code: str, filename: str = USER_CODE_FILENAME):
+        """Compile in-server before anything is spawned; raises SyntaxError, returns the compile info"""
+        try:
+            _, info = self.code_cache.compile(code, filename)
+        except SyntaxError:
+            self.metrics.inc('pyidle_syntax_errors_total')
+            raise
+        if info['cache'] == 'hit':
+            self.metrics.inc('pyidle_compile_saved_seconds_total', info['saved_ms'] / 1000)
+        else:
+            self.metrics.observe('pyidle_compile_seconds', info['compile_ms'] / 1000)
+        return info
+
+    def syntax_error_response(self, error: SyntaxError, session_id: str, start_time: float):
+        """Result for code that does not compile; no worker was started for it"""
+        return {
+            'success': False,
+            'output': '',
+            'error': format_syntax_error(error),
+            'syntax_error': True,
+            'execution_time': round(time.time() - start_time, 3),
+            'session_id': session_id
+        }
+
+    def execute_code(self, code: str, session_id: str, stdin: str = None, client: str = None, kernel: bool = False, wait: float = None, limits: dict = None):
+        """Compile, wait for an execution slot, then run the code; interactive runs answer within `wait` seconds when given.
+
+        `limits` are the run's budgets (RUN_TIME_LIMITS when not given).
+        """
+        start_time = time.time()
+        try:
+            if kernel:
+                # Cells are compiled by the kernel itself, under their cell name
+                current = self.kernels.get(session_id)
+                compile(code, f'<cell {current.cells + 1 if current else 1}>', 'exec', dont_inherit=True)
+                compiled = None
+            else:
+                compiled = self.preflight(code)
+        except (SyntaxError, ValueError) as e:
+            if not isinstance(e, SyntaxError):
+                e = SyntaxError(str(e))
+            return self.syntax_error_response(e, session_id, start_time)
+
+        try:
+            ticket = self.admission.acquire(client, session_id)
+        except AdmissionRejected as e:
+            return self.busy_response(e, session_id)
+
+        if kernel:
+            path = 'kernel'
+        else:
+            path = 'interactive' if stdin is None and 'input(' in code else 'simple'
+        self.metrics.observe('pyidle_queue_wait_seconds', ticket.queue_wait, path=path)
+        result = None
+        try:
+            result = self.run_admitted_code(code, session_id, stdin, ticket, kernel, wait, limits)
+            result['queue_wait'] = round(ticket.queue_wait, 3)
+            if compiled:
+                result['compile'] = compiled
+            return result
+        finally:
+            # A program waiting for input or still running keeps its slot until it exits
+            if not (result and (result.get('waiting_for_input') or result.get('running'))):
+                ticket.release()
+
+    def busy_response(self, error: AdmissionRejected, session_id: str):
+        """Response for a run shed by admission control (served as 429)"""
+        return {
+            'success': False,
+            'error': str(error),
+            'queue_full': True,
+            'retry_after': error.retry_after,
+            'session_id': session_id
+        }
+
+    def run_admitted_code(self, code: str, session_id: str, stdin: str = None, ticket: AdmissionTicket = None, kernel: bool = False, wait: float = None, limits: dict = None):
+        """Execute Python code with intelligent input detection and handling"""
+        try:
+            start_time = time.time()
+            
+            # Kernel mode: run as the next cell of the session's interpreter
+            if kernel:
+                return self.execute_kernel_cell(code, session_id, start_time, ticket, wait, limits)
+            
+            # Inputs supplied up front: one shot, no prompt handshake
+            if stdin is not None:
+                if self.result_cache.enabled:
+                    return self.execute_cached_code(code, start_time, session_id, stdin, limits)
+                return self.execute_simple_code(code, start_time, session_id, stdin, limits)
+            
+            # Check if code needs input with smart detection
+            if 'input(' in code:
+                # Count and analyze input statements
+                input_info = self.analyze_input_statements(code)
+                return self.execute_interactive_code(code, session_id, start_time, input_info, ticket, wait, limits)
+            elif self.result_cache.enabled:
+                return self.execute_cached_code(code, start_time, session_id, limits=limits)
+            else:
+                return self.execute_simple_code(code, start_time, session_id, limits=limits)
+                
+        except Exception as e:
+            return {
+                'success': False,
+                'error': f'Execution error: {str(e)}',
+                'session_id': session_id
+            }
+
+    def analyze_input_statements(self, code: str):
+        """Count input() statements and check determinism (cached per source; do not modify the result)"""
+        return self.analysis_cache.analyze(code)
+
+    def execute_cached_code(self, code: str, start_time: float, session_id: str, stdin: str = '', limits: dict = None):
+        """Execute non-interactive code through the result cache"""
+        if not self.analyze_input_statements(code)['deterministic']:
+            result = self.execute_simple_code(code, start_time, session_id, stdin, limits)
+            result['cache'] = 'bypass'
+            return result
+
+        key = self.result_cache.key(code, stdin)
+        result, status = self.result_cache.run(key, lambda: self.execute_simple_code(code, start_time, session_id, stdin, limits))
+        if status != 'miss':
+            # Shared result from another request: give it this request's identity
+            result['session_id'] = session_id
+            result['execution_time'] = round(time.time() - start_time, 3)
+            result.pop('fork_latency_ms', None)
+        result['cache'] = status
+        return result
+
+    def execute_simple_code(self, code: str, start_time: float, session_id: str, stdin: str = '', limits: dict = None):
+        """Execute non-interactive code (or interactive code with all of its stdin given)"""
+        try:
+            process = self.run_in_worker(code, stdin, limits, session_id)
+            execution_time = round(time.time() - start_time, 3)
+
+            if process.timeout_reason:
+                return {
+                    'success': False,
+                    'output': process.stdout,
+                    **timeout_fields(process.timeout_reason, process.limits),
+                    'execution_time': execution_time,
+                    'session_id': session_id,
+                    **process.truncation,
+                    **self.engine_details(process)
+                }
+
+            if process.cancelled:
+                return {
+                    'success': False,
+                    'output': process.stdout,
+                    'error': 'Run cancelled',
+                    'cancelled': True,
+                    'execution_time': execution_time,
+                    'session_id': session_id,
+                    **process.truncation,
+                    **self.engine_details(process)
+                }
+
+            return {
+                'success': process.returncode == 0,
+                'output': process.stdout,
+                'error': process.stderr or signal_error(process.resources),
+                'execution_time': execution_time,
+                'session_id': session_id,
+                **process.truncation,
+                **self.engine_details(process)
+            }
+
+        except Exception as e:
+            return {
+                'success': False,
+                'output': '',
+                'error': f'Execution error: {str(e)}',
+                'session_id': session_id
+            }
+
+    def run_in_worker(self, code: str, stdin: str = '', limits: dict = None, session_id: str = None):
+        """Run code to completion on a worker from the configured engine.
+
+        With a session_id the run is registered with the session while it
+        lasts, so /execute/cancel can stop it. A run stopped by one of its
+        budgets comes back with `timeout_reason` set.
+        """
+        start_time = time.time()
+        worker = self.acquire_worker()
+        channel = self.multiplexer.watch(worker)
+        self.track_run(channel, 'simple', start_time)
+        self.start_budget(channel, 'simple', limits)
+        if session_id:
+            sessions.set_run(session_id, {
+                'process': worker,
+                'channel': channel,
+                'start_time': start_time,
+                'oneshot': True
+            })
+        try:
+            try:
+                worker.stdin.write(self.code_cache.frame(code) + stdin)
+                worker.stdin.close()
+            except BrokenPipeError:
+                pass  # the worker died early; its exit status tells the story
+            wall_time = channel.limits['wall_time']
+            if not channel.wait_for_exit(wall_time + ORPHAN_PIPE_GRACE if wall_time else None):
+                # The budget should have ended it by now; make sure nothing keeps the request here
+                channel.timeout_reason = channel.timeout_reason or 'wall_time'
+                channel.timed_out = True
+                kill_run(worker)
+                channel.force_close()
+                channel.wait_for_exit(ORPHAN_PIPE_GRACE)
+        finally:
+            if session_id:
+                sessions.pop_run(session_id, worker)
+        completed = subprocess.CompletedProcess(worker.args, channel.returncode, channel.output_text(), channel.stderr_text())
+        completed.cancelled = channel.cancelled
+        completed.timeout_reason = channel.timeout_reason
+        completed.limits = channel.limits
+        completed.truncation = output_truncation(channel)
+        completed.fork_latency = getattr(worker, 'fork_latency', None)
+        completed.resources = resource_usage(worker, channel)
+        return completed
+
+    def execute_interactive_code(self, code: str, session_id: str, start_time: float, input_info: dict, ticket: AdmissionTicket = None, wait: float = None, limits: dict = None):
+        """Execute interactive code with SIMPLE but RELIABLE input handling"""
+        try:
+            # Ensure clean state - if there's already an active process, clean it up
+            existing_info = sessions.pop_run(session_id)
+            if existing_info:
+                print(f"[DEBUG] Found existing process for session {session_id}, cleaning up...")
+                terminate_run(existing_info['process'], 'replaced', existing_info.get('channel'))
+            
+            # Store input information in session
+            sessions.touch(session_id).input_info = input_info
+            
+            # Hand the code to a ready worker; its bootstrap already routes
+            # input() through the control pipe, and the multiplexer reads its output
+            process = self.acquire_worker('interactive')
+            channel = self.multiplexer.watch(process, interactive=True)
+            self.track_run(channel, 'interactive', start_time)
+            self.start_budget(channel, 'interactive', limits)
+            if ticket:
+                channel.on_exit(ticket.release)
+            process.stdin.write(self.code_cache.frame(code))
+            
+            # Store process info
+            sessions.set_run(session_id, {
+                'process': process,
+                'channel': channel,
+                'start_time': start_time
+            })
+            
+            # Wait for the first prompt or for the program to finish
+            result = self.simple_monitor_process(session_id, channel, start_time, wait=wait)
+            result.update(self.engine_details(process))
+            return result
+                
+        except Exception as e:
+            return {
+                'success': False,
+                'output': '',
+                'error': f'Execution error: {str(e)}',
+                'session_id': session_id
+            }
+
+    def wait_for_step(self, channel, wait: float = None):
+        """Wait for the next prompt or the end of the run, for at most `wait` seconds when given.
+
+        Returns the channel's state, or 'running' when the wait ran out
+        first. The run's own budgets are enforced by the deadline
+        scheduler, which stops the program and so ends any wait.
+        """
+        state = channel.wait_for_prompt_or_exit(wait)
+        return 'running' if state == 'timeout' else state
+
+    def simple_monitor_process(self, session_id: str, channel, start_time: float, cursor: int = None, wait: float = None):
+        """Block until the program asks for input or exits (woken by the multiplexer)"""
+        state = self.wait_for_step(channel, wait)
+        if state not in ('input', 'running'):
+            self.cleanup_process(session_id, channel.process)
+        return channel_response(channel, state, session_id, start_time, cursor)
+
+    def execute_kernel_cell(self, code: str, session_id: str, start_time: float, ticket: AdmissionTicket = None, wait: float = None, limits: dict = None):
+        """Run code as the next cell of the session's kernel, starting one if needed"""
+        try:
+            kernel, started = self.kernels.acquire(session_id)
+        except RuntimeError as e:
+            return {
+                'success': False,
+                'output': '',
+                'error': str(e),
+                'session_id': session_id
+            }
+
+        kernel.busy = True
+        kernel.ticket = ticket
+        kernel.cells += 1
+        kernel.channel.begin_cell(kernel.cells)
+        self.start_budget(kernel.channel, 'kernel', limits, kernel)
+        sessions.set_run(session_id, {
+            'process': kernel.process,
+            'channel': kernel.channel,
+            'start_time': start_time,
+            'kernel': kernel
+        })
+        try:
+            kernel.process.stdin.write(frame_source(code))
+        except BrokenPipeError:
+            pass  # the kernel died; the monitor reports its exit
+
+        result = self.monitor_kernel_cell(session_id, kernel, start_time, wait=wait)
+        result['kernel_started'] = started
+        return result
+
+    def monitor_kernel_cell(self, session_id: str, kernel: Kernel, start_time: float, cursor: int = None, wait: float = None):
+        """Block until the cell asks for input or ends; the kernel itself keeps running"""
+        channel = kernel.channel
+        state = self.wait_for_step(channel, wait)
+        if state in ('input', 'running'):
+            response = channel_response(channel, state, session_id, start_time, cursor)
+            response['cell'] = kernel.cells
+            return response
+
+        timed_out = channel.timed_out
+        sessions.pop_run(session_id, kernel.process)
+        kernel.finish_cell()
+        cell = channel.cell_result or {}
+        output_bytes = channel.output_bytes
+        response = {
+            'success': bool(cell.get('ok')) and not timed_out,
+            **output_fields(channel, cursor),
+            'error': channel.stderr_text() or None,
+            'execution_time': round(time.time() - start_time, 3),
+            'cell': kernel.cells,
+            'session_id': session_id
+        }
+        if timed_out:
+            response.update(timeout_fields(channel.timeout_reason, channel.limits))
+        if state == 'exit':
+            # The interpreter is gone (killed, or over its memory limit): the next run starts fresh
+            resources = resource_usage(kernel.process, kernel.channel)
+            response['error'] = response['error'] or signal_error(resources) or 'Kernel exited'
+            response['resources'] = resources
+            response['kernel_restarted'] = True
+            self.kernels.shutdown(session_id, 'exited')
+        elif (kernel.peak_rss_kb() or 0) > self.kernels.max_rss_kb:
+            response['kernel_restarted'] = True
+            response['warning'] = f'Kernel restarted: memory use passed {self.kernels.max_rss_kb // 1024} MB'
+            self.kernels.shutdown(session_id, 'memory')
+
+        self.metrics.observe('pyidle_execution_seconds', time.time() - start_time, path='kernel')
+        self.metrics.observe('pyidle_output_bytes', output_bytes, path='kernel')
+        if response['output_truncated'] or response.get('error_truncated'):
+            self.metrics.inc('pyidle_output_truncated_total', path='kernel')
+        self.metrics.inc('pyidle_runs_total', path='kernel', outcome='success' if response['success'] else 'error')
+        return response
+
+    def cleanup_process(self, session_id: str, process=None, reason: str = 'cleanup'):
+        """Clean up process resources thoroughly (only `process`'s run, when given)"""
+        try:
+            # Remove from active processes
+            process_info = sessions.pop_run(session_id, process)
+            if process_info:
+                # Ensure process is properly terminated
+                terminate_run(process_info.get('process'), reason, process_info.get('channel'))
+                
+                print(f"[DEBUG] Cleaned up active process for session: {session_id}")
+            
+            # Reset session input state
+            record = sessions.get(session_id)
+            if record:
+                # Keep session but reset input-related state
+                record.input_info = None
+                record.last_activity = time.time()
+                
+        except Exception as e:
+            print(f"[DEBUG] Error during cleanup: {e}")
+            self.metrics.inc('pyidle_cleanup_failures_total', path='interactive')
+
+    def cancel_run(self, session_id: str):
+        """Hard-stop the session's running program and everything it started"""
+        process_info = sessions.get_run(session_id)
+        if not process_info:
+            return {'success': True, 'cancelled': False, 'reclaimed': True, 'session_id': session_id}
+
+        channel = process_info.get('channel')
+        kernel = process_info.get('kernel')
+        if channel is not None:
+            channel.cancelled = True
+        if kernel is not None:
+            # A cell cannot be killed without its kernel: the session loses its state
+            sessions.pop_run(session_id, process_info.get('process'))
+            process, channel = kernel.process, kernel.channel
+            elapsed = terminate_run(process, 'cancel', channel)
+            self.kernels.shutdown(session_id, 'cancelled')
+        else:
+            process = process_info['process']
+            if not process_info.get('oneshot'):
+                # One-shot runs are detached by the request still waiting on them
+                sessions.pop_run(session_id, process)
+            elapsed = terminate_run(process, 'cancel', channel)
+
+        print(f"[DEBUG] Cancelled run for session {session_id}")
+        return {
+            'success': True,
+            'cancelled': elapsed is not None,
+            'reclaimed': run_reclaimed(process, channel),
+            'reclaim_ms': round(elapsed * 1000, 3) if elapsed is not None else None,
+            'session_id': session_id
+        }
+
+    def _reap_sessions_loop(self):
+        while True:
+            time.sleep(SESSION_REAP_INTERVAL)
+            try:
+                self.reap_sessions()
+            except Exception as e:
+                print(f"[DEBUG] Session reaper error: {e}")
+
+    def reap_sessions(self):
+        """Forget finished runs nobody collected and drop sessions past their TTL.
+
+        Programs themselves are stopped by their budgets on the deadline
+        scheduler (including ones abandoned at an input prompt).
+        """
+        started = time.perf_counter()
+        stale_sessions, idle_runs = sessions.expired(SESSION_TTL, INPUT_IDLE_TIMEOUT or SESSION_TTL)
+        self.kernels.reap()
+        output_spools.expire()
+
+        for session_id, process in idle_runs:
+            print(f"[DEBUG] Reaping uncollected run for session {session_id}")
+            kernel = (sessions.get_run(session_id) or {}).get('kernel')
+            if kernel and kernel.alive:
+                # Only the cell is over: keep the kernel, give back its slot
+                if sessions.pop_run(session_id, process):
+                    kernel.finish_cell()
+                continue
+            self.cleanup_process(session_id, process, 'idle')
+            self.metrics.inc('pyidle_reaped_processes_total', path='interactive')
+
+        for session_id in stale_sessions:
+            if sessions.remove_if_idle(session_id, SESSION_TTL):
+                self.metrics.inc('pyidle_reaped_sessions_total')
+
+        self.metrics.observe('pyidle_reaper_seconds', time.perf_counter() - started)
+        return len(stale_sessions), len(idle_runs)
+
+    def handle_input(self, session_id: str, user_input: str, cursor: int = None, wait: float = None):
+        """Send a line to the waiting program; with a cursor only the output after it is returned.
+
+        With `wait`, the answer comes after at most that many seconds even if
+        the program is still busy; it then carries a resume token for /poll.
+        """
+        try:
+            process_info = sessions.get_run(session_id)
+            if not process_info:
+                return {
+                    'success': False,
+                    'error': 'No active process for this session',
+                    'session_id': session_id
+                }
+            
+            sessions.touch(session_id)
+            process = process_info['process']
+            channel = process_info['channel']
+            kernel = process_info.get('kernel')
+            
+            if channel.timed_out and not process_info.get('streaming'):
+                # Stopped at the prompt by its input-idle budget: report that instead
+                if kernel:
+                    return self.monitor_kernel_cell(session_id, kernel, process_info['start_time'], cursor, wait)
+                return self.simple_monitor_process(session_id, channel, process_info['start_time'], cursor, wait)
+            
+            if channel.exited:
+                return {
+                    'success': False,
+                    'error': 'Process has already terminated',
+                    'session_id': session_id
+                }
+            
+            if not channel.waiting_for_input:
+                # A kernel would read the text as its next cell frame
+                return {
+                    'success': False,
+                    'error': 'The program is not waiting for input',
+                    'not_waiting': True,
+                    'session_id': session_id
+                }
+            
+            try:
+                print(f"[DEBUG] Sending input: {user_input}")
+                
+                # Send input to process
+                channel.send_input(user_input)
+            except Exception as e:
+                print(f"[DEBUG] Input handling error: {e}")
+                return {
+                    'success': False,
+                    'error': f'Failed to send input: {str(e)}',
+                    'session_id': session_id
+                }
+
+            if process_info.get('streaming'):
+                # The open /execute/stream response delivers the output
+                return {
+                    'success': True,
+                    'streaming': True,
+                    'session_id': session_id
+                }
+            
+            # Wait for the next prompt or for completion
+            sent_at = time.perf_counter()
+            if kernel:
+                result = self.monitor_kernel_cell(session_id, kernel, process_info['start_time'], cursor, wait)
+            else:
+                result = self.simple_monitor_process(session_id, channel, process_info['start_time'], cursor, wait)
+            if not result.get('running'):
+                path = 'kernel' if kernel else 'interactive'
+                self.metrics.observe('pyidle_input_roundtrip_seconds', time.perf_counter() - sent_at, path=path)
+            return result
+                
+        except Exception as e:
+            return {
+                'success': False,
+                'error': f'Input handling error: {str(e)}',
+                'session_id': session_id
+            }
+
+    def poll_run(self, session_id: str, token: str, cursor: int = None, wait: float = None):
+        """Collect a run that was still busy when /execute or /input answered"""
+        try:
+            process_info = sessions.get_run(session_id)
+            if not process_info:
+                return {
+                    'success': False,
+                    'error': 'No active process for this session',
+                    'session_id': session_id
+                }
+            
+            channel = process_info['channel']
+            if token != channel.resume_token():
+                return {
+                    'success': False,
+                    'error': 'Resume token does not match the current run (it was restarted or given more input)',
+                    'stale_token': True,
+                    'session_id': session_id
+                }
+            
+            sessions.touch(session_id)
+            self.metrics.inc('pyidle_polls_total')
+            kernel = process_info.get('kernel')
+            if kernel:
+                return self.monitor_kernel_cell(session_id, kernel, process_info['start_time'], cursor, wait)
+            return self.simple_monitor_process(session_id, channel, process_info['start_time'], cursor, wait)
+                
+        except Exception as e:
+            return {
+                'success': False,
+                'error': f'Poll error: {str(e)}',
+                'session_id': session_id
+            }
+
+    def stream_execution(self, code: str, session_id: str, ticket: AdmissionTicket = None, limits: dict = None):
+        """Run code and yield (event, payload) pairs as output arrives.
+
+        Output chunks are pushed as soon as the multiplexer reads them, input
+        requests are announced while the stream stays open (the input itself
+        still goes through /input), and a final status event ends the run.
+        """
+        start_time = time.time()
+        try:
+            compiled = self.preflight(code)
+        except SyntaxError as e:
+            yield 'status', self.syntax_error_response(e, session_id, start_time)
+            return
+        interactive = 'input(' in code
+
+        path = 'interactive' if interactive else 'simple'
+        if ticket:
+            self.metrics.observe('pyidle_queue_wait_seconds', ticket.queue_wait, path=path)
+        process = self.acquire_worker(path)
+        channel = ProcessChannel(process, interactive=interactive)
+        self.track_run(channel, path, start_time)
+        self.start_budget(channel, path, limits)
+        if ticket:
+            channel.on_exit(ticket.release)
+        events = channel.subscribe()
+        self.multiplexer.register(channel)
+        process.stdin.write(self.code_cache.frame(code))
+        if not interactive:
+            process.stdin.close()
+
+        sessions.set_run(session_id, {
+            'process': process,
+            'channel': channel,
+            'start_time': start_time,
+            'streaming': True
+        })
+
+        yield 'start', {
+            'session_id': session_id,
+            'interactive': interactive,
+            'queue_wait': round(ticket.queue_wait, 3) if ticket else None,
+            'compile': compiled,
+            **self.engine_details(process)
+        }
+
+        ttfb = None
+        try:
+            while True:
+                # The run's budgets end it (and so this loop) through the scheduler
+                event, payload = events.get()
+
+                if event == 'exit' and channel.timed_out:
+                    yield 'status', {
+                        'success': False,
+                        **timeout_fields(channel.timeout_reason, channel.limits),
+                        'execution_time': round(time.time() - start_time, 3),
+                        'ttfb_ms': round(ttfb * 1000, 3) if ttfb is not None else None,
+                        'session_id': session_id
+                    }
+                    return
+
+                if event == 'exit':
+                    yield 'status', {
+                        'success': payload == 0,
+                        'returncode': payload,
+                        'execution_time': round(time.time() - start_time, 3),
+                        'ttfb_ms': round(ttfb * 1000, 3) if ttfb is not None else None,
+                        'session_id': session_id
+                    }
+                    return
+
+                if ttfb is None:
+                    ttfb = time.time() - start_time
+
+                if event == 'input_request':
+                    yield 'input_request', {'prompt': payload}
+                else:
+                    yield 'output', {'stream': event, 'data': payload}
+        finally:
+            # Also reached when the client disconnects mid-run
+            self.cleanup_process(session_id, process, 'disconnect')
+            with self.stream_lock:
+                self.stream_stats['runs'] += 1
+                if ttfb is not None:
+                    self.stream_stats['ttfb_total'] += ttfb
+                    self.stream_stats['ttfb_count'] += 1
+                    self.stream_stats['last_ttfb'] = ttfb
+
+    def execute_batch_job(self, index: int, job: dict, deadline: float, client: str = None):
+        """Run one batch job to completion; same result shape as /execute"""
+        code = job.get('code', '')
+        stdin = job.get('stdin') or ''
+        result = {'index': index, 'id': job.get('id', index)}
+
+        try:
+            result['compile'] = self.preflight(code)
+        except SyntaxError as e:
+            result.update(self.syntax_error_response(e, None, time.time()))
+            result.pop('session_id')
+            return result
+
+        # Batch jobs wait out a full queue instead of failing, up to the deadline
+        ticket = None
+        while ticket is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                result.update({
+                    'success': False,
+                    'output': '',
+                    'error': 'Batch deadline exceeded before the job started',
+                    'skipped': True
+                })
+                return result
+            try:
+                ticket = self.admission.acquire(client, None, min(self.admission.queue_timeout, remaining))
+            except AdmissionRejected as e:
+                time.sleep(min(e.retry_after, max(0, deadline - time.time())))
+
+        result['queue_wait'] = round(ticket.queue_wait, 3)
+        self.metrics.observe('pyidle_queue_wait_seconds', ticket.queue_wait, path='simple')
+        try:
+            return self.run_batch_job(result, code, stdin, deadline)
+        finally:
+            ticket.release()
+
+    def run_batch_job(self, result: dict, code: str, stdin: str, deadline: float):
+        """Run an admitted batch job; `result` already carries its index and id"""
+        start_time = time.time()
+        remaining = deadline - start_time
+
+        wall_time = RUN_TIME_LIMITS['wall_time']
+        limits = dict(RUN_TIME_LIMITS, wall_time=min(wall_time, remaining) if wall_time else remaining)
+
+        def run():
+            try:
+                process = self.run_in_worker(code, stdin, limits)
+                if process.timeout_reason == 'wall_time' and limits['wall_time'] != wall_time:
+                    return {
+                        'success': False,
+                        'output': process.stdout,
+                        'error': 'Batch deadline exceeded',
+                        'timeout': True,
+                        'timeout_reason': 'batch_deadline'
+                    }
+                if process.timeout_reason:
+                    return {'success': False, 'output': process.stdout, **timeout_fields(process.timeout_reason, limits)}
+                return {
+                    'success': process.returncode == 0,
+                    'output': process.stdout,
+                    'error': process.stderr or signal_error(process.resources),
+                    'returncode': process.returncode,
+                    'execution_time': round(time.time() - start_time, 3),
+                    **process.truncation,
+                    **self.engine_details(process)
+                }
+            except Exception as e:
+                return {'success': False, 'output': '', 'error': f'Execution error: {str(e)}'}
+
+        if self.result_cache.enabled and self.analyze_input_statements(code)['deterministic']:
+            outcome, status = self.result_cache.run(self.result_cache.key(code, stdin), run)
+            outcome = dict(outcome, cache=status)
+            if status != 'miss':
+                outcome['execution_time'] = round(time.time() - start_time, 3)
+                outcome.pop('fork_latency_ms', None)
+        else:
+            outcome = run()
+        result.update(outcome)
+        return result
+
+    def run_batch(self, jobs: list, deadline_seconds: float = None, client: str = None):
+        """Run jobs in parallel and yield ('result', ...) pairs as they finish, then ('summary', ...).
+
+        Every job gets the usual per-run timeout, clipped to whatever is left
+        of the batch deadline; jobs that have not started by then are skipped.
+        Closing the generator early cancels the jobs that have not started.
+        """
+        start_time = time.time()
+        deadline = start_time + (deadline_seconds if deadline_seconds else float('inf'))
+        futures = [self.batch_pool.submit(self.execute_batch_job, index, job, deadline, client) for index, job in enumerate(jobs)]
+        summary = {'total': len(jobs), 'succeeded': 0, 'failed': 0, 'timed_out': 0, 'skipped': 0, 'job_time_total': 0.0}
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                if result.get('skipped'):
+                    summary['skipped'] += 1
+                elif result.get('success'):
+                    summary['succeeded'] += 1
+                else:
+                    summary['failed'] += 1
+                if result.get('timeout'):
+                    summary['timed_out'] += 1
+                summary['job_time_total'] += result.get('execution_time') or 0
+                yield 'result', result
+        finally:
+            for future in futures:
+                future.cancel()
+
+        wall_time = time.time() - start_time
+        summary['job_time_total'] = round(summary['job_time_total'], 3)
+        summary['wall_time'] = round(wall_time, 3)
+        summary['jobs_per_second'] = round(len(jobs) / wall_time, 2) if wall_time else None
+        summary['workers'] = self.batch_workers
+        yield 'summary', summary
+
+    def streaming_stats(self):
+        with self.stream_lock:
+            stats = self.stream_stats
+            return {
+                'runs': stats['runs'],
+                'avg_ttfb_ms': round(stats['ttfb_total'] / stats['ttfb_count'] * 1000, 3) if stats['ttfb_count'] else None,
+                'last_ttfb_ms': round(stats['last_ttfb'] * 1000, 3) if stats['last_ttfb'] is not None else None
+            }
+
+# Initialize executor
+executor = UnifiedCodeExecutor()
+
+def client_id():
+    """Identity used for per-client fairness in the job queue"""
+    return request.remote_addr or 'unknown'
+
+def busy_reply(result: dict):
+    """429 response telling the client when to come back"""
+    return jsonify(result), 429, {'Retry-After': str(result['retry_after'])}
+
+def normalize_stdin(value):
+    """Turn the optional `stdin` request field (string or list of lines) into text"""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, list) and all(isinstance(line, (str, int, float)) for line in value):
+        return ''.join(f'{line}\n' for line in value)
+    raise ValueError('stdin must be a string or a list of lines')
+
+def parse_cursor(value):
+    """The optional output `cursor` request field; raises ValueError"""
+    if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+        raise ValueError('cursor must be a non-negative integer')
+    return value
+
+def parse_wait(value):
+    """The optional long-poll `wait` request field in seconds, capped at LONG_POLL_SECONDS; raises ValueError"""
+    if value is None:
+        return LONG_POLL_SECONDS
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+        raise ValueError('wait must be a non-negative number of seconds')
+    return min(float(value), LONG_POLL_SECONDS)
+
+def parse_time_limits(data: dict):
+    """The run's budgets, lowered by the optional `timeout`, `cpu_timeout` and `input_timeout` fields; raises ValueError"""
+    limits = dict(RUN_TIME_LIMITS)
+    for field, budget in TIME_LIMIT_FIELDS.items():
+        value = data.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+            raise ValueError(f'{field} must be a positive number of seconds')
+        limits[budget] = min(float(value), limits[budget]) if limits[budget] else float(value)
+    return limits
+
+def prepare_session_for_run(session_id: str):
+    """Stop any process still running for the session and reset its state"""
+    existing_info = sessions.pop_run(session_id)
+    if existing_info and existing_info.get('kernel'):
+        # Interrupt the kernel's pending cell but keep its state
+        executor.kernels.cancel_cell(existing_info['kernel'])
+    elif existing_info:
+        try:
+            # Terminate existing process
+            terminate_run(existing_info['process'], 'replaced', existing_info.get('channel'))
+            
+            print(f"[DEBUG] Cleaned up existing process for session {session_id}")
+        except Exception as e:
+            print(f"[DEBUG] Error cleaning up existing process: {e}")
+            executor.metrics.inc('pyidle_cleanup_failures_total', path='interactive')
+    
+    # Reset/Create session state
+    sessions.reset(session_id)
+    if cluster is not None:
+        cluster.claim(session_id)
+
+# API Routes  
+@app.route('/health')
+def health_check():
+    """Health check endpoint"""
+    return jsonify({
+        'success': True,
+        'status': 'healthy',
+        'python_version': f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}",
+        'timestamp': datetime.now().isoformat(),
+        'active_sessions': len(sessions),
+        'active_processes': sessions.run_count(),
+        'sessions': sessions.stats(),
+        'engine': executor.engine,
+        'pool': executor.pool.stats(),
+        'fork_server': executor.fork_server.stats() if executor.fork_server else None,
+        'result_cache': executor.result_cache.stats(),
+        'analysis_cache': executor.analysis_cache.stats(),
+        'code_cache': executor.code_cache.stats(),
+        'streaming': executor.streaming_stats(),
+        'multiplexer': executor.multiplexer.stats(),
+        'admission': executor.admission.stats(),
+        'kernels': executor.kernels.stats(),
+        'output_spools': output_spools.stats(),
+        'websocket': HAS_SOCK,
+        'json_encoder': 'orjson' if HAS_ORJSON else 'json',
+        'gzip_min_bytes': GZIP_MIN_BYTES,
+        'long_poll_seconds': LONG_POLL_SECONDS,
+        'time_limits': RUN_TIME_LIMITS,
+        'resource_limits': RESOURCE_LIMITS,
+        'cgroups': run_cgroups.stats(),
+        'deadlines': executor.deadlines.stats(),
+        'cluster': cluster.stats() if cluster else None
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics endpoint"""
+    pool = executor.pool.stats()
+    admission = executor.admission.stats()
+    gauges = {
+        'pyidle_sessions': ('Sessions currently known to the server', len(sessions)),
+        'pyidle_active_processes': ('Interactive programs currently running', sessions.run_count()),
+        'pyidle_watched_processes': ('Children whose pipes the multiplexer is reading', executor.multiplexer.stats()['watched_processes']),
+        'pyidle_pool_idle_workers': ('Idle warm worker interpreters', pool['idle']),
+        'pyidle_pool_size': ('Target size of the warm worker pool', pool['size']),
+        'pyidle_running_slots': ('Execution slots in use', admission['running']),
+        'pyidle_queued_runs': ('Runs waiting for an execution slot', admission['queued']),
+        'pyidle_kernels': ('Live kernel interpreters', executor.kernels.stats()['kernels'])
+    }
+    return Response(executor.metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/session/create', methods=['POST'])
+def create_session():
+    """Create a new session"""
+    try:
+        session_id = str(uuid.uuid4())
+        sessions.touch(session_id)
+        if cluster is not None:
+            cluster.claim(session_id)
+        return jsonify({
+            'success': True,
+            'session_id': session_id
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/session/clear', methods=['POST'])
+def clear_session():
+    """Clear session"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        
+        # Stop any active processes
+        process_info = sessions.pop_run(session_id)
+        if process_info:
+            terminate_run(process_info['process'], 'clear', process_info.get('channel'))
+        
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/execute', methods=['POST'])
+def execute_code():
+    """Execute Python code with input support"""
+    try:
+        data = request.get_json()
+        code = data.get('code', '')
+        session_id = data.get('session_id')
+        
+        if not code.strip():
+            return jsonify({
+                'success': False,
+                'error': 'No code provided'
+            }), 400
+        
+        try:
+            stdin = normalize_stdin(data.get('stdin'))
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+        
+        try:
+            wait = parse_wait(data.get('wait'))
+            limits = parse_time_limits(data)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+        
+        kernel = bool(data.get('kernel'))
+        if kernel and not executor.kernels.enabled:
+            return jsonify({
+                'success': False,
+                'error': 'Kernel mode is disabled on this server'
+            }), 400
+        if kernel and stdin is not None:
+            return jsonify({
+                'success': False,
+                'error': 'stdin cannot be combined with kernel mode; answer prompts through /input'
+            }), 400
+        
+        # Create session if not provided
+        if not session_id:
+            session_id = str(uuid.uuid4())
+        
+        # IMPORTANT: Clean up any existing process for this session
+        # This ensures multiple clicks on "Run" don't cause conflicts
+        prepare_session_for_run(session_id)
+        
+        print(f"[DEBUG] Executing new code for session {session_id} (reset #{sessions.get(session_id).reset_count})")
+        
+        # Execute the code
+        result = executor.execute_code(code, session_id, stdin, client_id(), kernel, wait, limits)
+        if result.get('queue_full'):
+            return busy_reply(result)
+        return jsonify(result)
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/execute/stream', methods=['POST'])
+def execute_code_stream():
+    """Execute Python code and stream output as Server-Sent Events"""
+    try:
+        data = request.get_json()
+        code = data.get('code', '')
+        session_id = data.get('session_id') or str(uuid.uuid4())
+        
+        if not code.strip():
+            return jsonify({
+                'success': False,
+                'error': 'No code provided'
+            }), 400
+        
+        try:
+            limits = parse_time_limits(data)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+        
+        prepare_session_for_run(session_id)
+        
+        try:
+            ticket = executor.admission.acquire(client_id(), session_id)
+        except AdmissionRejected as e:
+            return busy_reply(executor.busy_response(e, session_id))
+        
+        def generate():
+            try:
+                for event, payload in executor.stream_execution(code, session_id, ticket, limits):
+                    yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+            except Exception as e:
+                yield f"event: status\ndata: {json.dumps({'success': False, 'error': f'Execution error: {str(e)}', 'session_id': session_id})}\n\n"
+        
+        response = Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        # Frees the slot even if the client goes away before the run starts
+        response.call_on_close(ticket.release)
+        return response
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/execute/batch', methods=['POST'])
+def execute_batch():
+    """Run many non-interactive jobs in parallel, streaming results as NDJSON"""
+    try:
+        data = request.get_json()
+        jobs = data.get('jobs')
+        deadline = data.get('deadline')
+        
+        if not isinstance(jobs, list) or not jobs:
+            return jsonify({
+                'success': False,
+                'error': 'No jobs provided'
+            }), 400
+        
+        if len(jobs) > BATCH_MAX_JOBS:
+            return jsonify({
+                'success': False,
+                'error': f'Too many jobs ({len(jobs)}, limit {BATCH_MAX_JOBS})'
+            }), 400
+        
+        for job in jobs:
+            if not isinstance(job, dict) or not str(job.get('code', '')).strip():
+                return jsonify({
+                    'success': False,
+                    'error': 'Every job needs non-empty code'
+                }), 400
+            try:
+                job['stdin'] = normalize_stdin(job.get('stdin'))
+            except ValueError as e:
+                return jsonify({
+                    'success': False,
+                    'error': str(e)
+                }), 400
+        
+        if deadline is not None and (not isinstance(deadline, (int, float)) or deadline <= 0):
+            return jsonify({
+                'success': False,
+                'error': 'deadline must be a positive number of seconds'
+            }), 400
+        
+        print(f"[DEBUG] Running batch of {len(jobs)} jobs (deadline: {deadline or 'none'})")
+        
+        client = client_id()
+        
+        def generate():
+            results = executor.run_batch(jobs, deadline, client)
+            try:
+                for event, payload in results:
+                    yield json.dumps({'event': event, **payload}) + '\n'
+            finally:
+                results.close()
+        
+        return Response(
+            stream_with_context(generate()),
+            mimetype='application/x-ndjson',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/input', methods=['POST'])
+def handle_input():
+    """Handle input for interactive programs"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        user_input = data.get('input', '')
+        
+        try:
+            cursor = parse_cursor(data.get('cursor'))
+            wait = parse_wait(data.get('wait'))
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+        
+        result = executor.handle_input(session_id, user_input, cursor, wait)
+        return jsonify(result), 409 if result.get('not_waiting') else 200
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/poll', methods=['POST'])
+def poll_run():
+    """Collect output and prompt state of a run answered with a resume token"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        token = data.get('resume_token')
+        
+        if not token:
+            return jsonify({
+                'success': False,
+                'error': 'No resume_token provided'
+            }), 400
+        
+        try:
+            cursor = parse_cursor(data.get('cursor'))
+            wait = parse_wait(data.get('wait'))
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+        
+        result = executor.poll_run(session_id, token, cursor, wait)
+        return jsonify(result), 409 if result.get('stale_token') else 200
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/execute/cancel', methods=['POST'])
+def cancel_execution():
+    """Kill the session's running program (and any processes it started) right away"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        
+        if not session_id:
+            return jsonify({
+                'success': False,
+                'error': 'No session_id provided'
+            }), 400
+        
+        return jsonify(executor.cancel_run(session_id))
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+def output_page(run_id: str, params):
+    """(status, payload) for one page of a spooled output stream; offsets are UTF-8 byte offsets"""
+    stream = params.get('stream') or 'stdout'
+    try:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or OUTPUT_PAGE_BYTES)
+    except (TypeError, ValueError):
+        offset = limit = -1
+    if offset < 0 or limit <= 0 or stream not in ('stdout', 'stderr'):
+        return 400, {
+            'success': False,
+            'error': 'offset must be a non-negative integer, limit a positive one and stream stdout or stderr'
+        }
+
+    spool = output_spools.get(run_id, stream)
+    if spool is None:
+        return 404, {
+            'success': False,
+            'error': 'No spooled output for this run_id (it was not truncated, or it expired)',
+            'run_id': run_id
+        }
+    text, next_offset = spool.read(offset, min(limit, OUTPUT_MAX_PAGE_BYTES))
+    return 200, {
+        'success': True,
+        'run_id': run_id,
+        'stream': stream,
+        'output': text,
+        'offset': offset,
+        'next_offset': next_offset,
+        'total_bytes': spool.size,
+        'has_more': next_offset < spool.size,
+        'spool_full': spool.dropped > 0
+    }
+
+@app.route('/output/<run_id>')
+def get_output(run_id):
+    """Page through the full output of a run whose response was truncated"""
+    status, payload = output_page(run_id, request.args)
+    return jsonify(payload), status
+
+@app.route('/session/reset', methods=['POST'])
+def reset_session():
+    """Reset a session - cleanup any active processes"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        
+        if not session_id:
+            return jsonify({
+                'success': False,
+                'error': 'No session_id provided'
+            }), 400
+        
+        # Clean up active process if exists
+        process_info = sessions.pop_run(session_id)
+        if process_info:
+            try:
+                terminate_run(process_info.get('process'), 'reset', process_info.get('channel'))
+                
+                print(f"[DEBUG] Reset session {session_id}")
+                
+            except Exception as e:
+                print(f"[DEBUG] Error resetting session: {e}")
+                executor.metrics.inc('pyidle_cleanup_failures_total', path='interactive')
+        
+        # Reset session state
+        record = sessions.get(session_id)
+        if record:
+            record.input_info = None
+            record.last_activity = time.time()
+        
+        return jsonify({
+            'success': True,
+            'message': f'Session {session_id} reset successfully'
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/kernel/restart', methods=['POST'])
+def restart_kernel():
+    """Throw away the session's kernel; its next kernel-mode run starts a fresh one"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        
+        if not session_id:
+            return jsonify({
+                'success': False,
+                'error': 'No session_id provided'
+            }), 400
+        
+        sessions.pop_run(session_id)
+        restarted = executor.kernels.shutdown(session_id, 'restart')
+        return jsonify({
+            'success': True,
+            'restarted': restarted,
+            'session_id': session_id
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/kernel/interrupt', methods=['POST'])
+def interrupt_kernel():
+    """Raise KeyboardInterrupt in the session's running cell; the kernel keeps its state"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        
+        kernel = executor.kernels.get(session_id) if session_id else None
+        if kernel is None:
+            return jsonify({
+                'success': False,
+                'error': 'No kernel for this session',
+                'session_id': session_id
+            }), 404
+        
+        if not kernel.channel.waiting_for_input:
+            # The request running the cell gets the KeyboardInterrupt traceback
+            return jsonify({
+                'success': True,
+                'interrupted': executor.kernels.interrupt(kernel),
+                'session_id': session_id
+            })
+        
+        # Nobody is waiting on a cell parked at a prompt: report its end here
+        process_info = sessions.get_run(session_id)
+        if not executor.kernels.interrupt(kernel) or not process_info:
+            return jsonify({
+                'success': True,
+                'interrupted': False,
+                'session_id': session_id
+            })
+        kernel.channel.wait_for_cell_end(2)
+        result = executor.monitor_kernel_cell(session_id, kernel, process_info['start_time'])
+        result['interrupted'] = True
+        return jsonify(result)
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+def websocket_session(ws):
+    """Interactive runs over one WebSocket instead of /execute + /input round trips.
+
+    Client messages (JSON): {"type": "run", "code": ...} (optionally with the
+    /execute `timeout`, `cpu_timeout` and `input_timeout` fields), {"type": "stdin",
+    "data": "line"} and {"type": "stop"}. The server pushes {"type":
+    "session"} once, then per run "start", "stdout"/"stderr" chunks as they
+    are produced, "input_request" and a final "exit" (the /execute/stream
+    events). The REST endpoints keep working for the same session.
+    """
+    session_id = request.args.get('session_id') or str(uuid.uuid4())
+    client = client_id()
+    send_lock = threading.Lock()
+    if cluster is not None:
+        cluster.claim(session_id)  # REST calls for a new session must find this worker
+
+    def send(message):
+        with send_lock:
+            ws.send(json.dumps(message))
+
+    def pump(code, ticket, limits):
+        events = executor.stream_execution(code, session_id, ticket, limits)
+        try:
+            for event, payload in events:
+                if event == 'output':
+                    send({'type': payload['stream'], 'data': payload['data']})
+                elif event == 'status':
+                    send({'type': 'exit', **payload})
+                else:
+                    send({'type': event, **payload})
+        except Exception as e:
+            print(f"[DEBUG] WebSocket run for session {session_id} ended: {e}")
+        finally:
+            events.close()
+            ticket.release()
+
+    def stop_run():
+        process_info = sessions.pop_run(session_id)
+        if process_info:
+            terminate_run(process_info['process'], 'cancel', process_info.get('channel'))
+
+    send({'type': 'session', 'session_id': session_id})
+    try:
+        while True:
+            try:
+                message = json.loads(ws.receive())
+                kind = message.get('type')
+            except (ValueError, AttributeError):
+                send({'type': 'error', 'error': 'Messages must be JSON objects'})
+                continue
+
+            if kind == 'run':
+                code = message.get('code', '')
+                if not isinstance(code, str) or not code.strip():
+                    send({'type': 'error', 'error': 'No code provided'})
+                    continue
+                try:
+                    limits = parse_time_limits(message)
+                except ValueError as e:
+                    send({'type': 'error', 'error': str(e)})
+                    continue
+                prepare_session_for_run(session_id)
+                try:
+                    ticket = executor.admission.acquire(client, session_id)
+                except AdmissionRejected as e:
+                    send({'type': 'busy', **executor.busy_response(e, session_id)})
+                    continue
+                threading.Thread(target=pump, args=(code, ticket, limits), daemon=True).start()
+
+            elif kind == 'stdin':
+                process_info = sessions.get_run(session_id)
+                if not process_info or process_info['channel'].exited:
+                    send({'type': 'error', 'error': 'No active process for this session'})
+                    continue
+                if not process_info['channel'].waiting_for_input:
+                    send({'type': 'error', 'error': 'The program is not waiting for input'})
+                    continue
+                sessions.touch(session_id)
+                try:
+                    process_info['channel'].send_input(str(message.get('data', '')))
+                except Exception as e:
+                    send({'type': 'error', 'error': f'Failed to send input: {str(e)}'})
+
+            elif kind == 'stop':
+                stop_run()
+
+            else:
+                send({'type': 'error', 'error': f'Unknown message type: {kind}'})
+    finally:
+        # Closing the socket ends the session's program
+        stop_run()
+
+if HAS_SOCK:
+    sock.route('/ws')(websocket_session)
+
+# ---------------------------------------------------------------------------
+# Multi-worker mode: several server processes share one port, session
+# ownership lives in a SQLite registry and requests are forwarded to the owner
+# ---------------------------------------------------------------------------
+
+# Routes whose session_id pins them to the worker holding the live process
+SESSION_ROUTES = {
+    '/execute', '/execute/stream', '/execute/cancel', '/input', '/poll', '/session/clear', '/session/reset',
+    '/kernel/restart', '/kernel/interrupt'
+}
+FORWARDED_HEADER = 'X-PyIdle-Forwarded'
+
+class HashRing:
+    """Consistent hash ring over worker ids (with virtual nodes for balance)"""
+
+    def __init__(self, worker_ids: list, replicas: int = 64):
+        self.worker_ids = tuple(sorted(worker_ids))
+        self.points = sorted(
+            (self._hash(f'{worker_id}#{replica}'), worker_id)
+            for worker_id in self.worker_ids for replica in range(replicas)
+        )
+        self.keys = [point for point, _ in self.points]
+
+    @staticmethod
+    def _hash(value: str):
+        return int.from_bytes(hashlib.sha1(value.encode('utf-8')).digest()[:8], 'big')
+
+    def owner(self, key: str):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.keys, self._hash(key)) % len(self.points)
+        return self.points[index][1]
+
+class ClusterRegistry:
+    """Shared SQLite table of live workers and of which worker owns each session.
+
+    A session stays with the worker that first ran it (sticky); sessions
+    without an owner, or whose owner stopped heartbeating, are placed by
+    consistent hashing over the live workers.
+    """
+
+    def __init__(self, path: str, worker_id: str, url: str, heartbeat_interval: float = 2.0):
+        self.path = path
+        self.worker_id = worker_id
+        self.url = url
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = heartbeat_interval * 5
+        self.local = threading.local()
+        self.ring = HashRing([])
+        self.lock = threading.Lock()
+        self.forwarded = 0
+
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, url TEXT, pid INTEGER, heartbeat REAL)')
+        db.execute('CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, worker_id TEXT, updated REAL)')
+        self.heartbeat()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def heartbeat(self):
+        db = self._db()
+        db.execute('INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?)', (self.worker_id, self.url, os.getpid(), time.time()))
+        workers = self.live_workers()
+        if tuple(sorted(workers)) != self.ring.worker_ids:
+            self.ring = HashRing(list(workers))
+        db.execute('DELETE FROM sessions WHERE updated < ?', (time.time() - SESSION_TTL,))
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e:
+                print(f"[DEBUG] Cluster heartbeat failed: {e}")
+
+    def live_workers(self):
+        rows = self._db().execute('SELECT worker_id, url FROM workers WHERE heartbeat >= ?', (time.time() - self.stale_after,))
+        return dict(rows.fetchall())
+
+    def owner(self, session_id: str):
+        """(worker_id, url) of the worker that should serve this session"""
+        workers = self.live_workers()
+        row = self._db().execute('SELECT worker_id FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        if row and row[0] in workers:
+            return row[0], workers[row[0]]
+        worker_id = self.ring.owner(session_id) or self.worker_id
+        return worker_id, workers.get(worker_id, self.url)
+
+    def claim(self, session_id: str):
+        self._db().execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', (session_id, self.worker_id, time.time()))
+
+    def count_forward(self):
+        with self.lock:
+            self.forwarded += 1
+
+    def stats(self):
+        workers = self.live_workers()
+        return {
+            'worker_id': self.worker_id,
+            'live_workers': sorted(workers),
+            'owned_sessions': self._db().execute('SELECT COUNT(*) FROM sessions WHERE worker_id = ?', (self.worker_id,)).fetchone()[0],
+            'forwarded_requests': self.forwarded  # a plain read; the lock only orders writers
+        }
+
+# Set in multi-worker mode only
+cluster = None
+
+def forward_request(url: str):
+    """Replay the current request on another worker and relay its (possibly streamed) response"""
+    headers = {key: value for key, value in request.headers.items() if key.lower() in ('content-type', 'accept', 'accept-encoding')}
+    headers[FORWARDED_HEADER] = cluster.worker_id
+    upstream_request = urllib.request.Request(url + request.full_path.rstrip('?'), data=request.get_data(), headers=headers, method=request.method)
+    try:
+        # A socket timeout: the longest a run can leave its response silent, plus slack
+        silence = max(LONG_POLL_SECONDS, *RUN_TIME_LIMITS.values()) + QUEUE_TIMEOUT + 30
+        upstream = urllib.request.urlopen(upstream_request, timeout=silence)
+    except urllib.error.HTTPError as e:
+        upstream = e
+
+    def relay():
+        try:
+            while True:
+                chunk = upstream.read1(65536) if hasattr(upstream, 'read1') else upstream.read(65536)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            upstream.close()
+
+    passthrough = {key: value for key, value in upstream.headers.items()
+                   if key.lower() in ('content-type', 'content-encoding', 'vary', 'retry-after', 'cache-control', 'x-accel-buffering')}
+    return Response(relay(), status=upstream.status, headers=passthrough)
+
+class HandedOver(Response):
+    """Response for a connection the view has taken over and already finished with"""
+
+    def __call__(self, environ, start_response):
+        # The werkzeug server treats this as a dropped client and writes nothing
+        raise ConnectionError('connection handed over')
+
+def forward_websocket(url: str):
+    """Splice the current WebSocket upgrade through to another worker, byte for byte.
+
+    The upgrade request is replayed on the owner's private port and the two
+    sockets are then copied into each other until either side closes, so the
+    owner runs the session exactly as if the client had connected to it.
+    """
+    client = request.environ.get('werkzeug.socket')
+    if client is None:
+        raise OSError('this server cannot hand over WebSocket connections')
+    target = urllib.parse.urlsplit(url)
+    upstream = socket.create_connection((target.hostname, target.port), timeout=10)
+    upstream.settimeout(None)
+    lines = [f'GET {request.full_path.rstrip("?")} HTTP/1.1']
+    lines += [f'{key}: {value}' for key, value in request.headers.items()]
+    lines.append(f'{FORWARDED_HEADER}: {cluster.worker_id}')
+    upstream.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    def copy(source, sink):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                sink.sendall(data)
+        except OSError:
+            pass
+        finally:
+            try:
+                sink.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    downstream = threading.Thread(target=copy, args=(upstream, client), daemon=True)
+    downstream.start()
+    copy(client, upstream)
+    downstream.join()
+    upstream.close()
+    return HandedOver()
+
+@app.before_request
+def route_to_session_owner():
+    """In multi-worker mode, send session-bound requests to the worker that owns the session"""
+    if cluster is None:
+        return None
+    if request.path.startswith('/output/') and not request.headers.get(FORWARDED_HEADER):
+        # Spools live on the worker that ran the program; run ids start with its id
+        worker_id = request.path[len('/output/'):].rsplit('-', 1)[0]
+        url = cluster.live_workers().get(worker_id)
+        if url and worker_id != cluster.worker_id:
+            cluster.count_forward()
+            try:
+                return forward_request(url)
+            except OSError as e:
+                print(f"[DEBUG] Forwarding to worker {worker_id} failed ({e})")
+        return None
+    websocket = request.path == '/ws' and request.method == 'GET'
+    if websocket:
+        session_id = request.args.get('session_id')
+    elif request.path in SESSION_ROUTES and request.method == 'POST':
+        session_id = (request.get_json(silent=True) or {}).get('session_id')
+    else:
+        return None
+    if not session_id:
+        return None
+
+    worker_id, url = cluster.owner(session_id)
+    if worker_id == cluster.worker_id or request.headers.get(FORWARDED_HEADER):
+        cluster.claim(session_id)
+        return None
+
+    cluster.count_forward()
+    try:
+        return forward_websocket(url) if websocket else forward_request(url)
+    except OSError as e:
+        print(f"[DEBUG] Forwarding to worker {worker_id} failed ({e}), handling locally")
+        cluster.claim(session_id)
+        return None
+
+def serve_cluster_worker(listen_fd: int, worker_id: str, db_path: str):
+    """Run one worker: public requests on the shared socket, forwarded ones on a private port"""
+    global cluster
+    from werkzeug.serving import make_server
+
+    private = make_server('127.0.0.1', 0, app, threaded=True)
+    cluster = ClusterRegistry(db_path, worker_id, f'http://127.0.0.1:{private.server_port}')
+    threading.Thread(target=private.serve_forever, daemon=True).start()
+    print(f"[DEBUG] Worker {worker_id} (pid {os.getpid()}) ready, private port {private.server_port}")
+    make_server('0.0.0.0', 0, app, threaded=True, fd=listen_fd).serve_forever()
+
+def run_workers(count: int, port: int):
+    """Bind the public port once and start `count` worker processes that share it"""
+    if not hasattr(os, 'fork'):
+        print("❌ Multi-worker mode needs a POSIX system")
+        sys.exit(1)
+
+    listener = socket.create_server(('0.0.0.0', port), backlog=512)
+    listener.set_inheritable(True)
+    db_path = os.environ.get('PYIDLE_CLUSTER_DB') or os.path.join(tempfile.gettempdir(), f'pyidle-cluster-{port}.sqlite')
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.unlink(db_path + suffix)
+        except FileNotFoundError:
+            pass
+
+    workers = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--port', str(port),
+             '--listen-fd', str(listener.fileno()), '--worker-id', f'w{index}'],
+            pass_fds=(listener.fileno(),),
+            env=dict(os.environ, PYIDLE_CLUSTER_DB=db_path)
+        )
+        for index in range(count)
+    ]
+    listener.close()
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+# ---------------------------------------------------------------------------
+# ASGI serving mode: same JSON API, children managed as asyncio subprocesses
+# ---------------------------------------------------------------------------
+
+class AsyncProcessChannel(ProcessChannel):
+    """ProcessChannel fed by asyncio reader tasks instead of the multiplexer"""
+
+    def __init__(self, process, interactive: bool = False):
+        super().__init__(process, interactive, streams=process.pipes)
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.outputs_closed = asyncio.Event()
+
+    def _publish(self, event, payload):
+        super()._publish(event, payload)
+        self.changed.set()
+
+    def _outputs_closed(self):
+        # The exit itself is reported by AsyncCodeExecutor once wait() returns
+        self.outputs_closed.set()
+
+    def force_close(self):
+        if not self.exited:
+            kill_strays(self.process)
+            self.loop.call_soon_threadsafe(self.detach)
+
+    def detach(self):
+        """Stop reading the pipes and close them (event loop thread)"""
+        for name in list(self._open_outputs) + ['control']:
+            stream = self.streams[name]
+            if not stream.closed:
+                self.loop.remove_reader(stream.fileno())
+                self.close_stream(name)
+
+    async def send_input_async(self, text: str):
+        with self.condition:
+            self.waiting_for_input = False
+            self.inputs_sent += 1
+            if self.budget:
+                self.budget.resume()
+        self.process.stdin.write((text + '\n').encode('utf-8'))
+        await self.process.stdin.drain()
+
+    async def wait_async(self, timeout=None):
+        """Returns 'input', 'exit' or 'timeout' without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        # Prompts of a run fed from `stdin` are answered from the pipe, not by a client
+        while not ((self.interactive and self.waiting_for_input) or self.exited):
+            self.changed.clear()
+            if deadline is None:
+                await self.changed.wait()
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return 'timeout'
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return 'timeout'
+        return 'exit' if self.exited else 'input'
+
+    async def wait_exit_async(self, timeout: float):
+        """True once the child is reaped and its pipes are closed, False on timeout"""
+        try:
+            await asyncio.wait_for(self._until_exited(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _until_exited(self):
+        while not self.exited:
+            self.changed.clear()
+            await self.changed.wait()
+
+class AsyncCodeExecutor:
+    """asyncio counterpart of UnifiedCodeExecutor for the ASGI serving mode.
+
+    Children are asyncio subprocesses read by event-loop tasks, so a program
+    waiting for input costs a couple of coroutines instead of a server
+    thread. The pre-flight compile and code cache are shared with the
+    threaded executor.
+    """
+
+    def __init__(self, helper: UnifiedCodeExecutor):
+        self.helper = helper
+        self.processes = {}
+        self.idle = deque()
+        self.pool_size = POOL_SIZE
+        self.refill_task = None
+        self._install_child_watcher()
+        self.sweep_task = asyncio.get_running_loop().create_task(self._sweep_loop())
+
+    def _install_child_watcher(self):
+        """Reap children through pidfds instead of one waiter thread per child"""
+        if sys.version_info >= (3, 12) or not hasattr(asyncio, 'PidfdChildWatcher'):
+            return  # 3.12+ already prefers pidfds where the kernel has them
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+        except (AttributeError, OSError):
+            return
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(asyncio.get_running_loop())
+        asyncio.set_child_watcher(watcher)
+
+    async def spawn_worker(self):
+        # Output pipes are plain fds watched with loop.add_reader, so the
+        # control pipe and the output pipes share ProcessChannel.read()
+        env = worker_env()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        control_r, control_w = os.pipe()
+        try:
+            worker = await asyncio.create_subprocess_exec(
+                sys.executable, '-u', '-c', WORKER_BOOTSTRAP, USER_CODE_FILENAME,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=stdout_w,
+                stderr=stderr_w,
+                env=env,
+                **PROCESS_GROUP_OPTIONS,
+                **control_pipe_options(control_w, env)
+            )
+        except:
+            for fd in (stdout_r, stderr_r, control_r):
+                os.close(fd)
+            raise
+        finally:
+            for fd in (stdout_w, stderr_w, control_w):
+                os.close(fd)
+        worker.pipes = {
+            'stdout': io.FileIO(stdout_r, 'rb'),
+            'stderr': io.FileIO(stderr_r, 'rb'),
+            'control': io.FileIO(control_r, 'rb')
+        }
+        worker.own_group = bool(PROCESS_GROUP_OPTIONS)
+        worker.run_token = env[RUN_TOKEN_ENV]
+        return worker
+
+    async def acquire_worker(self):
+        """Take a warm worker if one is idle, otherwise spawn one"""
+        while self.idle:
+            worker = self.idle.popleft()
+            if worker.returncode is None:
+                self._refill()
+                return worker
+        self._refill()
+        return await self.spawn_worker()
+
+    def _refill(self):
+        if self.pool_size and (self.refill_task is None or self.refill_task.done()):
+            self.refill_task = asyncio.get_running_loop().create_task(self._refill_pool())
+
+    async def _refill_pool(self):
+        while len(self.idle) < self.pool_size:
+            self.idle.append(await self.spawn_worker())
+
+    def _on_readable(self, loop, channel, name: str):
+        if not channel.read(name):
+            loop.remove_reader(channel.streams[name].fileno())
+            channel.close_stream(name)
+
+    async def _reap(self, channel):
+        process = channel.process
+        returncode = await process.wait()
+        # The child watcher has reaped the leader; anything it left behind in
+        # its group would otherwise keep the output pipes open
+        if getattr(process, 'own_group', False):
+            kill_process_group(process.pid)
+        try:
+            await asyncio.wait_for(channel.outputs_closed.wait(), ORPHAN_PIPE_GRACE)
+        except asyncio.TimeoutError:
+            # Held open by something that left the group
+            kill_strays(process)
+            channel.detach()
+        channel.mark_exited(returncode)
+
+    async def start_run(self, code: str, interactive: bool, stdin: str = '', limits: dict = None):
+        process = await self.acquire_worker()
+        channel = AsyncProcessChannel(process, interactive=interactive)
+        # Budgets live on the shared deadline scheduler; expiry kills the
+        # group from its thread and _reap sees the exit like any other
+        self.helper.start_budget(channel, 'interactive' if interactive else 'simple', limits)
+        loop = asyncio.get_running_loop()
+        for name, stream in channel.streams.items():
+            loop.add_reader(stream.fileno(), self._on_readable, loop, channel, name)
+        loop.create_task(self._reap(channel))
+
+        try:
+            process.stdin.write((self.helper.code_cache.frame(code) + stdin).encode('utf-8'))
+            await process.stdin.drain()
+            if not interactive:
+                process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the worker died early; its exit status tells the story
+        return channel
+
+    async def stop(self, session_id: str, reason: str = 'replaced'):
+        """Kill and forget the session's running program, if any; returns the reclaim time"""
+        process_info = self.processes.pop(session_id, None)
+        if not process_info:
+            return None
+        channel = process_info['channel']
+        started = time.perf_counter()
+        if not kill_run(channel.process):
+            if channel.exited:
+                return None
+            # The leader is already reaped; only something outside its group holds the pipes
+            kill_strays(channel.process)
+            channel.detach()
+        channel.cancelled = reason == 'cancel'
+        if not await channel.wait_exit_async(2.0):
+            print(f"[DEBUG] Run not reclaimed within 2s of SIGKILL ({reason})")
+            return None
+        elapsed = time.perf_counter() - started
+        self.helper.metrics.observe('pyidle_reclaim_seconds', elapsed, reason=reason)
+        return elapsed
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(SESSION_REAP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[DEBUG] ASGI run sweeper error: {e}")
+
+    def sweep(self):
+        """Forget finished runs nobody collected, with the threaded reaper's collect timeout"""
+        collect_timeout = INPUT_IDLE_TIMEOUT or SESSION_TTL
+        now = time.time()
+        for session_id, process_info in list(self.processes.items()):
+            if process_info['channel'].exited and now - process_info['last_activity'] > collect_timeout:
+                print(f"[DEBUG] Reaping uncollected run for session {session_id}")
+                del self.processes[session_id]
+                self.helper.metrics.inc('pyidle_reaped_processes_total', path='interactive')
 
-    def handle_input(self, session_id: str, user_input: str):
-        """Simple, reliable input handling"""
+    def running_count(self):
+        return sum(1 for process_info in self.processes.values() if not process_info['channel'].exited)
+
+    async def wait_step(self, channel, wait: float = None):
+        """Like UnifiedCodeExecutor.wait_for_step, without blocking the event loop"""
+        state = await channel.wait_async(wait)
+        return 'running' if state == 'timeout' else state
+
+    async def finish_step(self, session_id: str, channel, state: str, start_time: float, cursor: int = None):
+        if state not in ('input', 'running'):
+            process_info = self.processes.get(session_id)
+            if process_info is not None and process_info['channel'] is channel:
+                del self.processes[session_id]
+        return channel_response(channel, state, session_id, start_time, cursor)
+
+    async def execute_code(self, code: str, session_id: str, stdin: str = None, wait: float = None,
+                           limits: dict = None, client: str = None):
+        """Admit the run through the shared job queue, then run it (through the result cache when it can be)"""
+        start_time = time.time()
         try:
-            if session_id not in active_processes:
-                return {
-                    'success': False,
-                    'error': 'No active process for this session',
-                    'session_id': session_id
-                }
-            
-            process_info = active_processes[session_id]
-            process = process_info['process']
-            
-            if process.poll() is not None:
+            compiled = self.helper.preflight(code)
+        except SyntaxError as e:
+            return self.helper.syntax_error_response(e, session_id, start_time)
+
+        # The session's previous run gives back its slot before this one queues
+        await self.stop(session_id)
+        try:
+            ticket = await self.helper.admission.acquire_async(client, session_id)
+        except AdmissionRejected as e:
+            return self.helper.busy_response(e, session_id)
+
+        interactive = stdin is None and 'input(' in code
+        path = 'interactive' if interactive else 'simple'
+        self.helper.metrics.observe('pyidle_queue_wait_seconds', ticket.queue_wait, path=path)
+        try:
+            run = lambda: self.run_code(code, session_id, stdin, wait, limits, start_time, ticket)
+            if not interactive and self.helper.result_cache.enabled:
+                if self.helper.analyze_input_statements(code)['deterministic']:
+                    key = self.helper.result_cache.key(code, stdin or '')
+                    result, status = await self.helper.result_cache.run_async(key, run)
+                    if status != 'miss':
+                        result['session_id'] = session_id
+                        result['execution_time'] = round(time.time() - start_time, 3)
+                else:
+                    result, status = await run(), 'bypass'
+                result['cache'] = status
+            else:
+                result = await run()
+            result['queue_wait'] = round(ticket.queue_wait, 3)
+            if compiled:
+                result['compile'] = compiled
+            return result
+        finally:
+            # An interactive run keeps its slot until its child exits
+            if not interactive:
+                ticket.release()
+
+    async def run_code(self, code: str, session_id: str, stdin: str, wait: float, limits: dict,
+                       start_time: float, ticket: AdmissionTicket):
+        """Start the run and answer like the threaded executor's execute paths"""
+        try:
+            interactive = stdin is None and 'input(' in code
+            try:
+                channel = await self.start_run(code, interactive, stdin or '', limits)
+            except:
+                ticket.release()
+                raise
+            channel.on_exit(ticket.release)
+            process_info = self.processes[session_id] = {
+                'process': channel.process,
+                'channel': channel,
+                'start_time': start_time,
+                'last_activity': start_time
+            }
+            channel.on_exit(lambda: process_info.update(last_activity=time.time()))
+            if interactive:
+                state = await self.wait_step(channel, wait)
+                return await self.finish_step(session_id, channel, state, start_time)
+
+            await channel.wait_async(None)
+
+            if self.processes.get(session_id, {}).get('channel') is channel:
+                del self.processes[session_id]
+            if channel.timed_out:
                 return {
                     'success': False,
-                    'error': 'Process has already terminated',
-                    'session_id': session_id
+                    'output': channel.output_text(),
+                    **timeout_fields(channel.timeout_reason, channel.limits),
+                    'execution_time': round(time.time() - start_time, 3),
+                    'session_id': session_id,
+                    'engine': 'asyncio'
                 }
-            
-            try:
-                print(f"[DEBUG] Sending input: {user_input}")
-                
-                # Send input to process
-                process.stdin.write(user_input + '\n')
-                process.stdin.flush()
-                
-                # Wait for process to complete
-                output_buffer = process_info.get('output_buffer', '')
-                
-                # Continue reading output until completion
-                while True:
-                    if process.poll() is not None:
-                        # Process finished
-                        remaining_output, stderr = process.communicate()
-                        if remaining_output:
-                            output_buffer += remaining_output
-                        
-                        execution_time = round(time.time() - process_info['start_time'], 3)
-                        self.cleanup_process(session_id, process_info['temp_file'])
-                        
-                        # Clean output
-                        clean_output = output_buffer.replace('__NEED_INPUT__', '').replace('__COMPLETE__', '').replace('__ERROR__', '').strip()
-                        
-                        print(f"[DEBUG] Final output after input: {repr(clean_output)}")
-                        
-                        return {
-                            'success': process.returncode == 0,
-                            'output': clean_output,
-                            'error': stderr if stderr else None,
-                            'execution_time': execution_time,
-                            'session_id': session_id
-                        }
-                    
-                    # Read more output
-                    try:
-                        time.sleep(0.1)
-                        line = process.stdout.readline()
-                        if line:
-                            output_buffer += line
-                            print(f"[DEBUG] Read line: {repr(line)}")
-                            
-                            # Check if there's another input request
-                            if '__NEED_INPUT__' in line:
-                                # Another input needed
-                                lines = output_buffer.strip().split('\n')
-                                prompt = "Enter input: "
-                                for i, l in enumerate(lines):
-                                    if '__NEED_INPUT__' in l and i > 0:
-                                        prompt = lines[i-1].strip()
-                                        break
-                                
-                                active_processes[session_id]['output_buffer'] = output_buffer
-                                
-                                return {
-                                    'success': True,
-                                    'output': output_buffer.replace('__NEED_INPUT__', '').strip(),
-                                    'waiting_for_input': True,
-                                    'input_prompt': prompt,
-                                    'session_id': session_id
-                                }
-                    except:
-                        pass
-                    
-                    # Timeout protection
-                    if time.time() - process_info['start_time'] > 30:
-                        process.terminate()
-                        self.cleanup_process(session_id, process_info['temp_file'])
-                        return {
-                            'success': False,
-                            'error': 'Process execution timeout',
-                            'session_id': session_id
-                        }
-                
-            except Exception as e:
-                print(f"[DEBUG] Input handling error: {e}")
+            if channel.cancelled:
                 return {
                     'success': False,
-                    'error': f'Failed to send input: {str(e)}',
-                    'session_id': session_id
+                    'output': channel.output_text(),
+                    'error': 'Run cancelled',
+                    'cancelled': True,
+                    'execution_time': round(time.time() - start_time, 3),
+                    'session_id': session_id,
+                    'engine': 'asyncio'
                 }
-                
+            stderr = channel.stderr_text()
+            return {
+                'success': channel.returncode == 0,
+                'output': channel.output_text(),
+                'error': stderr if stderr else None,
+                'execution_time': round(time.time() - start_time, 3),
+                'session_id': session_id,
+                **output_truncation(channel),
+                'engine': 'asyncio'
+            }
+
         except Exception as e:
             return {
                 'success': False,
-                'error': f'Input handling error: {str(e)}',
+                'output': '',
+                'error': f'Execution error: {str(e)}',
+                'session_id': session_id
+            }
+
+    async def handle_input(self, session_id: str, user_input: str, cursor: int = None, wait: float = None):
+        process_info = self.processes.get(session_id)
+        if not process_info:
+            return {
+                'success': False,
+                'error': 'No active process for this session',
+                'session_id': session_id
+            }
+
+        process_info['last_activity'] = time.time()
+        channel = process_info['channel']
+        if channel.exited and channel.timed_out:
+            # Stopped at the prompt by its input-idle budget: say so
+            return await self.finish_step(session_id, channel, 'exit', process_info['start_time'], cursor)
+        if channel.exited:
+            return {
+                'success': False,
+                'error': 'Process has already terminated',
+                'session_id': session_id
+            }
+        if not channel.waiting_for_input:
+            return {
+                'success': False,
+                'error': 'The program is not waiting for input',
+                'not_waiting': True,
                 'session_id': session_id
             }
 
-    def monitor_process_for_completion(self, session_id: str, process, temp_file_path: str, start_time: float):
-        """Monitor process after input is sent, focusing on completion and full output"""
-        import time
-        import threading
-        import queue
-        
-        output_buffer = ""
-        stderr_buffer = ""
-        output_queue = queue.Queue()
-        
-        def read_all_output():
-            """Read all remaining output from the process"""
-            try:
-                while True:
-                    line = process.stdout.readline()
-                    if not line:
-                        break
-                    output_queue.put(line)
-                    print(f"[DEBUG] Process output: {repr(line)}")
-            except:
-                pass
-        
-        # Start reader thread
-        reader_thread = threading.Thread(target=read_all_output, daemon=True)
-        reader_thread.start()
-        
-        # Wait for process to complete while collecting output
-        timeout_counter = 0
-        while process.poll() is None and timeout_counter < 100:  # 10 second timeout
-            time.sleep(0.1)
-            timeout_counter += 1
-            
-            # Collect any available output
-            while not output_queue.empty():
-                try:
-                    line = output_queue.get_nowait()
-                    output_buffer += line
-                except:
-                    break
-            
-            # Check for any new input requests (in case there are multiple inputs)
-            input_request = self.detect_input_request(output_buffer)
-            if input_request and '__INPUT_REQUEST__' in output_buffer:
-                # Found another input request
-                print(f"[DEBUG] Found additional input request: {input_request}")
-                active_processes[session_id]['output_buffer'] = output_buffer
-                
-                return {
-                    'success': True,
-                    'output': self.clean_partial_output(output_buffer),
-                    'waiting_for_input': True,
-                    'input_request': input_request,
-                    'session_id': session_id
-                }
-        
-        # Process completed or timed out - collect any remaining output
         try:
-            remaining_stdout, stderr = process.communicate(timeout=2)
-            if remaining_stdout:
-                output_buffer += remaining_stdout
-                print(f"[DEBUG] Final process output: {repr(remaining_stdout)}")
-            stderr_buffer = stderr if stderr else ""
-        except:
-            stderr_buffer = ""
-        
-        # Collect any remaining queued output
-        while not output_queue.empty():
+            await channel.send_input_async(user_input)
+        except Exception as e:
+            return {
+                'success': False,
+                'error': f'Failed to send input: {str(e)}',
+                'session_id': session_id
+            }
+
+        start_time = process_info['start_time']
+        state = await self.wait_step(channel, wait)
+        return await self.finish_step(session_id, channel, state, start_time, cursor)
+
+    async def poll(self, session_id: str, token: str, cursor: int = None, wait: float = None):
+        process_info = self.processes.get(session_id)
+        if not process_info:
+            return {
+                'success': False,
+                'error': 'No active process for this session',
+                'session_id': session_id
+            }
+
+        channel = process_info['channel']
+        if token != channel.resume_token():
+            return {
+                'success': False,
+                'error': 'Resume token does not match the current run (it was restarted or given more input)',
+                'stale_token': True,
+                'session_id': session_id
+            }
+
+        process_info['last_activity'] = time.time()
+        start_time = process_info['start_time']
+        state = await self.wait_step(channel, wait)
+        return await self.finish_step(session_id, channel, state, start_time, cursor)
+
+    async def shutdown(self):
+        self.sweep_task.cancel()
+        for session_id in list(self.processes):
+            await self.stop(session_id, 'shutdown')
+        while self.idle:
+            worker = self.idle.popleft()
             try:
-                line = output_queue.get_nowait()
-                output_buffer += line
-            except:
-                break
-        
-        execution_time = round(time.time() - start_time, 3)
-        self.cleanup_process(session_id, temp_file_path)
-        
-        # Clean the output and return final result
-        clean_output = self.clean_final_output(output_buffer)
-        print(f"[DEBUG] Final cleaned output: {repr(clean_output)}")
-        
-        return {
-            'success': process.returncode == 0,
-            'output': clean_output,
-            'error': stderr_buffer if stderr_buffer else None,
-            'execution_time': execution_time,
-            'session_id': session_id
-        }
+                worker.kill()
+            except ProcessLookupError:
+                pass
+            await worker.wait()
 
-# Initialize executor
-executor = UnifiedCodeExecutor()
+# Created on ASGI startup so it binds to the server's event loop
+async_executor = None
 
-# API Routes  
-@app.route('/health')
-def health_check():
-    """Health check endpoint"""
-    return jsonify({
+# Address of the client whose request the current task is serving (ASGI's request.remote_addr)
+asgi_client = contextvars.ContextVar('asgi_client', default='unknown')
+
+async def asgi_health(data):
+    return 200, {
         'success': True,
         'status': 'healthy',
+        'mode': 'asgi',
         'python_version': f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}",
         'timestamp': datetime.now().isoformat(),
         'active_sessions': len(sessions),
-        'active_processes': len(active_processes)
-    })
+        'active_processes': async_executor.running_count(),
+        'uncollected_runs': len(async_executor.processes) - async_executor.running_count(),
+        'pool': {'size': async_executor.pool_size, 'idle': len(async_executor.idle)},
+        'admission': executor.admission.stats(),
+        'result_cache': executor.result_cache.stats()
+    }
 
-@app.route('/session/create', methods=['POST'])
-def create_session():
-    """Create a new session"""
-    try:
-        session_id = str(uuid.uuid4())
-        sessions[session_id] = {
-            'created_at': datetime.now(),
-            'last_activity': datetime.now()
-        }
-        return jsonify({
-            'success': True,
-            'session_id': session_id
-        })
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500
+async def asgi_create_session(data):
+    session_id = str(uuid.uuid4())
+    sessions.touch(session_id)
+    return 200, {'success': True, 'session_id': session_id}
 
-@app.route('/session/clear', methods=['POST'])
-def clear_session():
-    """Clear session"""
-    try:
-        data = request.get_json()
-        session_id = data.get('session_id')
-        
-        # Stop any active processes
-        if session_id in active_processes:
-            try:
-                process_info = active_processes[session_id]
-                process_info['process'].terminate()
-                os.unlink(process_info['temp_file'])
-                del active_processes[session_id]
-            except:
-                pass
-        
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500
+async def asgi_clear_session(data):
+    await async_executor.stop(data.get('session_id'), 'clear')
+    return 200, {'success': True}
 
-@app.route('/execute', methods=['POST'])
-def execute_code():
-    """Execute Python code with input support"""
+async def asgi_reset_session(data):
+    session_id = data.get('session_id')
+    if not session_id:
+        return 400, {'success': False, 'error': 'No session_id provided'}
+    await async_executor.stop(session_id, 'reset')
+    if session_id in sessions:
+        sessions.touch(session_id)
+    return 200, {'success': True, 'message': f'Session {session_id} reset successfully'}
+
+async def asgi_execute(data):
+    code = data.get('code', '')
+    if not code.strip():
+        return 400, {'success': False, 'error': 'No code provided'}
     try:
-        data = request.get_json()
-        code = data.get('code', '')
-        session_id = data.get('session_id')
-        
-        if not code.strip():
-            return jsonify({
-                'success': False,
-                'error': 'No code provided'
-            }), 400
-        
-        # Create session if not provided
-        if not session_id:
-            session_id = str(uuid.uuid4())
-        
-        # IMPORTANT: Clean up any existing process for this session
-        # This ensures multiple clicks on "Run" don't cause conflicts
-        if session_id in active_processes:
-            try:
-                # Terminate existing process
-                existing_process = active_processes[session_id]['process']
-                if existing_process.poll() is None:  # Still running
-                    existing_process.terminate()
-                    try:
-                        existing_process.wait(timeout=2)
-                    except subprocess.TimeoutExpired:
-                        existing_process.kill()
-                
-                # Clean up temp file
-                temp_file = active_processes[session_id].get('temp_file')
-                if temp_file and os.path.exists(temp_file):
-                    os.unlink(temp_file)
-                    
-                # Remove from active processes
-                del active_processes[session_id]
-                
-                print(f"[DEBUG] Cleaned up existing process for session {session_id}")
-            except Exception as e:
-                print(f"[DEBUG] Error cleaning up existing process: {e}")
-        
-        # Reset/Create session state
-        sessions[session_id] = {
-            'created_at': datetime.now(),
-            'last_activity': datetime.now(),
-            'reset_count': sessions.get(session_id, {}).get('reset_count', 0) + 1
-        }
-        
-        print(f"[DEBUG] Executing new code for session {session_id} (reset #{sessions[session_id]['reset_count']})")
-        
-        # Execute the code
-        result = executor.execute_code(code, session_id)
-        return jsonify(result)
-        
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': f'Server error: {str(e)}'
-        }), 500
+        stdin = normalize_stdin(data.get('stdin'))
+    except ValueError as e:
+        return 400, {'success': False, 'error': str(e)}
+    if data.get('kernel'):
+        return 400, {'success': False, 'error': 'Kernel mode needs the threaded server (run without --asgi)'}
+    try:
+        wait = parse_wait(data.get('wait'))
+        limits = parse_time_limits(data)
+    except ValueError as e:
+        return 400, {'success': False, 'error': str(e)}
+    session_id = data.get('session_id') or str(uuid.uuid4())
+    sessions.reset(session_id)
+    result = await async_executor.execute_code(code, session_id, stdin, wait, limits, asgi_client.get())
+    return 429 if result.get('queue_full') else 200, result
 
-@app.route('/input', methods=['POST'])
-def handle_input():
-    """Handle input for interactive programs"""
+async def asgi_input(data):
     try:
-        data = request.get_json()
-        session_id = data.get('session_id')
-        user_input = data.get('input', '')
-        
-        result = executor.handle_input(session_id, user_input)
-        return jsonify(result)
-        
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': f'Server error: {str(e)}'
-        }), 500
+        cursor = parse_cursor(data.get('cursor'))
+        wait = parse_wait(data.get('wait'))
+    except ValueError as e:
+        return 400, {'success': False, 'error': str(e)}
+    result = await async_executor.handle_input(data.get('session_id'), data.get('input', ''), cursor, wait)
+    return 409 if result.get('not_waiting') else 200, result
 
-@app.route('/session/reset', methods=['POST'])
-def reset_session():
-    """Reset a session - cleanup any active processes"""
+async def asgi_poll(data):
+    if not data.get('resume_token'):
+        return 400, {'success': False, 'error': 'No resume_token provided'}
     try:
-        data = request.get_json()
-        session_id = data.get('session_id')
-        
-        if not session_id:
-            return jsonify({
-                'success': False,
-                'error': 'No session_id provided'
-            }), 400
-        
-        # Clean up active process if exists
-        if session_id in active_processes:
+        cursor = parse_cursor(data.get('cursor'))
+        wait = parse_wait(data.get('wait'))
+    except ValueError as e:
+        return 400, {'success': False, 'error': str(e)}
+    result = await async_executor.poll(data.get('session_id'), data['resume_token'], cursor, wait)
+    return 409 if result.get('stale_token') else 200, result
+
+async def asgi_cancel(data):
+    session_id = data.get('session_id')
+    if not session_id:
+        return 400, {'success': False, 'error': 'No session_id provided'}
+    process_info = async_executor.processes.get(session_id)
+    elapsed = await async_executor.stop(session_id, 'cancel')
+    reclaimed = process_info is None or await asyncio.get_running_loop().run_in_executor(
+        None, run_reclaimed, process_info['channel'].process, process_info['channel'])
+    return 200, {
+        'success': True,
+        'cancelled': elapsed is not None,
+        'reclaimed': reclaimed,
+        'reclaim_ms': round(elapsed * 1000, 3) if elapsed is not None else None,
+        'session_id': session_id
+    }
+
+async def asgi_output(run_id, params):
+    return output_page(run_id, params)
+
+ASGI_ROUTES = {
+    ('GET', '/health'): asgi_health,
+    ('POST', '/session/create'): asgi_create_session,
+    ('POST', '/session/clear'): asgi_clear_session,
+    ('POST', '/session/reset'): asgi_reset_session,
+    ('POST', '/execute'): asgi_execute,
+    ('POST', '/execute/cancel'): asgi_cancel,
+    ('POST', '/input'): asgi_input,
+    ('POST', '/poll'): asgi_poll
+}
+
+async def asgi_app(scope, receive, send):
+    """ASGI application serving the same JSON API as the Flask routes"""
+    global async_executor
+
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                async_executor = AsyncCodeExecutor(executor)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if async_executor:
+                    await async_executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+    if async_executor is None:
+        async_executor = AsyncCodeExecutor(executor)
+    asgi_client.set((scope.get('client') or ('unknown',))[0])
+
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    if scope['method'] == 'OPTIONS':
+        status, payload = 204, None
+    else:
+        handler = ASGI_ROUTES.get((scope['method'], scope['path']))
+        if scope['method'] == 'GET' and scope['path'].startswith('/output/'):
+            params = dict(urllib.parse.parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+            status, payload = await asgi_output(scope['path'][len('/output/'):], params)
+        elif handler is None:
+            status, payload = 404, {'success': False, 'error': 'Not found'}
+        else:
             try:
-                process_info = active_processes[session_id]
-                process = process_info.get('process')
-                
-                if process and process.poll() is None:
-                    process.terminate()
-                    try:
-                        process.wait(timeout=2)
-                    except subprocess.TimeoutExpired:
-                        process.kill()
-                
-                temp_file = process_info.get('temp_file')
-                if temp_file and os.path.exists(temp_file):
-                    os.unlink(temp_file)
-                
-                del active_processes[session_id]
-                print(f"[DEBUG] Reset session {session_id}")
-                
+                status, payload = await handler(json.loads(body) if body else {})
             except Exception as e:
-                print(f"[DEBUG] Error resetting session: {e}")
-        
-        # Reset session state
-        if session_id in sessions:
-            sessions[session_id].update({
-                'input_info': None,
-                'current_input_index': 0,
-                'inputs_collected': [],
-                'last_activity': datetime.now()
-            })
-        
-        return jsonify({
-            'success': True,
-            'message': f'Session {session_id} reset successfully'
-        })
-        
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': f'Server error: {str(e)}'
-        }), 500
+                status, payload = 500, {'success': False, 'error': f'Server error: {str(e)}'}
+
+    if payload is None:
+        content = b''
+    else:
+        content = orjson.dumps(payload) if HAS_ORJSON else json.dumps(payload).encode('utf-8')
+    headers = [
+        (b'content-type', b'application/json'),
+        (b'access-control-allow-origin', b'*'),
+        (b'access-control-allow-headers', b'Content-Type'),
+        (b'access-control-allow-methods', b'GET, POST, OPTIONS')
+    ]
+    if status == 429 and payload.get('retry_after') is not None:
+        headers.append((b'retry-after', str(payload['retry_after']).encode()))
+    accept_encoding = b''.join(value for name, value in scope['headers'] if name.lower() == b'accept-encoding')
+    if GZIP_MIN_BYTES > 0 and len(content) >= GZIP_MIN_BYTES and b'gzip' in accept_encoding.lower():
+        content = gzip.compress(content, compresslevel=5)
+        headers += [(b'content-encoding', b'gzip'), (b'vary', b'Accept-Encoding')]
+    headers.append((b'content-length', str(len(content)).encode()))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers
+    })
+    await send({'type': 'http.response.body', 'body': content})
 
 @app.route('/')
 def dashboard():
@@ -964,7 +5671,7 @@ def dashboard():
                 <strong>Status:</strong> Running ✅<br>
                 <strong>Python Version:</strong> {sys.version}<br>
                 <strong>Active Sessions:</strong> {len(sessions)}<br>
-                <strong>Active Processes:</strong> {len(active_processes)}<br>
+                <strong>Active Processes:</strong> {sessions.run_count()}<br>
                 <strong>Server Time:</strong> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
             </div>
             
@@ -995,23 +5702,56 @@ print(n * 3)
     '''
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Unified Python IDLE Backend Server')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--asgi', action='store_true',
+                        help='serve the same API from asyncio subprocesses (requires uvicorn)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='run N server processes on the port, routing each session to its owner')
+    parser.add_argument('--listen-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-id', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.listen_fd is not None:
+        # One worker of a --workers N server, started by run_workers()
+        serve_cluster_worker(args.listen_fd, args.worker_id, os.environ['PYIDLE_CLUSTER_DB'])
+        sys.exit(0)
+
     print("🚀 Starting Unified Python IDLE Backend Server (Fixed)")
     print("=" * 60)
     print(f"🐍 Python Version: {sys.version}")
-    print(f"🌐 Server URL: http://localhost:5000")
+    print(f"🌐 Server URL: http://localhost:{args.port}")
+    print(f"⚙️  Mode: {'asgi (asyncio)' if args.asgi else 'threaded (Flask)'}"
+          + (f", {args.workers} workers" if args.workers > 1 else ''))
     print("✅ Input support enabled for interactive programs (FIXED)")
     print("⚠️  Press Ctrl+C to stop the server")
     print()
     
+    if args.asgi:
+        if not HAS_UVICORN:
+            print("❌ ASGI mode needs uvicorn: pip install uvicorn")
+            sys.exit(1)
+        # The asyncio executor keeps its own warm workers
+        executor.pool.shutdown()
+        uvicorn.run(asgi_app, host='0.0.0.0', port=args.port, log_level='warning')
+        sys.exit(0)
+    
+    if args.workers > 1:
+        # The supervisor only hands out the socket; workers run the code
+        executor.pool.shutdown()
+        if executor.fork_server:
+            executor.fork_server.shutdown()
+        run_workers(args.workers, args.port)
+        sys.exit(0)
+    
     try:
-        app.run(host='0.0.0.0', port=5000, debug=False)
+        app.run(host='0.0.0.0', port=args.port, debug=False)
     except KeyboardInterrupt:
         print("\\n🛑 Server stopped by user")
+        executor.pool.shutdown()
+        if executor.fork_server:
+            executor.fork_server.shutdown()
         # Clean up any active processes
-        for session_id, process_info in active_processes.items():
-            try:
-                process_info['process'].terminate()
-                os.unlink(process_info['temp_file'])
-            except:
-                pass
+        for session_id, process_info in sessions.runs():
+            kill_run(process_info['process'])
         print("✅ Cleanup completed")
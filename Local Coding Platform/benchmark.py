@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Unified Python IDLE Backend
+
+    python benchmark.py servers [--clients 50] [--rounds 3]
+    python benchmark.py analysis [--corpus DIR] [--rounds 200]
+    python benchmark.py wire [--prompts 50] [--lines 200]
+
+The servers benchmark starts the backend(s) it needs as subprocesses; the
+analysis benchmark imports the backend in-process. Run them from this
+directory with the backend's dependencies installed.
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.join(HERE, 'Backendfile.py')
+
+# A typical classroom program: some work, then a prompt, then more output
+INTERACTIVE_PROGRAM = '''import time
+time.sleep(0.5)
+name = input("Name: ")
+print("Hello", name)
+'''
+
+# Typical classroom submissions for the analysis benchmark (--corpus replaces them)
+SAMPLE_SUBMISSIONS = {
+    'hello': 'print("Hello, World!")\n',
+    'sum-two': 'a = int(input("A: "))\nb = int(input("B: "))\nprint(a + b)\n',
+    'grades': '''scores = []
+n = int(input("How many students? "))
+for i in range(n):
+    name = input(f"Name {i + 1}: ")
+    score = float(input("Score: "))
+    scores.append((name, score))
+best = max(scores, key=lambda pair: pair[1])
+print(f"Top: {best[0]} with {best[1]:.1f}")
+''',
+    'guessing-game': '''import random
+secret = random.randint(1, 100)
+while (guess := int(input("Guess: "))) != secret:
+    print("Higher" if guess < secret else "Lower")
+print("Correct!")
+'''
+}
+
+
+def generated_submission(functions: int):
+    """A large machine-generated program, like the ones produced by code generators"""
+    parts = []
+    for index in range(functions):
+        parts.append(
+            f'def step_{index}(values):\n'
+            f'    total = 0\n'
+            f'    for value in values:\n'
+            f'        total += value * {index}\n'
+            f'    return total\n'
+        )
+    parts.append('count = int(input("Count: "))\n')
+    parts.append(f'print(sum(step_{functions - 1}(range(count)) for _ in range(3)))\n')
+    return ''.join(parts)
+
+
+def load_corpus(directory: str):
+    if not directory:
+        corpus = dict(SAMPLE_SUBMISSIONS)
+        corpus['generated-2k-lines'] = generated_submission(400)
+        corpus['generated-20k-lines'] = generated_submission(4000)
+        return corpus
+    corpus = {}
+    for path in sorted(glob.glob(os.path.join(directory, '**', '*.py'), recursive=True)):
+        with open(path, encoding='utf-8', errors='replace') as source:
+            corpus[os.path.relpath(path, directory)] = source.read()
+    return corpus
+
+
+def post(base_url: str, path: str, payload: dict, timeout: float = 60):
+    request = urllib.request.Request(
+        base_url + path,
+        data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def post_raw(base_url: str, path: str, payload: dict, headers: dict = None, timeout: float = 60):
+    """POST and return (bytes received for the body, decoded JSON)"""
+    request = urllib.request.Request(
+        base_url + path,
+        data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json', **(headers or {})}
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        body = response.read()
+        wire_bytes = len(body)
+        if response.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return wire_bytes, json.loads(body)
+
+
+def start_server(port: int, extra_args: list):
+    server = subprocess.Popen(
+        [sys.executable, BACKEND, '--port', str(port)] + extra_args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f'Server on port {port} did not come up')
+
+
+def thread_count(pid: int):
+    """Threads currently used by a process (Linux only, None elsewhere)"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def run_sessions(base_url: str, clients: int):
+    """Run `clients` concurrent execute+input sessions; returns latencies and failures"""
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def session(index: int):
+        session_id = f'bench-{index}-{time.time_ns()}'
+        started = time.perf_counter()
+        try:
+            first = post(base_url, '/execute', {'code': INTERACTIVE_PROGRAM, 'session_id': session_id})
+            if not first.get('waiting_for_input'):
+                raise RuntimeError(first.get('error') or 'no input prompt')
+            final = post(base_url, '/input', {'session_id': session_id, 'input': 'bench'})
+            if 'Hello bench' not in (final.get('output') or ''):
+                raise RuntimeError(final.get('error') or 'unexpected output')
+            with lock:
+                latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            with lock:
+                failures.append(str(e))
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, failures
+
+
+def percentile(values: list, fraction: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def bench_servers(args):
+    """Threaded Flask server vs. the asyncio (ASGI) server mode"""
+    modes = [('flask (threaded)', 5101, []), ('asgi (asyncio)', 5102, ['--asgi'])]
+    print(f'{args.clients} concurrent interactive sessions x {args.rounds} rounds\n')
+    print(f"{'mode':<18}{'sessions/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'max threads':>13}{'failed':>8}")
+
+    for name, port, extra in modes:
+        server = start_server(port, extra)
+        base_url = f'http://127.0.0.1:{port}'
+        try:
+            latencies, failures, peak_threads = [], [], 0
+            stop = threading.Event()
+
+            def sample_threads():
+                nonlocal peak_threads
+                while not stop.is_set():
+                    peak_threads = max(peak_threads, thread_count(server.pid) or 0)
+                    time.sleep(0.05)
+
+            sampler = threading.Thread(target=sample_threads, daemon=True)
+            sampler.start()
+            started = time.perf_counter()
+            for _ in range(args.rounds):
+                round_latencies, round_failures = run_sessions(base_url, args.clients)
+                latencies += round_latencies
+                failures += round_failures
+            elapsed = time.perf_counter() - started
+            stop.set()
+            sampler.join()
+
+            rate = len(latencies) / elapsed if elapsed else 0
+            p50 = percentile(latencies, 0.5) * 1000 if latencies else float('nan')
+            p95 = percentile(latencies, 0.95) * 1000 if latencies else float('nan')
+            print(f'{name:<18}{rate:>12.1f}{p50:>10.0f}{p95:>10.0f}{peak_threads or "-":>13}{len(failures):>8}')
+            if failures:
+                print(f'  first failure: {failures[0]}')
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+
+
+def bench_analysis(args):
+    """Static input()/determinism analysis: first sight of a program vs. a resubmission"""
+    os.environ.setdefault('PYIDLE_POOL_SIZE', '0')  # no worker interpreters needed
+    sys.path.insert(0, HERE)
+    import Backendfile
+
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        raise SystemExit(f'No .py files found in {args.corpus}')
+    cache = Backendfile.AnalysisCache(len(corpus))
+    print(f'{len(corpus)} submissions x {args.rounds} rounds\n')
+    print(f"{'submission':<28}{'lines':>8}{'inputs':>8}{'parse us':>12}{'cached us':>12}")
+
+    total_cold = total_warm = 0.0
+    for name, code in corpus.items():
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            info = Backendfile.analyze_source(code)
+        cold = (time.perf_counter() - started) / args.rounds
+
+        cache.analyze(code)
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            cache.analyze(code)
+        warm = (time.perf_counter() - started) / args.rounds
+
+        total_cold += cold
+        total_warm += warm
+        print(f'{name[:27]:<28}{code.count(chr(10)) + 1:>8}{info["count"]:>8}{cold * 1e6:>12.1f}{warm * 1e6:>12.1f}')
+    print(f"{'total':<28}{'':>8}{'':>8}{total_cold * 1e6:>12.1f}{total_warm * 1e6:>12.1f}")
+
+
+def bench_wire(args):
+    """Bytes sent for a chatty interactive program: full output vs. cursor deltas vs. deltas + gzip"""
+    program = (
+        f'for step in range({args.prompts}):\n'
+        f'    for line in range({args.lines}):\n'
+        f'        print(f"step {{step}} line {{line}}: " + "x" * 24)\n'
+        f'    input("next? ")\n'
+        f'print("done")\n'
+    )
+    modes = [
+        ('full output', False, {}),
+        ('cursor deltas', True, {}),
+        ('deltas + gzip', True, {'Accept-Encoding': 'gzip'})
+    ]
+    port = 5103
+    server = start_server(port, [])
+    base_url = f'http://127.0.0.1:{port}'
+    print(f'{args.prompts} prompts x {args.lines} lines of output per step\n')
+    print(f"{'mode':<18}{'bytes':>14}{'requests':>10}{'ms':>10}")
+    try:
+        for name, use_cursor, headers in modes:
+            session_id = f'wire-{time.time_ns()}'
+            started = time.perf_counter()
+            total, result = post_raw(base_url, '/execute', {'code': program, 'session_id': session_id}, headers)
+            requests_made = 1
+            while result.get('waiting_for_input'):
+                payload = {'session_id': session_id, 'input': ''}
+                if use_cursor:
+                    payload['cursor'] = result.get('output_cursor', 0)
+                size, result = post_raw(base_url, '/input', payload, headers)
+                total += size
+                requests_made += 1
+            elapsed = (time.perf_counter() - started) * 1000
+            if 'done' not in (result.get('output') or ''):
+                print(f'  {name}: run did not finish: {result.get("error")}')
+            print(f'{name:<18}{total:>14,}{requests_made:>10}{elapsed:>10.0f}')
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+BENCHMARKS = {
+    'servers': bench_servers,
+    'analysis': bench_analysis,
+    'wire': bench_wire
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Unified Python IDLE Backend benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--clients', type=int, default=50, help='concurrent sessions per round')
+    parser.add_argument('--rounds', type=int, default=None, help='rounds per benchmark (servers: 3, analysis: 200)')
+    parser.add_argument('--corpus', help='directory of .py submissions for the analysis benchmark')
+    parser.add_argument('--prompts', type=int, default=50, help='input() calls in the wire benchmark program')
+    parser.add_argument('--lines', type=int, default=200, help='lines printed before each prompt (wire benchmark)')
+    args = parser.parse_args()
+    if args.rounds is None:
+        args.rounds = 200 if args.benchmark == 'analysis' else 3
+    BENCHMARKS[args.benchmark](args)